@@ -0,0 +1,357 @@
+"""
+アドミッション制御と負荷制限
+
+- ルートごとに優先度クラスを割り当て、クラス別の同時実行数と全体の同時実行数を制限する
+- 枠が空いたら優先度の高いクラスの待ち行列から順に通す
+- 待ち行列が一杯、または推定待ち時間が上限を超える場合は即座に503 (Retry-After付き) を返す
+- ユーザー（検証済みトークンのsub、未認証・検証失敗ならIP）ごとのトークンバケットで429を返す
+  （信頼するプロキシ経由の接続では X-Forwarded-For からクライアントのIPを取る）
+
+リクエストがDB接続プールやスレッドプールの後ろで長時間待たされてタイムアウトするより、
+早く失敗させてクライアントに再試行させる方が全体として劣化が穏やかになる。
+"""
+import asyncio
+import heapq
+import ipaddress
+import itertools
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from jose.exceptions import JWTError
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from startup import lazy_module
+
+jwt = lazy_module("jose.jwt")
+
+logger = logging.getLogger(__name__)
+
+
+class PriorityClass:
+    """優先度クラス（priorityが小さいほど優先）"""
+
+    def __init__(
+        self,
+        name: str,
+        priority: int,
+        max_concurrency: int,
+        max_queue: int,
+        queue_timeout: float,
+        token_cost: float = 1.0,
+    ):
+        self.name = name
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.token_cost = token_cost
+
+
+READ = PriorityClass("read", priority=0, max_concurrency=32, max_queue=64, queue_timeout=2.0)
+WRITE = PriorityClass("write", priority=1, max_concurrency=8, max_queue=32, queue_timeout=5.0, token_cost=2.0)
+EXPENSIVE = PriorityClass("expensive", priority=2, max_concurrency=4, max_queue=16, queue_timeout=5.0, token_cost=5.0)
+ADMIN = PriorityClass("admin", priority=3, max_concurrency=2, max_queue=0, queue_timeout=0.0, token_cost=0.0)
+
+# スレッドプール（anyioのデフォルト40）を使い切らない全体の上限
+TOTAL_CONCURRENCY = 40
+
+# (メソッド, パスの前方一致, クラス) 先に一致したものを使う。クラスがNoneなら制御しない
+ROUTE_RULES: List[Tuple[str, str, Optional[PriorityClass]]] = [
+    ("GET", "/spots/stream", None),        # 長時間接続のSSE
+    ("GET", "/health/", None),             # ロードバランサーのヘルスチェック
+    ("*", "/admin/", ADMIN),
+    ("POST", "/upload/image", EXPENSIVE),
+    ("POST", "/users/me/icon", EXPENSIVE),
+    ("POST", "/auth/signup", EXPENSIVE),   # bcrypt
+    ("POST", "/auth/login", EXPENSIVE),    # bcrypt
+    ("POST", "/spots/along-route", READ),  # 検索（ルートをボディで受け取るためPOST）
+    ("GET", "/", READ),
+    ("HEAD", "/", READ),
+    ("*", "/", WRITE),
+]
+
+# ユーザーごとのトークンバケット
+RATE_LIMIT_CAPACITY = 60.0
+RATE_LIMIT_REFILL_PER_SECOND = 10.0
+MAX_TRACKED_CLIENTS = 100_000
+
+# 処理時間の指数移動平均の重み
+LATENCY_EWMA_ALPHA = 0.2
+
+
+def classify(method: str, path: str) -> Optional[PriorityClass]:
+    for rule_method, prefix, priority_class in ROUTE_RULES:
+        if rule_method in ("*", method) and path.startswith(prefix):
+            return priority_class
+    return None
+
+
+class Rejected(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Server is busy")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """イベントループ上でのみ使う（ロック不要）"""
+
+    def __init__(self, total_concurrency: int = TOTAL_CONCURRENCY):
+        self.total_concurrency = total_concurrency
+        self.in_flight_total = 0
+        self.in_flight: Dict[str, int] = {}
+        self.queued: Dict[str, int] = {}
+        self.latency_ewma: Dict[str, float] = {}
+        self.rejected: Dict[str, int] = {}
+        self._waiters: List[tuple] = []  # (priority, seq, future, class)
+        self._seq = itertools.count()
+
+    def _can_admit(self, pc: PriorityClass) -> bool:
+        return (
+            self.in_flight_total < self.total_concurrency
+            and self.in_flight.get(pc.name, 0) < pc.max_concurrency
+        )
+
+    def _admit(self, pc: PriorityClass) -> None:
+        self.in_flight_total += 1
+        self.in_flight[pc.name] = self.in_flight.get(pc.name, 0) + 1
+
+    def _has_waiters_ahead(self, pc: PriorityClass) -> bool:
+        return any(w[0] <= pc.priority and not w[2].done() for w in self._waiters)
+
+    def _estimated_wait(self, pc: PriorityClass) -> float:
+        """前に並んでいる件数と平均処理時間から待ち時間を見積もる"""
+        latency = self.latency_ewma.get(pc.name)
+        if latency is None:
+            return 0.0
+        ahead = self.queued.get(pc.name, 0) + 1
+        return ahead * latency / pc.max_concurrency
+
+    def _reject(self, pc: PriorityClass) -> Rejected:
+        self.rejected[pc.name] = self.rejected.get(pc.name, 0) + 1
+        latency = self.latency_ewma.get(pc.name, 1.0)
+        return Rejected(retry_after=max(1.0, latency * 2))
+
+    async def acquire(self, pc: PriorityClass) -> None:
+        if self._can_admit(pc) and not self._has_waiters_ahead(pc):
+            self._admit(pc)
+            return
+
+        queued = self.queued.get(pc.name, 0)
+        if queued >= pc.max_queue or self._estimated_wait(pc) > pc.queue_timeout:
+            raise self._reject(pc)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (pc.priority, next(self._seq), future, pc))
+        self.queued[pc.name] = queued + 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=pc.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # タイムアウトと同時に枠が割り当てられた場合は受け入れる
+                return
+            future.cancel()
+            raise self._reject(pc) from None
+        except asyncio.CancelledError:
+            # クライアント切断など。割り当て済みの枠は返す
+            if future.done() and not future.cancelled():
+                self.release(pc, None)
+            else:
+                future.cancel()
+            raise
+        finally:
+            self.queued[pc.name] -= 1
+
+    def release(self, pc: PriorityClass, elapsed: Optional[float]) -> None:
+        self.in_flight_total -= 1
+        self.in_flight[pc.name] -= 1
+        if elapsed is not None:
+            previous = self.latency_ewma.get(pc.name)
+            self.latency_ewma[pc.name] = (
+                elapsed if previous is None
+                else previous + LATENCY_EWMA_ALPHA * (elapsed - previous)
+            )
+        self._wake()
+
+    def _wake(self) -> None:
+        """空いた枠を優先度順に待機中のリクエストへ割り当てる"""
+        skipped = []
+        while self._waiters and self.in_flight_total < self.total_concurrency:
+            waiter = heapq.heappop(self._waiters)
+            _, _, future, pc = waiter
+            if future.done():
+                continue
+            if self._can_admit(pc):
+                self._admit(pc)
+                future.set_result(None)
+            else:
+                skipped.append(waiter)
+        for waiter in skipped:
+            heapq.heappush(self._waiters, waiter)
+
+
+class TokenBucketLimiter:
+    """クライアントごとのトークンバケット（古いクライアントはLRUで捨てる）"""
+
+    def __init__(
+        self,
+        capacity: float = RATE_LIMIT_CAPACITY,
+        refill_per_second: float = RATE_LIMIT_REFILL_PER_SECOND,
+        max_clients: int = MAX_TRACKED_CLIENTS,
+    ):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()  # key -> [tokens, updated_at]
+
+    def consume(self, key: str, cost: float) -> float:
+        """
+        トークンを消費する
+
+        Returns:
+            0なら許可、正の値なら再試行までの秒数
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.capacity, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill_per_second)
+            bucket[1] = now
+
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / self.refill_per_second
+
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def parse_trusted_proxies(value: Optional[str]) -> List[Network]:
+    """カンマ区切りのIPアドレス・CIDR（例: "10.0.0.0/8,127.0.0.1"）"""
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in (value or "").split(",") if item.strip()]
+
+
+def _is_trusted(address: str, trusted_proxies: Sequence[Network]) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted_proxies)
+
+
+def _client_ip(scope: Scope, trusted_proxies: Sequence[Network]) -> str:
+    """
+    接続元IP。信頼するプロキシからの接続なら X-Forwarded-For を右から辿り、最初の信頼しないアドレスを使う
+    （左側はクライアントが自由に書けるため、信頼するプロキシが付け足した分だけを見る）
+    """
+    client = scope.get("client")
+    address = client[0] if client else "unknown"
+    if not trusted_proxies or not _is_trusted(address, trusted_proxies):
+        return address
+    forwarded: List[str] = []
+    for name, value in scope.get("headers", ()):
+        if name == b"x-forwarded-for":
+            forwarded += [hop.strip() for hop in value.decode("latin-1").split(",")]
+    for hop in reversed(forwarded):
+        if not hop:
+            continue
+        address = hop
+        if not _is_trusted(hop, trusted_proxies):
+            break
+    return address
+
+
+def _client_key(
+    scope: Scope,
+    secret_key: Optional[str],
+    algorithm: str,
+    trusted_proxies: Sequence[Network] = (),
+) -> str:
+    """
+    検証済みBearerトークンのsub、無ければ接続元IPでクライアントを識別する
+
+    未検証の文字列をキーにすると、リクエストごとに違う偽トークンを付けるだけで制限を回避できるため、
+    署名を検証できたトークンだけをユーザーとして扱う（HS256の検証はリクエストごとに行っても軽い）。
+    """
+    if secret_key:
+        for name, value in scope.get("headers", ()):
+            if name == b"authorization" and value[:7].lower() == b"bearer ":
+                try:
+                    subject = jwt.decode(value[7:].decode("latin-1"), secret_key, algorithms=[algorithm]).get("sub")
+                except JWTError:
+                    break
+                if subject:
+                    return "u:" + str(subject)
+                break
+    return "ip:" + _client_ip(scope, trusted_proxies)
+
+
+def _busy_response(status_code: int, detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        {"detail": detail},
+        status_code=status_code,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class AdmissionMiddleware:
+    """ASGIミドルウェア"""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        secret_key: Optional[str] = None,
+        algorithm: str = "HS256",
+        trusted_proxies: Iterable[Network] = (),
+    ):
+        """
+        Args:
+            secret_key, algorithm: クライアントの識別に使うJWTの検証鍵（未指定なら常にIPで識別する）
+            trusted_proxies: X-Forwarded-For を信頼するリバースプロキシのネットワーク
+        """
+        self.app = app
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+        self.trusted_proxies = list(trusted_proxies)
+        self.controller = AdmissionController()
+        self.limiter = TokenBucketLimiter()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        pc = classify(scope["method"], scope["path"])
+        if pc is None:
+            await self.app(scope, receive, send)
+            return
+
+        if pc.token_cost > 0:
+            retry_after = self.limiter.consume(
+                _client_key(scope, self.secret_key, self.algorithm, self.trusted_proxies), pc.token_cost
+            )
+            if retry_after > 0:
+                await _busy_response(429, "Too many requests", retry_after)(scope, receive, send)
+                return
+
+        try:
+            await self.controller.acquire(pc)
+        except Rejected as e:
+            logger.warning("Shed %s %s (%s)", scope["method"], scope["path"], pc.name)
+            await _busy_response(503, "Server is busy", e.retry_after)(scope, receive, send)
+            return
+
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(pc, time.monotonic() - started)
@@ -0,0 +1,266 @@
+"""
+スポットの一括インポート (NDJSON / CSV)
+
+行をストリーミングで検証し、バッチ単位で複数行INSERTを発行する。
+投稿報酬のコインはバッチ内で投稿者ごとに集約し、1ユーザーにつき1回のUPDATEで付与する。
+"""
+import csv
+import json
+import logging
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+from uuid import UUID
+
+from pydantic import ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+import crud
+import geo
+import models
+import schemas
+import spot_events
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 100
+SUPPORTED_FORMATS = ("ndjson", "csv")
+
+# (行番号, レコード, パースエラー)
+ImportRecord = Tuple[int, Optional[dict], Optional[str]]
+
+
+def detect_format(filename: Optional[str], content_type: Optional[str]) -> str:
+    """ファイル名とContent-Typeから入力形式を推定する（不明な場合はNDJSON）"""
+    name = (filename or "").lower()
+    ctype = (content_type or "").lower()
+    if name.endswith(".csv") or "csv" in ctype:
+        return "csv"
+    return "ndjson"
+
+
+def iter_records(stream: TextIO, fmt: str) -> Iterator[ImportRecord]:
+    """入力ストリームを1行ずつパースする（全体をメモリに載せない）"""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            # 空欄はNone扱いにしてスキーマのデフォルト値を使う
+            yield reader.line_num, {k: v for k, v in record.items() if k and v not in ("", None)}, None
+    elif fmt == "ndjson":
+        for line_no, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_no, None, f"Invalid JSON: {e.msg}"
+                continue
+            if not isinstance(record, dict):
+                yield line_no, None, "Each line must be a JSON object"
+                continue
+            yield line_no, record, None
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+
+def _format_validation_error(error: ValidationError) -> str:
+    """ValidationErrorを1行のメッセージにまとめる"""
+    return "; ".join(
+        f"{'.'.join(str(p) for p in e['loc']) or 'row'}: {e['msg']}" for e in error.errors()
+    )
+
+
+class SpotImporter:
+    """検証済みの行をバッチにまとめてINSERTするインポーター"""
+
+    def __init__(
+        self,
+        db: Session,
+        default_author_id: Optional[UUID] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        reward_coins: bool = True,
+    ):
+        self.db = db
+        self.default_author_id = default_author_id
+        self.batch_size = batch_size
+        self.reward_coins = reward_coins
+
+        # バッチをまたいで使い回すルックアップキャッシュ
+        self._user_skins: Dict[UUID, Optional[UUID]] = {}  # user_id -> current_skin_id
+        self._missing_users: Set[UUID] = set()
+        self._skin_ids: Optional[Set[UUID]] = None
+        self._default_skin_id: Optional[UUID] = None
+
+        self.inserted = 0
+        self.failed = 0
+        self.batches = 0
+        self.coins_awarded = 0
+        self.errors: List[schemas.ImportRowError] = []
+
+    def run(self, records: Iterable[ImportRecord]) -> schemas.SpotImportResponse:
+        """レコードを順に検証し、batch_size件ごとにコミットする"""
+        started = time.perf_counter()
+        batch: List[Tuple[int, schemas.SpotImportRow]] = []
+
+        for line_no, record, error in records:
+            if error is not None:
+                self._fail(line_no, error)
+                continue
+            try:
+                row = schemas.SpotImportRow.model_validate(record)
+            except ValidationError as e:
+                self._fail(line_no, _format_validation_error(e))
+                continue
+
+            batch.append((line_no, row))
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+
+        if batch:
+            self._flush(batch)
+
+        return schemas.SpotImportResponse(
+            inserted=self.inserted,
+            failed=self.failed,
+            batches=self.batches,
+            coins_awarded=self.coins_awarded,
+            elapsed_seconds=round(time.perf_counter() - started, 3),
+            errors=self.errors,
+        )
+
+    def _fail(self, line_no: int, message: str) -> None:
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(schemas.ImportRowError(line=line_no, message=message))
+
+    def _resolve_authors(self, author_ids: Set[UUID]) -> None:
+        """未知の投稿者だけを1クエリでまとめて取得する"""
+        unknown = [a for a in author_ids if a not in self._user_skins and a not in self._missing_users]
+        if not unknown:
+            return
+        rows = self.db.execute(
+            select(models.User.id, models.User.current_skin_id).where(models.User.id.in_(unknown))
+        ).all()
+        for user_id, skin_id in rows:
+            self._user_skins[user_id] = skin_id
+        self._missing_users.update(a for a in unknown if a not in self._user_skins)
+
+    def _known_skin_ids(self) -> Set[UUID]:
+        # スキンは件数が少ないので初回に全件読み込む
+        if self._skin_ids is None:
+            self._skin_ids = set(self.db.scalars(select(models.Skin.id)))
+        return self._skin_ids
+
+    def _get_default_skin_id(self) -> UUID:
+        if self._default_skin_id is None:
+            self._default_skin_id = crud.get_or_create_default_skin(self.db).id
+            self._known_skin_ids().add(self._default_skin_id)
+        return self._default_skin_id
+
+    def _flush(self, batch: List[Tuple[int, schemas.SpotImportRow]]) -> None:
+        """1バッチ分を複数行INSERT + 投稿者ごとの集約UPDATE・コインの記録で1トランザクションに書き込む"""
+        self._resolve_authors({
+            row.author_id or self.default_author_id
+            for _, row in batch
+            if (row.author_id or self.default_author_id) is not None
+        })
+        skin_ids = self._known_skin_ids()
+        now = datetime.now(timezone.utc)
+
+        values = []
+        counts: Counter = Counter()
+        rating_sums: Counter = Counter()
+        for line_no, row in batch:
+            author_id = row.author_id or self.default_author_id
+            if author_id is None:
+                self._fail(line_no, "author_id is required")
+                continue
+            if author_id not in self._user_skins:
+                self._fail(line_no, f"user {author_id} not found")
+                continue
+            if row.skin_id is not None and row.skin_id not in skin_ids:
+                self._fail(line_no, f"skin {row.skin_id} not found")
+                continue
+
+            skin_id = row.skin_id or self._user_skins[author_id] or self._get_default_skin_id()
+            created_at = row.created_at or now
+            values.append({
+                "id": uuid.uuid4(),
+                "author_id": author_id,
+                "skin_id": skin_id,
+                "latitude": row.lat,
+                "longitude": row.lng,
+                "grid_key": geo.grid_key(row.lat, row.lng),
+                "title": row.title,
+                "description": row.description,
+                "image_url": row.image_url,
+                "crowd_level": models.CrowdLevelEnum(row.crowd_level.value),
+                "author_crowd_level": models.CrowdLevelEnum(row.crowd_level.value),
+                "rating": row.rating,
+                "created_at": created_at,
+                "updated_at": now,
+            })
+            counts[author_id] += 1
+            rating_sums[author_id] += row.rating
+
+        if not values:
+            return
+
+        reward = crud.SPOT_POST_REWARD if self.reward_coins else 0
+        try:
+            # insertmanyvalues により複数行のINSERT文にまとめて送信される
+            self.db.execute(insert(models.Spot), values)
+            # 投稿者ごとに投稿の集計をまとめて加算
+            crud.add_spot_stats_many(
+                self.db, [(user_id, count, rating_sums[user_id]) for user_id, count in counts.items()]
+            )
+            # 投稿報酬は投稿者ごとに1件ずつ台帳に追記（残高への反映はバックグラウンドの精算で行う）
+            if reward:
+                self.db.execute(insert(models.CoinLedger), [
+                    {
+                        "id": uuid.uuid4(),
+                        "user_id": user_id,
+                        "delta": count * reward,
+                        "reason": crud.COIN_REASON_SPOT_IMPORT,
+                        "created_at": now,
+                    }
+                    for user_id, count in counts.items()
+                ])
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+        for value in values:
+            fields = {k: v for k, v in value.items() if k not in ("grid_key", "author_crowd_level")}
+            snapshot = spot_events.SpotSnapshot(**{**fields, "crowd_level": value["crowd_level"].value})
+            spot_events.emit(spot_events.SPOT_CREATED, snapshot)
+
+        self.batches += 1
+        self.inserted += len(values)
+        self.coins_awarded += sum(counts.values()) * reward
+        logger.info("Imported batch %d (%d spots, total %d)", self.batches, len(values), self.inserted)
+
+
+def import_spots(
+    db: Session,
+    stream: TextIO,
+    fmt: str,
+    default_author_id: Optional[UUID] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    reward_coins: bool = True,
+) -> schemas.SpotImportResponse:
+    """ストリームからスポットを一括インポートする"""
+    importer = SpotImporter(
+        db,
+        default_author_id=default_author_id,
+        batch_size=batch_size,
+        reward_coins=reward_coins,
+    )
+    return importer.run(iter_records(stream, fmt))
@@ -0,0 +1,156 @@
+"""
+プロセス内キャッシュ
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, Hashable, Iterable, List, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class _Flight:
+    """ロード中のキー1つ分（後続のリクエストはこれを待つ）"""
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+
+class LRUCache(Generic[K, V]):
+    """
+    スレッドセーフなLRUキャッシュ（TTL付き）
+
+    get_or_load_many() は同じキーの同時ミスをまとめ、ロードを1回だけ実行する（single-flight）。
+    ロード中に invalidate() されたキーの結果はキャッシュしない。
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[K, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._flights: Dict[K, _Flight] = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _get_locked(self, key: K) -> Optional[V]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def _set_locked(self, key: K, value: V) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            value = self._get_locked(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key: K, value: V) -> None:
+        with self._lock:
+            self._set_locked(key, value)
+
+    def invalidate(self, key: K) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._generation += 1
+
+    def invalidate_where(self, predicate: Callable[[V], bool]) -> int:
+        """条件に合う値をすべて破棄する（全件走査なので頻繁には呼ばない）"""
+        with self._lock:
+            keys = [k for k, (_, v) in self._data.items() if predicate(v)]
+            for k in keys:
+                del self._data[k]
+            self._generation += 1
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+
+    def get_or_load_many(self, keys: Iterable[K], loader: Callable[[List[K]], Dict[K, V]]) -> Dict[K, V]:
+        """
+        キャッシュにないキーだけをloaderでまとめて取得する
+
+        Args:
+            keys: 取得したいキー
+            loader: キーのリストを受け取り、見つかったものだけを辞書で返す関数
+
+        Returns:
+            見つかったキーと値の辞書
+        """
+        results: Dict[K, V] = {}
+        to_load: Dict[K, _Flight] = {}
+        waiting: Dict[K, _Flight] = {}
+
+        with self._lock:
+            generation = self._generation
+            for key in keys:
+                if key in results or key in to_load or key in waiting:
+                    continue
+                value = self._get_locked(key)
+                if value is not None:
+                    self.hits += 1
+                    results[key] = value
+                elif key in self._flights:
+                    waiting[key] = self._flights[key]
+                else:
+                    self.misses += 1
+                    flight = _Flight()
+                    self._flights[key] = flight
+                    to_load[key] = flight
+
+        if to_load:
+            try:
+                loaded = loader(list(to_load))
+            except BaseException as e:
+                with self._lock:
+                    for key, flight in to_load.items():
+                        flight.error = e
+                        del self._flights[key]
+                        flight.event.set()
+                raise
+
+            with self._lock:
+                cacheable = self._generation == generation
+                for key, flight in to_load.items():
+                    value = loaded.get(key)
+                    flight.value = value
+                    if value is not None:
+                        results[key] = value
+                        if cacheable:
+                            self._set_locked(key, value)
+                    del self._flights[key]
+                    flight.event.set()
+
+        for key, flight in waiting.items():
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.value is not None:
+                results[key] = flight.value
+
+        return results
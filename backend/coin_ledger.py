@@ -0,0 +1,44 @@
+"""
+コイン台帳の精算
+
+付与（投稿報酬など）は coin_ledger に追記するだけで users の行を更新しないため、
+未精算の記録を定期的に users.coins / coins_earned にまとめて反映する。
+残高は精算の前後で変わらない（crud.get_coin_balance は未精算の記録も足して返す）。
+"""
+import logging
+
+from sqlalchemy import select
+
+import crud
+import models
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+SETTLE_INTERVAL_SECONDS = 60
+# 1回の実行で精算するユーザー数の上限
+SETTLE_MAX_USERS = 500
+
+
+def settle_pending() -> int:
+    """未精算の記録があるユーザーを1人ずつ精算する（バックグラウンドタスク用）"""
+    db = SessionLocal()
+    try:
+        ledger = models.CoinLedger
+        user_ids = db.scalars(
+            select(ledger.user_id).where(ledger.settled.is_(False)).distinct().limit(SETTLE_MAX_USERS)
+        ).all()
+        db.rollback()
+
+        settled = 0
+        for user_id in user_ids:
+            try:
+                settled += crud.settle_coins(db, user_id)
+            except Exception:
+                # 購入と競合した場合などは次回に再試行する
+                logger.exception("Failed to settle coins for user %s", user_id)
+        if settled:
+            logger.info("Settled %d coin ledger entries for %d users", settled, len(user_ids))
+        return settled
+    finally:
+        db.close()
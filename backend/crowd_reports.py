@@ -0,0 +1,180 @@
+"""
+混雑度レポートの集計
+
+レポートは crowd_reports に (スポット, 時間バケット) ごとの low/medium/high の件数として溜める。
+refresh() が定期的に直近のバケットを読み、スポットごとの混雑度を時間減衰付きの加重平均で
+NumPyでまとめて計算し、変わったスポットの spots.crowd_level だけを書き換える。
+地図の一覧・詳細は今までどおり crowd_level 列を読むだけなので、読み取りの負荷は増えない。
+
+    スコア = (PRIOR_WEIGHT × 投稿者の値 + Σ 減衰 × レポートの値) / (PRIOR_WEIGHT + Σ 減衰 × 件数)
+    値: low=0, medium=0.5, high=1  減衰: exp(-経過時間 / DECAY_TAU_SECONDS)
+
+レポートが WINDOW_BUCKETS より古くなったスポットは投稿者の値（author_crowd_level）に戻す。
+"""
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List
+from uuid import UUID
+
+from sqlalchemy import delete, select
+
+import cache
+import models
+import spot_events
+from database import SessionLocal
+from startup import lazy_module
+
+np = lazy_module("numpy")
+
+logger = logging.getLogger(__name__)
+
+BUCKET_SECONDS = 15 * 60
+# 集計に使うバケット数（3時間）
+WINDOW_BUCKETS = 12
+# 集計の窓から外れたスポットを投稿者の値に戻すために見るバケット数（24時間。停止中に外れた分もこれで拾う）
+EXPIRED_LOOKBACK_BUCKETS = 96
+# これより古いバケットは削除する（7日）
+RETENTION_BUCKETS = 7 * 96
+DECAY_TAU_SECONDS = 45 * 60
+# 投稿者の値の重み（新しいレポート1件の重みは約1）
+PRIOR_WEIGHT = 0.5
+REFRESH_INTERVAL_SECONDS = 60
+# スポットからこの距離（メートル）以内でないとレポートできない
+REPORT_RADIUS_M = 500
+_LOAD_CHUNK_SIZE = 1000
+
+_LEVEL_VALUES = {"low": 0.0, "medium": 0.5, "high": 1.0}
+
+_reporters: cache.LRUCache = cache.LRUCache(maxsize=100_000, ttl=BUCKET_SECONDS)
+_reporters_lock = threading.Lock()
+
+
+def bucket_of(at: datetime) -> int:
+    return int(at.timestamp()) // BUCKET_SECONDS
+
+
+def claim_report(user_id: UUID, spot_id: UUID) -> bool:
+    """
+    同じユーザーの同じスポットへのレポートを1バケットに1回に制限する
+    （プロセス内の記録なので、別のワーカーに届いた重複までは防がない）
+    """
+    key = (user_id, spot_id, bucket_of(datetime.now(timezone.utc)))
+    with _reporters_lock:
+        if _reporters.get(key) is not None:
+            return False
+        _reporters.set(key, True)
+    return True
+
+
+def _level_of(score: float) -> str:
+    if score < 1 / 3:
+        return "low"
+    if score < 2 / 3:
+        return "medium"
+    return "high"
+
+
+def compute_levels(
+    spot_index: "np.ndarray",
+    buckets: "np.ndarray",
+    counts: "np.ndarray",
+    priors: "np.ndarray",
+    now: datetime,
+) -> List[str]:
+    """
+    スポットごとの混雑度をまとめて計算する
+
+    Args:
+        spot_index: 各行のスポットの番号 (rows,)
+        buckets: 各行のバケット (rows,)
+        counts: 各行の low/medium/high の件数 (rows, 3)
+        priors: スポットごとの投稿者の値 0〜1 (spots,)
+    """
+    # バケットの中央からの経過時間で減衰させる
+    age = now.timestamp() - (buckets.astype(np.float64) + 0.5) * BUCKET_SECONDS
+    decay = np.exp(-np.maximum(age, 0.0) / DECAY_TAU_SECONDS)
+    values = counts @ np.array([_LEVEL_VALUES["low"], _LEVEL_VALUES["medium"], _LEVEL_VALUES["high"]])
+    weighted_sum = np.bincount(spot_index, weights=decay * values, minlength=len(priors))
+    weight = np.bincount(spot_index, weights=decay * counts.sum(axis=1), minlength=len(priors))
+    scores = (PRIOR_WEIGHT * priors + weighted_sum) / (PRIOR_WEIGHT + weight)
+    return [_level_of(score) for score in scores.tolist()]
+
+
+def refresh() -> int:
+    """
+    直近のレポートから混雑度を計算し直し、変わったスポットだけを更新する（バックグラウンドタスク用）
+
+    Returns:
+        crowd_level を更新したスポット数
+    """
+    now = datetime.now(timezone.utc)
+    current = bucket_of(now)
+    window_start = current - WINDOW_BUCKETS + 1
+    reports = models.CrowdReport
+    spot = models.Spot
+
+    db = SessionLocal()
+    try:
+        db.execute(delete(reports).where(reports.bucket < current - RETENTION_BUCKETS))
+        db.commit()
+
+        rows = db.execute(
+            select(reports.spot_id, reports.bucket, reports.low, reports.medium, reports.high)
+            .where(reports.bucket >= window_start - EXPIRED_LOOKBACK_BUCKETS)
+        ).all()
+        if not rows:
+            return 0
+
+        recent = [row for row in rows if row.bucket >= window_start]
+        active: Dict = {}
+        for row in recent:
+            active.setdefault(row.spot_id, len(active))
+        expired = {row.spot_id for row in rows} - active.keys()
+
+        spots = {}
+        candidate_ids = list(active) + list(expired)
+        for start in range(0, len(candidate_ids), _LOAD_CHUNK_SIZE):
+            chunk = candidate_ids[start:start + _LOAD_CHUNK_SIZE]
+            spots.update({s.id: s for s in db.query(spot).filter(spot.id.in_(chunk))})
+
+        targets: Dict = {}
+        if active:
+            priors = np.array([
+                _LEVEL_VALUES[spots[spot_id].author_crowd_level.value] if spot_id in spots else 0.5
+                for spot_id in active
+            ])
+            levels = compute_levels(
+                np.array([active[row.spot_id] for row in recent], dtype=np.int64),
+                np.array([row.bucket for row in recent], dtype=np.int64),
+                np.array([(row.low, row.medium, row.high) for row in recent], dtype=np.float64),
+                priors,
+                now,
+            )
+            targets.update(zip(active, levels))
+        for spot_id in expired:
+            if spot_id in spots:
+                targets[spot_id] = spots[spot_id].author_crowd_level.value
+
+        changed = []
+        for spot_id, level in targets.items():
+            db_spot = spots.get(spot_id)
+            if db_spot is not None and db_spot.crowd_level.value != level:
+                db_spot.crowd_level = models.CrowdLevelEnum(level)
+                changed.append(db_spot)
+        if not changed:
+            return 0
+        db.flush()
+        # コミットで属性が期限切れになる前にスナップショットを取る
+        snapshots = [spot_events.SpotSnapshot.from_model(db_spot) for db_spot in changed]
+        db.commit()
+
+        for snapshot in snapshots:
+            spot_events.emit(spot_events.SPOT_UPDATED, snapshot)
+        logger.info("Updated crowd level of %d spots from %d reports", len(changed), len(recent))
+        return len(changed)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
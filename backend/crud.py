@@ -1,14 +1,53 @@
-from sqlalchemy.orm import Session, selectinload
-from sqlalchemy import and_
-from typing import Optional, List
+from sqlalchemy.orm import Session, selectinload, joinedload, load_only
+from sqlalchemy import and_, case, func, select, tuple_, update
+from typing import NamedTuple, Optional, List, Tuple
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 import models
 import schemas
+import spot_events
+import geo
+import crowd_reports
+import search_index
+from database import upsert_add
 from uuid import UUID
-from passlib.context import CryptContext
 from enum import Enum
+from pathlib import Path
+import logging
+import threading
+import time
+from r2_storage import get_r2_storage
+from startup import lazy_module
 
-# パスワードハッシュ化
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+logger = logging.getLogger(__name__)
+
+# パスワードハッシュ化（passlibの読み込みは最初に使うときまで遅らせる）
+passlib_context = lazy_module("passlib.context")
+_pwd_context = None
+_pwd_context_lock = threading.Lock()
+
+
+def get_pwd_context():
+    global _pwd_context
+    if _pwd_context is None:
+        with _pwd_context_lock:
+            if _pwd_context is None:
+                _pwd_context = passlib_context.CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _pwd_context
+
+
+def warm_up_password_hasher() -> None:
+    """bcryptのバックエンドを読み込んでおく（最初のログインで読み込まずに済むように）"""
+    get_pwd_context().handler("bcrypt").get_backend()
+
+
+# 投稿報酬として付与するコイン数
+SPOT_POST_REWARD = 10
+# チェックインの報酬と、同じスポットに再びチェックインできるまでの時間
+CHECKIN_REWARD = 5
+CHECKIN_COOLDOWN = timedelta(hours=24)
+# スポットからこの距離（メートル）以内でないとチェックインできない
+CHECKIN_RADIUS_M = 200
 
 
 # ===== Purchase Result =====
@@ -28,13 +67,21 @@ def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
 
 
 def get_user_by_id(db: Session, user_id: UUID) -> Optional[models.User]:
-    """IDでユーザーを取得"""
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    """
+    IDでユーザーを取得
+    同じセッション（リクエスト）で読み込み済みならSQLを発行せずにそれを返す
+    """
+    return db.get(models.User, user_id)
+
+
+def get_user_with_skin(db: Session, user_id: UUID) -> Optional[models.User]:
+    """IDでユーザーを現在のスキンと一緒に取得（認証時に1回だけ読み込むため）"""
+    return db.get(models.User, user_id, options=[joinedload(models.User.current_skin)])
 
 
 def create_user(db: Session, user: schemas.UserCreate) -> models.User:
     """新規ユーザーを作成"""
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = get_pwd_context().hash(user.password)
     
     # デフォルトスキンを取得または作成
     default_skin = get_or_create_default_skin(db)
@@ -66,47 +113,175 @@ def create_user(db: Session, user: schemas.UserCreate) -> models.User:
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """パスワードを検証"""
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
+
+
+# ===== Coins =====
+# coin_ledger.reason
+COIN_REASON_SPOT_POST = "spot_post"
+COIN_REASON_SPOT_IMPORT = "spot_import"
+COIN_REASON_SKIN_PURCHASE = "skin_purchase"
+COIN_REASON_OPENING_BALANCE = "opening_balance"
+COIN_REASON_CHECKIN = "checkin"
 
 
-def update_user_coins(db: Session, user_id: UUID, coin_delta: int) -> models.User:
+class CoinBalance(NamedTuple):
+    """現在の残高と、これまでに獲得したコインの合計"""
+    coins: int
+    coins_earned: int
+
+
+def credit_coins(
+    db: Session, user_id: UUID, amount: int, reason: str, ref_id: Optional[UUID] = None
+) -> models.CoinLedger:
+    """
+    コインを付与する
+    coin_ledger に追記するだけで users の行は更新しないので、同じユーザーへの付与が重なっても待ち合わない
     """
-    ユーザーのコインを更新
+    if amount <= 0:
+        raise ValueError("amount must be positive")
+    entry = models.CoinLedger(user_id=user_id, delta=amount, reason=reason, ref_id=ref_id)
+    db.add(entry)
+    # 呼び出し元でコミットを管理するため、ここではコミットしない
+    return entry
+
+
+def get_coin_balance(db: Session, user_id: UUID) -> Optional[CoinBalance]:
+    """精算済みの残高（users.coins）に未精算の記録を足した現在の残高（ユーザーが居なければNone）"""
+    ledger = models.CoinLedger
+    unsettled = and_(ledger.user_id == models.User.id, ledger.settled.is_(False))
+    delta_sum = select(func.coalesce(func.sum(ledger.delta), 0)).where(unsettled).scalar_subquery()
+    earned_sum = select(
+        func.coalesce(func.sum(case((ledger.delta > 0, ledger.delta), else_=0)), 0)
+    ).where(unsettled).scalar_subquery()
+    # 精算と行き違わないよう、users と未精算の記録を1つの文で読む
+    row = db.execute(
+        select(models.User.coins + delta_sum, models.User.coins_earned + earned_sum)
+        .where(models.User.id == user_id)
+    ).first()
+    return CoinBalance(*row) if row else None
+
+
+def get_coin_history(
+    db: Session,
+    user_id: UUID,
+    limit: int = 20,
+    before: Optional[Tuple[datetime, UUID]] = None,
+) -> List[models.CoinLedger]:
     """
-    user = get_user_by_id(db, user_id)
-    if not user:
-        raise ValueError(f"user {user_id} not found")
+    コインの増減を新しい順に取得（キーセットページング）
 
-    new_balance = user.coins + coin_delta
-    if new_balance < 0:
-        raise ValueError("coin balance must not be negative")
+    Args:
+        before: 前のページの最後の (created_at, id)。これより古いものを返す
+    """
+    ledger = models.CoinLedger
+    query = db.query(ledger).filter(ledger.user_id == user_id)
+    if before is not None:
+        query = query.filter(tuple_(ledger.created_at, ledger.id) < tuple_(*before))
+    return query.order_by(ledger.created_at.desc(), ledger.id.desc()).limit(limit).all()
 
-    user.coins = new_balance
-    # 呼び出し元でコミットを管理するため、ここではコミットしない
-    db.flush()
-    return user
+
+def settle_coins(db: Session, user_id: UUID) -> int:
+    """
+    ユーザーの未精算の記録を users.coins / coins_earned にまとめて反映し、精算済みにする
+
+    Returns:
+        精算した記録の件数
+    """
+    ledger = models.CoinLedger
+    try:
+        # 購入と同じくusersの行をロックし、残高の確認と精算を直列化する
+        user = db.get(models.User, user_id, with_for_update=True)
+        entries = db.execute(
+            select(ledger.id, ledger.delta).where(ledger.user_id == user_id, ledger.settled.is_(False))
+        ).all() if user is not None else []
+        if not entries:
+            db.rollback()
+            return 0
+
+        user.coins += sum(delta for _, delta in entries)
+        user.coins_earned += sum(delta for _, delta in entries if delta > 0)
+        # 読み取った後に追記された記録は次回に回す
+        db.execute(
+            update(ledger)
+            .where(ledger.id.in_([entry_id for entry_id, _ in entries]))
+            .values(settled=True)
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(entries)
+
+
+def check_in(db: Session, user_id: UUID, spot: models.Spot) -> bool:
+    """
+    スポットへのチェックインの報酬を付与する
+    同じスポットへのチェックインはCHECKIN_COOLDOWNに1回まで（同時に来ても二重に付与しないようusersの行をロックする）
+
+    Returns:
+        付与した場合True、クールダウン中の場合False
+    """
+    ledger = models.CoinLedger
+    try:
+        db.execute(select(models.User.id).where(models.User.id == user_id).with_for_update())
+        since = datetime.now(timezone.utc) - CHECKIN_COOLDOWN
+        recent = db.execute(
+            select(ledger.id).where(
+                ledger.user_id == user_id,
+                ledger.created_at >= since,
+                ledger.reason == COIN_REASON_CHECKIN,
+                ledger.ref_id == spot.id,
+            ).limit(1)
+        ).first()
+        if recent is not None:
+            db.rollback()
+            return False
+        credit_coins(db, user_id, CHECKIN_REWARD, COIN_REASON_CHECKIN, ref_id=spot.id)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return True
+
+
+# ===== Storage =====
+# デフォルト画像など削除してはいけないオブジェクトのプレフィックス
+PROTECTED_STORAGE_PREFIXES = ("defaults/",)
+
+
+def enqueue_storage_deletion(db: Session, file_url: Optional[str], reason: str) -> None:
+    """
+    参照されなくなった画像を削除キューに積む
+    呼び出し元のトランザクションでコミットされるため、ここではコミットしない
+    """
+    if not file_url or any(f"/{prefix}" in file_url for prefix in PROTECTED_STORAGE_PREFIXES):
+        return
+    db.add(models.StorageDeletion(file_url=file_url, reason=reason))
 
 
 # ===== Default Assets =====
+# 取得できたURLはプロセス内で使い回す（signupのたびにR2へHEADしない）
+_default_user_icon_url: Optional[str] = None
+
+
 def get_default_user_icon_url() -> Optional[str]:
     """デフォルトユーザーアイコンのURLを取得（R2にアップロード、既存の場合は再利用）"""
-    from r2_storage import get_r2_storage
-    from pathlib import Path
-    import logging
-    
-    logger = logging.getLogger(__name__)
-    
+    global _default_user_icon_url
+    if _default_user_icon_url is not None:
+        return _default_user_icon_url
     try:
         r2 = get_r2_storage()
         static_dir = Path(__file__).parent / "static"
         default_icon_path = static_dir / "default_user_icon.png"
         
         # R2にアップロード（既に存在する場合はスキップ）
-        return r2.upload_static_file(
+        _default_user_icon_url = r2.upload_static_file(
             file_path=default_icon_path,
             object_key="defaults/default_user_icon.png",
             content_type="image/png"
         )
+        return _default_user_icon_url
     except Exception:
         # R2アップロードに失敗した場合、ログを記録してNoneを返す
         logger.exception("Failed to upload default user icon to R2")
@@ -116,12 +291,6 @@ def get_default_user_icon_url() -> Optional[str]:
 # ===== Skin CRUD =====
 def get_or_create_default_skin(db: Session) -> models.Skin:
     """デフォルトスキンを取得または作成"""
-    from r2_storage import get_r2_storage
-    from pathlib import Path
-    import logging
-    
-    logger = logging.getLogger(__name__)
-    
     default_skin = db.query(models.Skin).filter(models.Skin.name == "Default Pin").first()
     if not default_skin:
         # デフォルトスキン画像をR2にアップロード（既に存在する場合はスキップ）
@@ -172,35 +341,172 @@ def user_owns_skin(db: Session, user_id: UUID, skin_id: UUID) -> bool:
 
 
 def purchase_skin(db: Session, user_id: UUID, skin_id: UUID) -> PurchaseResult:
-    """スキンを購入"""
-    user = get_user_by_id(db, user_id)
-    if not user:
-        return PurchaseResult.USER_NOT_FOUND
-    
+    """
+    スキンを購入
+    usersの行をロックしてから残高を確認し、引き落としの記録と所有スキンを同じトランザクションで追加する
+    （同じユーザーの購入が同時に来ても残高がマイナスにならない）
+    成功した場合のコミットは呼び出し元（Idempotency-Keyのレスポンスと同じトランザクションでコミットするため）
+    """
     skin = get_skin_by_id(db, skin_id)
     if not skin:
         return PurchaseResult.SKIN_NOT_FOUND
-    
+
+    locked = db.execute(
+        select(models.User.id).where(models.User.id == user_id).with_for_update()
+    ).first()
+    if locked is None:
+        db.rollback()
+        return PurchaseResult.USER_NOT_FOUND
+
     # すでに所有している場合
     if user_owns_skin(db, user_id, skin_id):
+        db.rollback()
         return PurchaseResult.ALREADY_OWNED
-    
+
     # コインが足りない場合
-    if user.coins < skin.price:
+    if get_coin_balance(db, user_id).coins < skin.price:
+        db.rollback()
         return PurchaseResult.INSUFFICIENT_COINS
-    
-    # コインを減らす
-    user.coins -= skin.price
-    
-    # 所有スキンに追加
-    user_skin = models.UserSkin(user_id=user_id, skin_id=skin_id)
-    db.add(user_skin)
-    db.commit()
-    
+
+    db.add(models.CoinLedger(
+        user_id=user_id, delta=-skin.price, reason=COIN_REASON_SKIN_PURCHASE, ref_id=skin_id
+    ))
+    db.add(models.UserSkin(user_id=user_id, skin_id=skin_id))
+    db.flush()
     return PurchaseResult.SUCCESS
 
 
+# ===== Crowd Reports =====
+def record_crowd_report(db: Session, spot_id: UUID, crowd_level: str, at: Optional[datetime] = None) -> None:
+    """
+    混雑度レポートを現在の時間バケットの件数に加算する
+    呼び出し元でコミットを管理するため、ここではコミットしない
+    """
+    level = models.CrowdLevelEnum(crowd_level).value
+    db.execute(
+        upsert_add(db.get_bind().dialect.name, models.CrowdReport.__table__, ["spot_id", "bucket"], [level]),
+        {
+            "spot_id": spot_id,
+            "bucket": crowd_reports.bucket_of(at or datetime.now(timezone.utc)),
+            "low": 0, "medium": 0, "high": 0,
+            level: 1,
+        },
+    )
+
+
+def add_crowd_report(db: Session, spot_id: UUID, crowd_level: str) -> None:
+    """混雑度レポートを記録する（表示される混雑度にはバックグラウンドの集計で反映される）"""
+    try:
+        record_crowd_report(db, spot_id, crowd_level)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+# ===== Spot Stats =====
+class SpotStats(NamedTuple):
+    spot_count: int
+    spot_rating_sum: int
+
+
+def _spot_stats_upsert(db: Session):
+    table = models.UserSpotStats.__table__
+    return upsert_add(db.get_bind().dialect.name, table, ["user_id"], ["spot_count", "spot_rating_sum"])
+
+
+def add_spot_stats(db: Session, user_id: UUID, count_delta: int, rating_delta: int) -> None:
+    """
+    投稿の集計に加算する（コミットは呼び出し元）
+    読んで書き戻さずにDB上で加算するので、同じユーザーの投稿が同時に来ても更新が失われない
+    """
+    db.execute(
+        _spot_stats_upsert(db),
+        {"user_id": user_id, "spot_count": count_delta, "spot_rating_sum": rating_delta},
+    )
+
+
+def add_spot_stats_many(db: Session, deltas: List[Tuple[UUID, int, int]]) -> None:
+    """複数ユーザーの投稿の集計に (user_id, 投稿数の増分, 評価の合計の増分) を1回のexecutemanyで加算する"""
+    db.execute(_spot_stats_upsert(db), [
+        {"user_id": user_id, "spot_count": count_delta, "spot_rating_sum": rating_delta}
+        for user_id, count_delta, rating_delta in deltas
+    ])
+
+
+def get_spot_stats(db: Session, user_id: UUID) -> SpotStats:
+    """ユーザーの投稿の集計（まだ投稿が無ければ0）"""
+    row = db.execute(
+        select(models.UserSpotStats.spot_count, models.UserSpotStats.spot_rating_sum)
+        .where(models.UserSpotStats.user_id == user_id)
+    ).first()
+    return SpotStats(*row) if row else SpotStats(0, 0)
+
+
+def find_spot_stats_drift(db: Session, limit: int = 500) -> List[Tuple[UUID, SpotStats, SpotStats]]:
+    """
+    user_spot_stats と spots から数え直した値が食い違うユーザーを探す
+
+    Returns:
+        (user_id, 記録されている集計, 数え直した集計) のリスト
+    """
+    stats = models.UserSpotStats
+    actual = (
+        select(
+            models.Spot.author_id.label("user_id"),
+            func.count().label("spot_count"),
+            func.sum(models.Spot.rating).label("spot_rating_sum"),
+        )
+        .group_by(models.Spot.author_id)
+        .subquery()
+    )
+    recorded_count = func.coalesce(stats.spot_count, 0)
+    recorded_sum = func.coalesce(stats.spot_rating_sum, 0)
+    actual_count = func.coalesce(actual.c.spot_count, 0)
+    actual_sum = func.coalesce(actual.c.spot_rating_sum, 0)
+    rows = db.execute(
+        select(models.User.id, recorded_count, recorded_sum, actual_count, actual_sum)
+        .outerjoin(stats, stats.user_id == models.User.id)
+        .outerjoin(actual, actual.c.user_id == models.User.id)
+        .where((recorded_count != actual_count) | (recorded_sum != actual_sum))
+        .limit(limit)
+    ).all()
+    return [
+        (user_id, SpotStats(rec_count, rec_sum), SpotStats(act_count, act_sum))
+        for user_id, rec_count, rec_sum, act_count, act_sum in rows
+    ]
+
+
+def reconcile_spot_stats(db: Session, user_id: UUID) -> None:
+    """
+    ユーザーの投稿の集計を spots から数え直した値に置き換える
+    数え直しと書き込みを1つの文で行うので、その間に投稿が増えても古い値で上書きしない
+    """
+    try:
+        # 行が無ければ作ってから置き換える
+        add_spot_stats(db, user_id, 0, 0)
+        spots = models.Spot
+        db.execute(
+            update(models.UserSpotStats)
+            .where(models.UserSpotStats.user_id == user_id)
+            .values(
+                spot_count=select(func.count()).where(spots.author_id == user_id).scalar_subquery(),
+                spot_rating_sum=select(func.coalesce(func.sum(spots.rating), 0))
+                .where(spots.author_id == user_id)
+                .scalar_subquery(),
+            )
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
 # ===== Spot CRUD =====
+# 位置で絞り込むときにグリッドキーで引くセルの最大リング数（これより広い半径は緯度経度の範囲だけで絞る）
+SPOT_GRID_MAX_RING = 8
+
+
 def get_spots(
     db: Session,
     lat: Optional[float] = None,
@@ -208,16 +514,35 @@ def get_spots(
     radius: Optional[float] = None,
     limit: int = 100
 ) -> List[models.Spot]:
-    """スポット一覧を取得（将来的に位置情報フィルタリング実装可能）"""
+    """
+    スポット一覧を新着順に取得（lat, lng, radius[m] を指定すると周辺に絞り込む）
+    一覧用のインデックスにSTORINGした列だけを読み込む（descriptionなどは未ロード）
+    """
     query = db.query(models.Spot).options(
+        load_only(
+            models.Spot.id,
+            models.Spot.created_at,
+            *(getattr(models.Spot, column) for column in models.SPOT_LIST_COLUMNS),
+        ),
         selectinload(models.Spot.author),
         selectinload(models.Spot.skin)
-    ).order_by(models.Spot.created_at.desc())
-    
-    # 位置情報パラメータは将来のフィルタ用に予約
-    _ = (lat, lng, radius)
-    
-    return query.limit(limit).all()
+    )
+
+    near = lat is not None and lng is not None and radius is not None
+    if near:
+        cells = geo.grid_keys_near(lat, lng, radius, SPOT_GRID_MAX_RING)
+        if cells is not None:
+            query = query.filter(models.Spot.grid_key.in_(cells))
+        min_lat, min_lng, max_lat, max_lng = geo.bbox_around(lat, lng, radius)
+        query = query.filter(models.Spot.latitude.between(min_lat, max_lat))
+        if min_lng >= -180 and max_lng <= 180:
+            query = query.filter(models.Spot.longitude.between(min_lng, max_lng))
+
+    spots = query.order_by(models.Spot.created_at.desc()).limit(limit).all()
+    if near:
+        # 矩形で絞った結果を円に絞る
+        spots = [s for s in spots if geo.haversine_m(lat, lng, s.latitude, s.longitude) <= radius]
+    return spots
 
 
 def get_spot_by_id(db: Session, spot_id: UUID) -> Optional[models.Spot]:
@@ -228,89 +553,239 @@ def get_spot_by_id(db: Session, spot_id: UUID) -> Optional[models.Spot]:
     ).filter(models.Spot.id == spot_id).first()
 
 
-def create_spot(db: Session, spot: schemas.SpotCreate, user_id: UUID, image_url: Optional[str] = None) -> models.Spot:
-    """新規スポットを作成"""
-    user = get_user_by_id(db, user_id)
-    if user is None:
-        raise ValueError(f"user {user_id} not found")
+def get_spots_by_ids(db: Session, spot_ids: List[UUID]) -> List[models.Spot]:
+    """複数IDのスポットを1回のINクエリで取得（順序は保証しない）"""
+    if not spot_ids:
+        return []
+    return db.query(models.Spot).options(
+        selectinload(models.Spot.author),
+        selectinload(models.Spot.skin)
+    ).filter(models.Spot.id.in_(spot_ids)).all()
+
+
+def get_spots_by_author(
+    db: Session,
+    author_id: UUID,
+    limit: int = 20,
+    before: Optional[Tuple[datetime, UUID]] = None,
+) -> List[models.Spot]:
+    """
+    ユーザーの投稿を新しい順に取得（キーセットページング）
+
+    Args:
+        before: 前のページの最後の (created_at, id)。これより古いものを返す
+    """
+    query = db.query(models.Spot).options(
+        selectinload(models.Spot.author),
+        selectinload(models.Spot.skin)
+    ).filter(models.Spot.author_id == author_id)
+    if before is not None:
+        query = query.filter(tuple_(models.Spot.created_at, models.Spot.id) < tuple_(*before))
+    return query.order_by(models.Spot.created_at.desc(), models.Spot.id.desc()).limit(limit).all()
+
+
+# ===== Duplicate Detection =====
+# 同じ場所の投稿とみなす距離とタイトルの類似度
+DUPLICATE_RADIUS_M = 30
+DUPLICATE_TITLE_SIMILARITY = 0.6
+# 比較する近くのスポットの上限（新しい順）と、比較にかける時間の上限
+DUPLICATE_SCAN_LIMIT = 200
+DUPLICATE_CHECK_BUDGET_SECONDS = 0.02
+DUPLICATE_MAX_CANDIDATES = 5
+
+
+class DuplicateCandidate(NamedTuple):
+    """重複の可能性があるスポット"""
+    spot_id: UUID
+    title: str
+    distance_m: float
+    similarity: float
+
+
+class DuplicateSpotError(ValueError):
+    """近くに同じようなタイトルのスポットが既にある"""
+
+    def __init__(self, candidates: List[DuplicateCandidate]):
+        super().__init__("similar spots already exist nearby")
+        self.candidates = candidates
+
+
+def _title_bigrams(title: str) -> Counter:
+    text = "".join(search_index.normalize(title).split())
+    if len(text) < 2:
+        return Counter([text])
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
 
+def title_similarity(a: str, b: str) -> float:
+    """タイトルの文字bigramのDice係数（0〜1。全角半角・大文字小文字・空白の違いは無視）"""
+    grams_a, grams_b = _title_bigrams(a), _title_bigrams(b)
+    total = sum(grams_a.values()) + sum(grams_b.values())
+    if total == 0:
+        return 0.0
+    return 2 * sum((grams_a & grams_b).values()) / total
+
+
+def find_duplicate_spots(db: Session, lat: float, lng: float, title: str) -> List[DuplicateCandidate]:
+    """
+    DUPLICATE_RADIUS_M以内でタイトルが似ているスポットを返す（類似度の高い順）
+
+    周辺のグリッドセルと緯度経度の範囲で (grid_key, created_at) インデックスから新しい順に
+    DUPLICATE_SCAN_LIMIT件だけ読み、比較がDUPLICATE_CHECK_BUDGET_SECONDSを超えたら打ち切る。
+    """
+    spot = models.Spot
+    stmt = select(spot.id, spot.title, spot.latitude, spot.longitude)
+    # 極付近はタイルが細く隣のセルで覆えないため、緯度経度の範囲だけで絞る
+    cells = geo.grid_keys_near(lat, lng, DUPLICATE_RADIUS_M, max_ring=1)
+    if cells is not None:
+        stmt = stmt.where(spot.grid_key.in_(cells))
+    min_lat, min_lng, max_lat, max_lng = geo.bbox_around(lat, lng, DUPLICATE_RADIUS_M)
+    stmt = stmt.where(spot.latitude.between(min_lat, max_lat))
+    if min_lng >= -180 and max_lng <= 180:
+        stmt = stmt.where(spot.longitude.between(min_lng, max_lng))
+    rows = db.execute(stmt.order_by(spot.created_at.desc()).limit(DUPLICATE_SCAN_LIMIT)).all()
+
+    deadline = time.perf_counter() + DUPLICATE_CHECK_BUDGET_SECONDS
+    candidates = []
+    for i, row in enumerate(rows):
+        if time.perf_counter() > deadline:
+            logger.warning("Duplicate check stopped after %d of %d nearby spots", i, len(rows))
+            break
+        distance = geo.haversine_m(lat, lng, row.latitude, row.longitude)
+        if distance > DUPLICATE_RADIUS_M:
+            continue
+        similarity = title_similarity(title, row.title)
+        if similarity >= DUPLICATE_TITLE_SIMILARITY:
+            candidates.append(DuplicateCandidate(row.id, row.title, round(distance, 1), round(similarity, 2)))
+    candidates.sort(key=lambda c: (-c.similarity, c.distance_m))
+    return candidates[:DUPLICATE_MAX_CANDIDATES]
+
+
+def ensure_not_duplicate(db: Session, spot: schemas.SpotCreate) -> None:
+    """重複の可能性があればDuplicateSpotErrorを投げる（allow_duplicateが指定されていれば確認しない）"""
+    if spot.allow_duplicate:
+        return
+    candidates = find_duplicate_spots(db, spot.lat, spot.lng, spot.title)
+    if candidates:
+        raise DuplicateSpotError(candidates)
+
+
+def add_spot(
+    db: Session,
+    user: models.User,
+    spot: schemas.SpotCreate,
+    image_url: Optional[str],
+    spot_id: Optional[UUID] = None,
+) -> models.Spot:
+    """スポットを追加し、投稿報酬と投稿の集計を反映する（flushまで。コミットは呼び出し元）"""
     # ユーザーの現在のスキンを使用
     skin_id = user.current_skin_id or get_or_create_default_skin(db).id
 
+    crowd_level = spot.crowd_level if spot.crowd_level else models.CrowdLevelEnum.MEDIUM
     db_spot = models.Spot(
-        author_id=user_id,
+        author_id=user.id,
         skin_id=skin_id,
         latitude=spot.lat,
         longitude=spot.lng,
+        grid_key=geo.grid_key(spot.lat, spot.lng),
         title=spot.title,
         description=spot.description,
         image_url=image_url,  # R2からのURLまたはNone
-        crowd_level=spot.crowd_level if spot.crowd_level else models.CrowdLevelEnum.MEDIUM,
+        crowd_level=crowd_level,
+        author_crowd_level=crowd_level,
         rating=spot.rating if spot.rating is not None else 3,
     )
+    if spot_id is not None:
+        db_spot.id = spot_id
 
-    try:
-        db.add(db_spot)
-        db.flush()  # IDを取得するためflushを実行
-        
-        # 投稿報酬としてコインを付与（同一トランザクション内）
-        update_user_coins(db, user_id, 10)
-        
-        # 両方成功した場合のみコミット
-        db.commit()
-        db.refresh(db_spot)
-    except Exception:
-        db.rollback()
-        raise
+    db.add(db_spot)
+    db.flush()  # IDを取得するためflushを実行
 
+    # 投稿報酬としてコインを付与し、投稿の集計を更新（同一トランザクション内）
+    credit_coins(db, user.id, SPOT_POST_REWARD, COIN_REASON_SPOT_POST, ref_id=db_spot.id)
+    add_spot_stats(db, user.id, 1, db_spot.rating)
     return db_spot
 
 
-def update_spot(
-    db: Session,
-    spot_id: UUID,
-    user_id: UUID,
-    spot_update: schemas.SpotUpdate,
-    image_url: Optional[str] = None,
-) -> models.Spot:
-    """スポットを更新(作成者のみ許可)"""
+def get_own_spot(db: Session, spot_id: UUID, user_id: UUID) -> models.Spot:
+    """作成者本人のスポットを取得（無ければValueError、他人のものならPermissionError）"""
     db_spot = get_spot_by_id(db, spot_id)
     if db_spot is None:
         raise ValueError(f"Spot {spot_id} not found")
     if db_spot.author_id != user_id:
-        raise PermissionError(f"User {user_id} does not have permission to update spot {spot_id}")
+        raise PermissionError(f"User {user_id} does not have permission to modify spot {spot_id}")
+    return db_spot
 
+
+def apply_spot_update(
+    db: Session,
+    db_spot: models.Spot,
+    spot_update: schemas.SpotUpdate,
+    image_url: Optional[str],
+) -> None:
+    """更新内容をスポットに反映する（コミットは呼び出し元）"""
     if spot_update.lat is not None:
         db_spot.latitude = spot_update.lat
     if spot_update.lng is not None:
         db_spot.longitude = spot_update.lng
+    db_spot.grid_key = geo.grid_key(db_spot.latitude, db_spot.longitude)
     if spot_update.title is not None:
         db_spot.title = spot_update.title
     if spot_update.description is not None:
         db_spot.description = spot_update.description
     if spot_update.crowd_level is not None:
         db_spot.crowd_level = spot_update.crowd_level
+        db_spot.author_crowd_level = spot_update.crowd_level
+        # 投稿者による更新も最新のレポートとして数え、次の集計で古いレポートに戻されないようにする
+        record_crowd_report(db, db_spot.id, spot_update.crowd_level.value)
     if spot_update.rating is not None:
+        add_spot_stats(db, db_spot.author_id, 0, spot_update.rating - db_spot.rating)
         db_spot.rating = spot_update.rating
-    if image_url is not None:
+    if image_url is not None and image_url != db_spot.image_url:
+        # 差し替えられた古い画像は削除キューへ（同一トランザクション）
+        enqueue_storage_deletion(db, db_spot.image_url, "spot_image_replaced")
         db_spot.image_url = image_url
 
+
+def update_spot(
+    db: Session,
+    spot_id: UUID,
+    user_id: UUID,
+    spot_update: schemas.SpotUpdate,
+    image_url: Optional[str] = None,
+) -> models.Spot:
+    """スポットを更新(作成者のみ許可)"""
+    db_spot = get_own_spot(db, spot_id, user_id)
+    previous_location = (db_spot.latitude, db_spot.longitude)
+    apply_spot_update(db, db_spot, spot_update, image_url)
+
     try:
         db.commit()
         db.refresh(db_spot)
     except Exception:
         db.rollback()
         raise
+
+    spot_events.emit(spot_events.SPOT_UPDATED, spot_events.SpotSnapshot.from_model(db_spot, previous_location))
     return db_spot
 
 
+def remove_spot(db: Session, db_spot: models.Spot) -> spot_events.SpotSnapshot:
+    """スポットを削除し、削除前の値を返す（コミットは呼び出し元）"""
+    snapshot = spot_events.SpotSnapshot.from_model(db_spot)
+    enqueue_storage_deletion(db, db_spot.image_url, "spot_deleted")
+    add_spot_stats(db, db_spot.author_id, -1, -db_spot.rating)
+    # spots を参照する行を先に消す（外部キーに ON DELETE が無いため）
+    db.query(models.SpotCounter).filter(models.SpotCounter.spot_id == db_spot.id).delete(synchronize_session=False)
+    db.query(models.CrowdReport).filter(models.CrowdReport.spot_id == db_spot.id).delete(synchronize_session=False)
+    db.delete(db_spot)
+    return snapshot
+
+
 def delete_spot(db: Session, spot_id: UUID, user_id: UUID) -> None:
     """スポットを削除(作成者のみ許可)"""
-    db_spot = get_spot_by_id(db, spot_id)
-    if db_spot is None:
-        raise ValueError(f"Spot {spot_id} not found")
-    if db_spot.author_id != user_id:
-        raise PermissionError(f"User {user_id} does not have permission to delete spot {spot_id}")
-
-    db.delete(db_spot)
+    db_spot = get_own_spot(db, spot_id, user_id)
+    snapshot = remove_spot(db, db_spot)
     db.commit()
+
+    spot_events.emit(spot_events.SPOT_DELETED, snapshot)
@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 import os
+import threading
 
 # 環境変数を読み込み
 load_dotenv()
@@ -10,25 +11,92 @@ load_dotenv()
 # CockroachDB接続URL
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-# CockroachDB用のエンジン作成
-# QueuePool
-engine = create_engine(
-    DATABASE_URL,
-    pool_size=10,
-    max_overflow=0,
-    pool_recycle=300,
-    pool_timeout=20,
-    pool_pre_ping=True,
-    connect_args={"connect_timeout": 10}
-)
+# 起動時のウォームアップで事前に開いておく接続数
+WARMUP_CONNECTIONS = 4
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    CockroachDB用のエンジンを取得する（初回呼び出し時に作成）
+    DBドライバの読み込みを最初に使うときまで遅らせ、インポートを軽くする
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                # QueuePool
+                _engine = create_engine(
+                    DATABASE_URL,
+                    pool_size=10,
+                    max_overflow=0,
+                    pool_recycle=300,
+                    pool_timeout=20,
+                    pool_pre_ping=True,
+                    connect_args={"connect_timeout": 10}
+                )
+    return _engine
+
+
+def __getattr__(name):
+    # 従来どおり `from database import engine` で使えるようにする
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class _LazySessionmaker(sessionmaker):
+    """bindが設定されていなければ最初のセッション作成時にエンジンを作る"""
+
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None and "bind" not in local_kw:
+            self.configure(bind=get_engine())
+        return super().__call__(**local_kw)
+
 
 # セッションローカルの作成
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = _LazySessionmaker(autocommit=False, autoflush=False)
 
 # Baseクラスの作成
 Base = declarative_base()
 
 
+def warm_up_pool(connections: int = WARMUP_CONNECTIONS) -> None:
+    """接続を同時に開いてプールに残し、最初のリクエストで接続を確立しなくて済むようにする"""
+    bind = SessionLocal.kw.get("bind") or get_engine()
+    opened = []
+    try:
+        for _ in range(connections):
+            conn = bind.connect()
+            opened.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in opened:
+            conn.close()
+
+
+def upsert_add(dialect_name: str, table, index_elements, add_columns, replace_columns=()):
+    """
+    INSERT ... ON CONFLICT DO UPDATE で、既存の行には add_columns の値を加算し、
+    replace_columns の値を置き換える文を返す（カウンターの一括加算用。executemanyで複数行をまとめて送る）
+    """
+    if dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        # CockroachDBはPostgreSQLの INSERT ... ON CONFLICT に対応している
+        from sqlalchemy.dialects.postgresql import insert
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={
+            **{name: table.c[name] + stmt.excluded[name] for name in add_columns},
+            **{name: stmt.excluded[name] for name in replace_columns},
+        },
+    )
+
+
 # 依存性注入用のDB取得関数
 def get_db():
     db = SessionLocal()
@@ -0,0 +1,54 @@
+# スポットのエクスポート用スクリプト
+# 使い方: python export_spots.py spots.ndjson.gz [--format csv] [--since 2025-01-01] [--bbox 35.5,139.5,35.8,139.9]
+
+import argparse
+import sys
+from datetime import datetime
+
+from database import SessionLocal
+import spot_export
+
+
+def _parse_bbox(value: str):
+    min_lat, min_lng, max_lat, max_lng = (float(v) for v in value.split(","))
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="スポットをNDJSON/CSVでエクスポートします")
+    parser.add_argument("path", help="出力ファイルのパス（'-' で標準出力）")
+    parser.add_argument("--format", choices=spot_export.SUPPORTED_FORMATS, help="出力形式（省略時は拡張子から推定）")
+    parser.add_argument("--gzip", action="store_true", help="gzip圧縮する（.gzで終わるパスなら自動）")
+    parser.add_argument("--bbox", type=_parse_bbox, help="min_lat,min_lng,max_lat,max_lng")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="created_atの下限（含む）")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="created_atの上限（含まない）")
+    args = parser.parse_args(argv)
+
+    path = args.path
+    compress = args.gzip or path.endswith(".gz")
+    fmt = args.format or ("csv" if path.removesuffix(".gz").endswith(".csv") else "ndjson")
+    min_lat, min_lng, max_lat, max_lng = args.bbox or (None, None, None, None)
+    filters = spot_export.ExportFilter(
+        min_lat=min_lat, max_lat=max_lat,
+        min_lng=min_lng, max_lng=max_lng,
+        since=args.since, until=args.until,
+    )
+
+    out = sys.stdout.buffer if path == "-" else open(path, "wb")
+    db = SessionLocal()
+    written = 0
+    try:
+        for chunk in spot_export.iter_export_chunks(db, fmt, filters, compress=compress):
+            out.write(chunk)
+            written += len(chunk)
+    finally:
+        db.close()
+        if out is not sys.stdout.buffer:
+            out.close()
+
+    print(f"エクスポートが完了しました！ ({written} bytes, 形式: {fmt})", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
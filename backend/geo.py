@@ -0,0 +1,83 @@
+"""
+位置情報まわりのヘルパー
+"""
+import math
+from typing import List, Optional, Tuple
+
+EARTH_RADIUS_M = 6_371_000.0
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """2点間の大円距離（メートル）"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+# ===== Webメルカトルのタイル座標 =====
+EARTH_CIRCUMFERENCE_M = 2 * math.pi * 6_378_137.0
+MAX_LATITUDE = 85.05112878
+
+
+def latlng_to_tile(lat: float, lng: float, zoom: int) -> Tuple[int, int]:
+    """緯度経度を含むタイルの (x, y) を返す"""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    n = 1 << zoom
+    x = int((lng + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_size_m(lat: float, zoom: int) -> float:
+    """指定緯度でのタイル1辺の長さ（メートル）"""
+    return EARTH_CIRCUMFERENCE_M * math.cos(math.radians(lat)) / (1 << zoom)
+
+
+def neighbour_tiles(x: int, y: int, zoom: int, ring: int = 1) -> List[Tuple[int, int]]:
+    """(x, y) を中心とする (2*ring+1)^2 個のタイル（経度方向は折り返し）"""
+    n = 1 << zoom
+    tiles = []
+    for dy in range(-ring, ring + 1):
+        ty = y + dy
+        if ty < 0 or ty >= n:
+            continue
+        for dx in range(-ring, ring + 1):
+            tiles.append(((x + dx) % n, ty))
+    return tiles
+
+
+# ===== グリッドキー（spots.grid_key） =====
+# ズーム14のタイル（東京付近で約2km四方）を1つの整数にしたもの。
+# 複合インデックス (grid_key, created_at) で周辺のスポットを絞り込むのに使う
+GRID_ZOOM = 14
+
+
+def grid_key(lat: float, lng: float) -> int:
+    """緯度経度を含むグリッドセルのキー"""
+    x, y = latlng_to_tile(lat, lng, GRID_ZOOM)
+    return (x << GRID_ZOOM) | y
+
+
+def grid_keys_near(lat: float, lng: float, radius_m: float, max_ring: int) -> Optional[List[int]]:
+    """
+    中心から半径radius_mを覆うグリッドセルのキー
+
+    Returns:
+        キーのリスト（必要なリング数がmax_ringを超える場合はNone）
+    """
+    ring = max(1, math.ceil(radius_m / tile_size_m(lat, GRID_ZOOM)))
+    if ring > max_ring:
+        return None
+    x, y = latlng_to_tile(lat, lng, GRID_ZOOM)
+    return [(tx << GRID_ZOOM) | ty for tx, ty in neighbour_tiles(x, y, GRID_ZOOM, ring)]
+
+
+def bbox_around(lat: float, lng: float, radius_m: float) -> Tuple[float, float, float, float]:
+    """中心から半径radius_mを含む (min_lat, min_lng, max_lat, max_lng)（経度は折り返さない）"""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    dlng = math.degrees(radius_m / (EARTH_RADIUS_M * max(math.cos(math.radians(lat)), 1e-6)))
+    return lat - dlat, lng - dlng, lat + dlat, lng + dlng
@@ -0,0 +1,289 @@
+"""
+スポットの密度・混雑度のヒートマップタイル（/tiles/{z}/{x}/{y}.png）
+
+- 全スポットのWebメルカトル座標と混雑度をNumPy配列でプロセス内に保持する
+  （spot_sync.ColumnStore。crudの書き込みイベントと spot_sync の定期同期で追従する）
+- タイルの描画: 範囲内（＋ぼかしの余白）の点を np.bincount でピクセルに集計し、
+  分離可能なガウシアンでぼかしてから色を付け、PillowでPNGにする
+- 描画したタイルはデータの版をキーに含めてLRUにキャッシュする。スポットが変わると点のある領域
+  （VERSION_ZOOM のタイル）の版が上がり、その領域にかかるタイルは次の取得でミスする（古いものはLRUで消える）
+"""
+import io
+import logging
+import math
+import threading
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+import cache
+import geo
+import spot_events
+import spot_sync
+from startup import lazy_module
+
+np = lazy_module("numpy")
+PIL_Image = lazy_module("PIL.Image")
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+MIN_ZOOM = 0
+MAX_ZOOM = 18
+BLUR_RADIUS_PX = 12
+# 密度の正規化: ぼかし後の値がこの値でちょうど半分の強さになる
+DENSITY_HALF = 0.15
+
+MODE_DENSITY = "density"
+MODE_CROWD = "crowd"
+MODES = (MODE_DENSITY, MODE_CROWD)
+CROWD_VALUES = {"low": 0.0, "medium": 0.5, "high": 1.0}
+
+TILE_CACHE_SIZE = 2048
+# データの版を持つ領域のズーム（≒40km四方）。これより低いズームのタイルは全体の版を使う
+VERSION_ZOOM = 10
+
+# 色: (位置, R, G, B, A)
+_DENSITY_STOPS = [(0.0, 0, 0, 255, 0), (0.25, 0, 128, 255, 140), (0.5, 0, 220, 120, 180),
+                  (0.75, 255, 220, 0, 210), (1.0, 255, 40, 0, 235)]
+_CROWD_STOPS = [(0.0, 40, 200, 80, 255), (0.5, 255, 210, 0, 255), (1.0, 230, 40, 30, 255)]
+
+def _mercator(lat: float, lng: float) -> Tuple[float, float]:
+    """緯度経度を [0, 1) に正規化したWebメルカトル座標にする"""
+    lat = max(-geo.MAX_LATITUDE, min(geo.MAX_LATITUDE, lat))
+    mx = (lng + 180.0) / 360.0
+    my = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0
+    return mx % 1.0, min(max(my, 0.0), 1.0 - 1e-12)
+
+
+def _region(mx: float, my: float) -> Tuple[int, int]:
+    """点を含む VERSION_ZOOM のタイル"""
+    n = 1 << VERSION_ZOOM
+    return min(int(mx * n), n - 1), min(int(my * n), n - 1)
+
+
+def _lut(stops) -> "np.ndarray":
+    """0〜255の強さからRGBAへの対応表 (256, 4)"""
+    positions = np.array([s[0] for s in stops]) * 255
+    levels = np.arange(256)
+    return np.stack(
+        [np.interp(levels, positions, [s[i] for s in stops]) for i in range(1, 5)], axis=1
+    ).astype(np.uint8)
+
+
+def _gaussian_kernel(radius: int) -> "np.ndarray":
+    offsets = np.arange(-radius, radius + 1, dtype=np.float32)
+    kernel = np.exp(-0.5 * (offsets / (radius / 2.0)) ** 2)
+    return kernel / kernel.sum()
+
+
+def _blur(grid: "np.ndarray", kernel: "np.ndarray") -> "np.ndarray":
+    """
+    分離可能なガウシアンでぼかす（縦横それぞれ、ずらしたスライスの重み付き和）
+    gridは四辺にカーネル半径分の余白を含み、戻り値は余白を除いた大きさになる
+    """
+    radius = len(kernel) // 2
+    height, width = grid.shape[0] - 2 * radius, grid.shape[1] - 2 * radius
+    rows = np.zeros((grid.shape[0], width), dtype=np.float32)
+    for i, weight in enumerate(kernel):
+        rows += weight * grid[:, i:i + width]
+    out = np.zeros((height, width), dtype=np.float32)
+    for i, weight in enumerate(kernel):
+        out += weight * rows[i:i + height, :]
+    return out
+
+
+def _encode_png(rgba: "np.ndarray") -> bytes:
+    buf = io.BytesIO()
+    PIL_Image.fromarray(rgba, "RGBA").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class SpotHeatmap(spot_sync.SyncedIndex):
+    """スレッドセーフ"""
+    COLUMNS = ("latitude", "longitude", "crowd_level")
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # crowd: CROWD_VALUES
+        self._points = spot_sync.ColumnStore({"mx": "float64", "my": "float64", "crowd": "float32"})
+        # (mode, z, x, y, データの版) -> PNG
+        self._tiles: cache.LRUCache = cache.LRUCache(maxsize=TILE_CACHE_SIZE)
+        self._version = 0
+        self._region_versions: Dict[Tuple[int, int], int] = {}
+        self._empty_png: Optional[bytes] = None
+        self._luts: Dict[str, "np.ndarray"] = {}
+        self._kernel = None
+
+    # ----- データの版 -----
+    def _bump_locked(self, changed: List[Tuple[float, float]]) -> None:
+        """変化した位置の領域と全体の版を上げる"""
+        for mx, my in changed:
+            region = _region(mx, my)
+            self._region_versions[region] = self._region_versions.get(region, 0) + 1
+            self._version += 1
+
+    def _data_version(self, z: int, x: int, y: int) -> int:
+        """
+        タイルの描画に使う点（ぼかしの余白を含む）がある領域の版の合計
+        版は増える一方なので、どの領域が変わっても合計が変わる
+        """
+        with self._lock:
+            if z < VERSION_ZOOM:
+                return self._version
+            n = 1 << VERSION_ZOOM
+            span = TILE_SIZE << (z - VERSION_ZOOM)   # 領域1辺のピクセル数（ズームz）
+            x0, x1 = (x * TILE_SIZE - BLUR_RADIUS_PX) // span, ((x + 1) * TILE_SIZE + BLUR_RADIUS_PX) // span
+            y0, y1 = (y * TILE_SIZE - BLUR_RADIUS_PX) // span, ((y + 1) * TILE_SIZE + BLUR_RADIUS_PX) // span
+            return sum(
+                self._region_versions.get((rx % n, ry), 0)
+                for rx in range(x0, x1 + 1)
+                for ry in range(max(y0, 0), min(y1, n - 1) + 1)
+            )
+
+    # ----- 点の更新 -----
+    def _put_locked(self, spot_id: UUID, lat: float, lng: float, crowd_level: str) -> List[Tuple[float, float]]:
+        """点を追加・更新し、変化した位置を返す"""
+        mx, my = _mercator(lat, lng)
+        crowd = CROWD_VALUES.get(crowd_level, CROWD_VALUES["medium"])
+        points = self._points
+        slot = points.slots.get(spot_id)
+        if slot is not None:
+            old = (float(points["mx"][slot]), float(points["my"][slot]))
+            if old == (mx, my) and points["crowd"][slot] == crowd:
+                return []
+            changed = [old, (mx, my)] if old != (mx, my) else [old]
+        else:
+            slot = points.put(spot_id)
+            changed = [(mx, my)]
+        points["mx"][slot] = mx
+        points["my"][slot] = my
+        points["crowd"][slot] = crowd
+        self._bump_locked(changed)
+        return changed
+
+    def _remove_locked(self, spot_id: UUID) -> List[Tuple[float, float]]:
+        slot = self._points.release(spot_id)
+        if slot is None:
+            return []
+        changed = [(float(self._points["mx"][slot]), float(self._points["my"][slot]))]
+        self._bump_locked(changed)
+        return changed
+
+    def upsert(self, spot_id: UUID, lat: float, lng: float, crowd_level: str) -> None:
+        with self._lock:
+            self._put_locked(spot_id, lat, lng, crowd_level)
+
+    def remove(self, spot_id: UUID) -> None:
+        with self._lock:
+            self._remove_locked(spot_id)
+
+    def on_spot_event(self, kind: str, snapshot: spot_events.SpotSnapshot) -> None:
+        """spot_eventsのリスナー"""
+        if kind == spot_events.SPOT_DELETED:
+            self.remove(snapshot.id)
+        else:
+            self.upsert(snapshot.id, snapshot.latitude, snapshot.longitude, snapshot.crowd_level)
+
+    # ----- DBとの同期 -----
+    def _apply_row(self, row) -> None:
+        self.upsert(row.id, row.latitude, row.longitude, row.crowd_level.value)
+
+    def _start_rebuild(self) -> Tuple[set, List[Tuple[float, float]]]:
+        # (読み直しで現れたスポット, 変化した位置)
+        return set(), []
+
+    def _rebuild_row(self, state, row) -> None:
+        seen, changed = state
+        seen.add(row.id)
+        with self._lock:
+            changed += self._put_locked(row.id, row.latitude, row.longitude, row.crowd_level.value)
+
+    def _finish_rebuild(self, state) -> None:
+        """他のワーカーで削除されたスポットを消す（変化した点の領域の版は _put_locked / _remove_locked で上がる）"""
+        seen, changed = state
+        with self._lock:
+            for spot_id in [spot_id for spot_id in self._points.slots if spot_id not in seen]:
+                changed += self._remove_locked(spot_id)
+        logger.info("Heatmap points rebuilt (%d spots, %d changed)", len(seen), len(changed))
+
+    # ----- 描画 -----
+    def _points_in(self, z: int, x: int, y: int, margin: int):
+        """タイル（＋余白）内の点のタイル内ピクセル座標と混雑度"""
+        scale = (1 << z) * TILE_SIZE
+        with self._lock:
+            points = self._points
+            n = points.size
+            if n == 0:
+                return None
+            px = points["mx"][:n] * scale - x * TILE_SIZE
+            py = points["my"][:n] * scale - y * TILE_SIZE
+            crowd = points["crowd"][:n].copy()
+            alive = points["alive"][:n].copy()
+        inside_y = alive & (py >= -margin) & (py < TILE_SIZE + margin)
+        # 経度方向の折り返し: 世界の反対側の端にある点も余白に入る（ズーム0では同じ点が両端に出る）
+        xs, ys, crowds = [], [], []
+        for shift in (-scale, 0, scale):
+            shifted = px + shift
+            mask = inside_y & (shifted >= -margin) & (shifted < TILE_SIZE + margin)
+            if mask.any():
+                xs.append(shifted[mask])
+                ys.append(py[mask])
+                crowds.append(crowd[mask])
+        if not xs:
+            return None
+        return np.concatenate(xs), np.concatenate(ys), np.concatenate(crowds)
+
+    def _render(self, mode: str, z: int, x: int, y: int) -> bytes:
+        if self._kernel is None:
+            self._kernel = _gaussian_kernel(BLUR_RADIUS_PX)
+            self._luts = {MODE_DENSITY: _lut(_DENSITY_STOPS), MODE_CROWD: _lut(_CROWD_STOPS)}
+
+        margin = BLUR_RADIUS_PX
+        points = self._points_in(z, x, y, margin)
+        if points is None:
+            return self.empty_png()
+        px, py, crowd = points
+
+        # 余白込みのグリッドにビニング
+        side = TILE_SIZE + 2 * margin
+        cells = (py + margin).astype(np.int64) * side + (px + margin).astype(np.int64)
+        counts = np.bincount(cells, minlength=side * side).astype(np.float32).reshape(side, side)
+        density = _blur(counts, self._kernel)
+        strength = density / (density + DENSITY_HALF)
+
+        if mode == MODE_DENSITY:
+            rgba = self._luts[MODE_DENSITY][(strength * 255).astype(np.uint8)]
+        else:
+            weighted = np.bincount(cells, weights=crowd, minlength=side * side).astype(np.float32)
+            crowd_blurred = _blur(weighted.reshape(side, side), self._kernel)
+            level = np.divide(crowd_blurred, density, out=np.zeros_like(density), where=density > 1e-6)
+            rgba = self._luts[MODE_CROWD][(np.clip(level, 0.0, 1.0) * 255).astype(np.uint8)]
+            # 点の無い場所は透明にし、密度に応じて濃くする
+            rgba[..., 3] = (np.minimum(strength * 1.6, 1.0) * 200).astype(np.uint8)
+        return _encode_png(np.ascontiguousarray(rgba))
+
+    def empty_png(self) -> bytes:
+        if self._empty_png is None:
+            self._empty_png = _encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+        return self._empty_png
+
+    def cached_tile(self, mode: str, z: int, x: int, y: int) -> Optional[bytes]:
+        """キャッシュ済みのタイル（イベントループ上で呼んでよい）"""
+        return self._tiles.get((mode, z, x, y, self._data_version(z, x, y)))
+
+    def tile(self, mode: str, z: int, x: int, y: int) -> bytes:
+        """タイルのPNG（キャッシュになければ描画する。CPUを使うのでスレッドプールで呼ぶ）"""
+        # 版は点を読む前に取る（描画中に変わった分は次の版で描き直される）
+        key = (mode, z, x, y, self._data_version(z, x, y))
+        return self._tiles.get_or_load_many([key], lambda keys: {key: self._render(mode, z, x, y)})[key]
+
+
+# シングルトンインスタンス
+_heatmap = SpotHeatmap()
+
+
+def get_heatmap() -> SpotHeatmap:
+    """プロセス共通のヒートマップを取得"""
+    return _heatmap
+
@@ -0,0 +1,213 @@
+"""
+「近くの人気スポット」ランキング
+
+スコア = 品質(rating, crowd_level) × 新しさの指数減衰 × 距離の指数減衰。
+新しさの減衰は全スポットに共通の係数 exp(-now/τ) を掛けるだけなので、
+log(品質) + created_at/τ をキーにすれば時間が経っても順位は変わらない。
+このキーでタイル（セル）ごとに上位CELL_CAPACITY件を保持しておき、
+クエリ時は周辺セルの候補に距離の減衰を掛けて上位k件を取り出すだけにする。
+"""
+import heapq
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Set, Tuple
+from uuid import UUID
+
+import geo
+import spot_events
+import spot_sync
+
+CELL_ZOOM = 14            # 1セル ≒ 2km四方（東京付近）
+CELL_CAPACITY = 64        # セルごとに保持する上位件数
+MAX_RING = 3              # クエリ時に見る周辺セルの最大半径
+RECENCY_TAU_SECONDS = 12 * 60 * 60
+DISTANCE_DECAY_M = 1000.0
+CROWD_WEIGHTS = {"low": 1.0, "medium": 0.8, "high": 0.6}
+
+Cell = Tuple[int, int]
+
+
+def _timestamp(value: datetime) -> float:
+    # DBから読んだ値はUTCのnaive datetime
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def rank_key(rating: int, crowd_level: str, created_at: datetime) -> float:
+    """時間に依存しない順位キー（大きいほど上位）"""
+    quality = (rating / 5.0) * CROWD_WEIGHTS.get(crowd_level, CROWD_WEIGHTS["medium"])
+    return math.log(max(quality, 1e-6)) + _timestamp(created_at) / RECENCY_TAU_SECONDS
+
+
+def max_radius_m(lat: float) -> float:
+    """指定緯度でMAX_RINGの周辺セルが覆える半径（高緯度ほどセルが小さく、狭くなる）"""
+    return MAX_RING * geo.tile_size_m(lat, CELL_ZOOM)
+
+
+class _Entry:
+    __slots__ = ("key", "spot_id", "lat", "lng")
+
+    def __init__(self, key: float, spot_id: UUID, lat: float, lng: float):
+        self.key = key
+        self.spot_id = spot_id
+        self.lat = lat
+        self.lng = lng
+
+    def __lt__(self, other: "_Entry") -> bool:
+        return self.key < other.key
+
+
+class HotSpotRanking(spot_sync.SyncedIndex):
+    """セルごとの上位スポットを保持するスレッドセーフな構造"""
+    COLUMNS = ("latitude", "longitude", "rating", "crowd_level", "created_at")
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._cells: Dict[Cell, List[_Entry]] = {}   # キー降順
+        self._spot_cells: Dict[UUID, Cell] = {}
+        self._truncated: Set[Cell] = set()           # DBにCELL_CAPACITYを超える件数があるセル
+        self._stale = False                          # 切り詰め済みセルの保持分から抜けたスポットがある
+
+    # ----- 更新 -----
+    def _remove(self, spot_id: UUID) -> None:
+        cell = self._spot_cells.pop(spot_id, None)
+        if cell is None:
+            return
+        entries = self._cells[cell]
+        entries[:] = [e for e in entries if e.spot_id != spot_id]
+        if cell in self._truncated:
+            # 圏外だった候補が繰り上がるはずなので次回の同期で再構築する
+            self._stale = True
+
+    @staticmethod
+    def _place(entries: List[_Entry], entry: _Entry) -> None:
+        # 件数が小さいので線形探索で十分
+        pos = next((i for i, e in enumerate(entries) if e.key < entry.key), len(entries))
+        entries.insert(pos, entry)
+
+    def _insert(self, cell: Cell, entry: _Entry) -> None:
+        entries = self._cells.setdefault(cell, [])
+        if len(entries) >= CELL_CAPACITY and entry.key <= entries[-1].key:
+            self._truncated.add(cell)
+            return
+        self._place(entries, entry)
+        self._spot_cells[entry.spot_id] = cell
+        if len(entries) > CELL_CAPACITY:
+            dropped = entries.pop()
+            del self._spot_cells[dropped.spot_id]
+            self._truncated.add(cell)
+
+    def _rerank(self, cell: Cell, entry: _Entry) -> None:
+        """同じセルに保持しているスポットの順位キーを更新する"""
+        entries = self._cells[cell]
+        if cell in self._truncated and entry.key < entries[-1].key:
+            # 保持していない候補（キーは保持分の最下位以下）より下がったかもしれない
+            self._stale = True
+        entries[:] = [e for e in entries if e.spot_id != entry.spot_id]
+        self._place(entries, entry)
+
+    def upsert(self, spot_id: UUID, lat: float, lng: float, rating: int, crowd_level: str, created_at: datetime) -> None:
+        entry = _Entry(rank_key(rating, crowd_level, created_at), spot_id, lat, lng)
+        cell = geo.latlng_to_tile(lat, lng, CELL_ZOOM)
+        with self._lock:
+            if self._spot_cells.get(spot_id) == cell:
+                # 差分同期で同じ行を取り込み直すことが多いので、その場で並べ替えるだけにする
+                self._rerank(cell, entry)
+            else:
+                self._remove(spot_id)
+                self._insert(cell, entry)
+
+    def remove(self, spot_id: UUID) -> None:
+        with self._lock:
+            self._remove(spot_id)
+
+    def on_spot_event(self, kind: str, snapshot: spot_events.SpotSnapshot) -> None:
+        """spot_eventsのリスナー"""
+        if kind == spot_events.SPOT_DELETED:
+            self.remove(snapshot.id)
+        else:
+            self.upsert(
+                snapshot.id, snapshot.latitude, snapshot.longitude,
+                snapshot.rating, snapshot.crowd_level, snapshot.created_at,
+            )
+
+    # ----- DBとの同期 -----
+    def _needs_rebuild(self) -> bool:
+        # 切り詰め済みセルの保持分から抜けると圏外だった候補が繰り上がるので、全件から作り直す
+        return self._stale or super()._needs_rebuild()
+
+    def _apply_row(self, row) -> None:
+        self.upsert(row.id, row.latitude, row.longitude, row.rating, row.crowd_level.value, row.created_at)
+
+    def _start_rebuild(self) -> Tuple[Dict[Cell, List[_Entry]], Set[Cell]]:
+        # (セルごとの上位CELL_CAPACITY件のヒープ, 上限を超える件数があったセル)
+        return {}, set()
+
+    def _rebuild_row(self, state, row) -> None:
+        heaps, truncated = state
+        entry = _Entry(
+            rank_key(row.rating, row.crowd_level.value, row.created_at),
+            row.id, row.latitude, row.longitude,
+        )
+        cell = geo.latlng_to_tile(row.latitude, row.longitude, CELL_ZOOM)
+        heap = heaps.setdefault(cell, [])
+        if len(heap) < CELL_CAPACITY:
+            heapq.heappush(heap, entry)
+        else:
+            heapq.heappushpop(heap, entry)
+            truncated.add(cell)
+
+    def _finish_rebuild(self, state) -> None:
+        """セルごとの上位CELL_CAPACITY件を作り直した内容に置き換える"""
+        heaps, truncated = state
+        cells = {cell: sorted(heap, reverse=True) for cell, heap in heaps.items()}
+        spot_cells = {e.spot_id: cell for cell, entries in cells.items() for e in entries}
+        with self._lock:
+            self._cells = cells
+            self._spot_cells = spot_cells
+            self._truncated = truncated
+            self._stale = False
+
+    # ----- 検索 -----
+    def top(self, lat: float, lng: float, radius: float, limit: int = 20) -> List[Tuple[UUID, float, float]]:
+        """
+        周辺の上位スポットを返す
+
+        Returns:
+            (spot_id, スコア(0〜1), 距離[m]) のリスト（スコア降順）
+
+        Raises:
+            ValueError: 半径がMAX_RINGの周辺セルで覆えない（max_radius_m(lat)を超える）場合
+        """
+        limit_m = max_radius_m(lat)
+        if radius > limit_m:
+            raise ValueError(f"radius must be at most {limit_m:.0f} m at latitude {lat}")
+        x, y = geo.latlng_to_tile(lat, lng, CELL_ZOOM)
+        ring = max(1, math.ceil(radius / geo.tile_size_m(lat, CELL_ZOOM)))
+        now_term = time.time() / RECENCY_TAU_SECONDS
+
+        scored = []
+        with self._lock:
+            for cell in geo.neighbour_tiles(x, y, CELL_ZOOM, ring):
+                for entry in self._cells.get(cell, ()):
+                    distance = geo.haversine_m(lat, lng, entry.lat, entry.lng)
+                    if distance > radius:
+                        continue
+                    scored.append((entry.key - distance / DISTANCE_DECAY_M, distance, entry.spot_id))
+
+        top = heapq.nlargest(limit, scored, key=lambda item: item[0])
+        return [(spot_id, math.exp(rank - now_term), distance) for rank, distance, spot_id in top]
+
+
+# シングルトンインスタンス
+_ranking = HotSpotRanking()
+
+
+def get_hot_spot_ranking() -> HotSpotRanking:
+    """プロセス共通のランキングを取得"""
+    return _ranking
+
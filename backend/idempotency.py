@@ -0,0 +1,170 @@
+"""
+Idempotency-Key による再送の重複排除
+
+処理前にキーを「処理中」として登録し、成功したら処理の変更とレスポンスを同じトランザクションでコミットする。
+同じキーで再送された場合は保存済みのレスポンスをそのまま返すため、
+画像の再アップロードやスポットの二重登録・コインの二重付与が起きない。
+完了済みのレスポンスはプロセス内のLRUキャッシュにも置き、DBを引かずに返せるようにする。
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import and_, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import cache
+import models
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+KEY_TTL = timedelta(hours=24)
+# 処理中のまま残ったキー（プロセスが落ちた場合など）を引き継げるまでの時間
+PENDING_TIMEOUT = timedelta(minutes=5)
+PURGE_INTERVAL_SECONDS = 60 * 60
+
+# (status_code, body)
+StoredResponse = Tuple[int, object]
+
+_completed: cache.LRUCache = cache.LRUCache(maxsize=10000, ttl=KEY_TTL.total_seconds())
+
+
+class IdempotencyConflict(Exception):
+    """キーが処理中、または別の内容のリクエストで使用済み"""
+
+    def __init__(self, message: str, in_progress: bool):
+        super().__init__(message)
+        self.in_progress = in_progress
+
+
+def request_hash(*parts) -> str:
+    """リクエスト内容のハッシュ（同じキーで内容が違う再送を検出するため）"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _find(db: Session, user_id: UUID, endpoint: str, key: str) -> Optional[models.IdempotencyRecord]:
+    return db.query(models.IdempotencyRecord).filter(
+        and_(
+            models.IdempotencyRecord.user_id == user_id,
+            models.IdempotencyRecord.endpoint == endpoint,
+            models.IdempotencyRecord.key == key,
+        )
+    ).first()
+
+
+def _utcnow() -> datetime:
+    # DBには UTC の naive datetime として保存される
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _replay(record: models.IdempotencyRecord, req_hash: str) -> Optional[StoredResponse]:
+    if record.request_hash != req_hash:
+        raise IdempotencyConflict("Idempotency-Key was already used for a different request", in_progress=False)
+    if record.status_code is None:
+        return None
+    return record.status_code, json.loads(record.response_body)
+
+
+def begin(db: Session, user_id: UUID, endpoint: str, key: str, req_hash: str) -> Optional[StoredResponse]:
+    """
+    キーを処理中として確保する
+
+    Returns:
+        保存済みのレスポンスがあれば (status_code, body)、確保できた場合はNone
+
+    Raises:
+        IdempotencyConflict: 処理中、または内容の異なるリクエストで使用済み
+    """
+    cache_key = (user_id, endpoint, key)
+    cached = _completed.get(cache_key)
+    if cached is not None:
+        cached_hash, stored = cached
+        if cached_hash != req_hash:
+            raise IdempotencyConflict("Idempotency-Key was already used for a different request", in_progress=False)
+        return stored
+
+    record = _find(db, user_id, endpoint, key)
+    if record is None:
+        db.add(models.IdempotencyRecord(
+            user_id=user_id, endpoint=endpoint, key=key, request_hash=req_hash, created_at=_utcnow(),
+        ))
+        try:
+            db.commit()
+            return None
+        except IntegrityError:
+            # 同じキーの同時リクエストに先を越された
+            db.rollback()
+            record = _find(db, user_id, endpoint, key)
+            if record is None:
+                raise IdempotencyConflict("A request with this Idempotency-Key is in progress", in_progress=True) from None
+
+    stored = _replay(record, req_hash)
+    if stored is not None:
+        _completed.set(cache_key, (req_hash, stored))
+        return stored
+
+    if record.created_at > _utcnow() - PENDING_TIMEOUT:
+        raise IdempotencyConflict("A request with this Idempotency-Key is in progress", in_progress=True)
+
+    # 放置された処理中のキーを引き継ぐ
+    # （処理の変更はレスポンスと同時にしかコミットされないので、処理中のままのキーの処理は反映されていない）
+    record.created_at = _utcnow()
+    db.commit()
+    return None
+
+
+def complete(db: Session, user_id: UUID, endpoint: str, key: str, req_hash: str, status_code: int, body) -> None:
+    """
+    処理結果を保存し、処理の変更と一緒にコミットする（bodyはJSONにできる値）
+
+    処理だけがコミットされてキーが処理中のまま残ると、引き継いだ再送で処理が二重に実行されるため、
+    処理の変更はこのコミットまでコミットしないこと。
+    """
+    record = _find(db, user_id, endpoint, key)
+    if record is not None:
+        record.status_code = status_code
+        record.response_body = json.dumps(body, ensure_ascii=False)
+    db.commit()
+    _completed.set((user_id, endpoint, key), (req_hash, (status_code, body)))
+
+
+def abandon(db: Session, user_id: UUID, endpoint: str, key: str) -> None:
+    """処理に失敗したキーを解放し、再送で再実行できるようにする"""
+    try:
+        db.rollback()
+        db.execute(delete(models.IdempotencyRecord).where(
+            and_(
+                models.IdempotencyRecord.user_id == user_id,
+                models.IdempotencyRecord.endpoint == endpoint,
+                models.IdempotencyRecord.key == key,
+                models.IdempotencyRecord.status_code.is_(None),
+            )
+        ))
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("Failed to release idempotency key")
+
+
+def purge_expired() -> int:
+    """期限切れのキーを削除する（バックグラウンドタスク用）"""
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            delete(models.IdempotencyRecord).where(models.IdempotencyRecord.created_at < _utcnow() - KEY_TTL)
+        )
+        db.commit()
+        return result.rowcount
+    finally:
+        db.close()
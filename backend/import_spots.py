@@ -0,0 +1,54 @@
+# スポットの一括インポート用スクリプト
+# 使い方: python import_spots.py spots.ndjson [--format csv] [--author-id <UUID>] [--batch-size 5000]
+
+import argparse
+import io
+import sys
+from uuid import UUID
+
+from database import SessionLocal
+import bulk_import
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="NDJSON/CSVファイルからスポットを一括インポートします")
+    parser.add_argument("path", help="入力ファイルのパス（'-' で標準入力）")
+    parser.add_argument("--format", choices=bulk_import.SUPPORTED_FORMATS, help="入力形式（省略時は拡張子から推定）")
+    parser.add_argument("--author-id", type=UUID, help="author_idが無い行に使う投稿者のID")
+    parser.add_argument("--batch-size", type=int, default=bulk_import.DEFAULT_BATCH_SIZE, help="1トランザクションあたりの行数")
+    parser.add_argument("--no-reward", action="store_true", help="投稿報酬のコインを付与しない")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or bulk_import.detect_format(args.path, None)
+    if args.path == "-":
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig", newline="")
+    else:
+        stream = open(args.path, encoding="utf-8-sig", newline="")
+
+    print(f"{args.path} からインポートしています（形式: {fmt}）...")
+    db = SessionLocal()
+    try:
+        with stream:
+            result = bulk_import.import_spots(
+                db,
+                stream,
+                fmt,
+                default_author_id=args.author_id,
+                batch_size=args.batch_size,
+                reward_coins=not args.no_reward,
+            )
+    finally:
+        db.close()
+
+    for error in result.errors:
+        print(f"  line {error.line}: {error.message}")
+    rate = result.inserted / result.elapsed_seconds if result.elapsed_seconds else 0
+    print(
+        f"インポートが完了しました！ 成功: {result.inserted}件 / 失敗: {result.failed}件 "
+        f"（{result.batches}バッチ, {result.elapsed_seconds}秒, {rate:.0f}件/秒）"
+    )
+    return 0 if result.failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
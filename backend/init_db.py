@@ -1,18 +1,44 @@
 # データベースの初期化用スクリプト
+# 使い方: python init_db.py          # 足りないテーブルの作成と未適用のマイグレーションの適用
+#         python init_db.py --reset  # すべてのテーブルを削除して作り直す（データは消えます）
+
+import argparse
+import logging
 
 from database import engine, Base
-import models
+import models  # noqa: F401  テーブル定義の登録
+import migrations
+
 
 def init_db():
     print("既存のテーブルを削除しています...")
-    
+
     # Metadataを使用してテーブルを削除
     Base.metadata.drop_all(bind=engine)
-    
+
     print("新しいテーブルを作成しています...")
     Base.metadata.create_all(bind=engine)
-    
+    migrations.stamp(engine)
+
     print("データベースの初期化が完了しました！")
 
+
+def migrate_db():
+    print("マイグレーションを適用しています...")
+    applied = migrations.upgrade(engine)
+    if applied:
+        print(f"適用したマイグレーション: {', '.join(map(str, applied))}")
+    else:
+        print("適用するマイグレーションはありません")
+
+
 if __name__ == "__main__":
-    init_db()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="データベースを初期化・マイグレーションします")
+    parser.add_argument("--reset", action="store_true", help="すべてのテーブルを削除して作り直す（データは消えます）")
+    args = parser.parse_args()
+
+    if args.reset:
+        init_db()
+    else:
+        migrate_db()
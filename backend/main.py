@@ -1,22 +1,56 @@
-from fastapi import FastAPI, HTTPException, Depends, Query, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, Query, UploadFile, File, Request, Header
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, APIKeyHeader
 from typing import List, Optional, Annotated
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, load_only
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta, timezone
 import schemas
 import crud
 import models
-from database import engine, get_db
+from database import get_db, warm_up_pool
 from uuid import uuid4, UUID
-from jose import JWTError, jwt
+from jose.exceptions import JWTError
 import os
 from dotenv import load_dotenv
-from r2_storage import get_r2_storage
+from r2_storage import get_r2_storage, R2UnavailableError
 import base64
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 import logging
+import secrets
+import json
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from fastapi.concurrency import run_in_threadpool
+import bulk_import
+import spot_export
+import spot_events
+import search_index
+import hot_spots
+import heatmap
+import spot_index
+import spot_sync
+import offline_sync
+import spot_stream
+import wire_format
+import cache
+import admission
+import idempotency
+import storage_gc
+import coin_ledger
+import spot_counters
+import spot_stats
+import crowd_reports
+import shop_catalog
+import profiling
+import startup
+import geo
+
+# joseはcryptographyバックエンドの読み込みが重いので、最初のトークン処理まで遅らせる
+jwt = startup.lazy_module("jose.jwt")
 
 # 環境変数を読み込み
 load_dotenv()
@@ -32,14 +66,180 @@ if not SECRET_KEY:
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# スポット詳細のキャッシュ（単体・一括取得で共有）
+# 他ワーカーでの更新はTTLで追従する
+SPOT_DETAIL_CACHE_SIZE = 10000
+SPOT_DETAIL_CACHE_TTL_SECONDS = 300
+
+# ヒートマップタイルのブラウザ・CDNでのキャッシュ時間（他ワーカーでの変更の反映は同期間隔に従う）
+TILE_MAX_AGE_SECONDS = 60
+
+# X-Forwarded-For を信頼するリバースプロキシ（カンマ区切りのIP・CIDR。未設定なら接続元IPをそのまま使う）
+TRUSTED_PROXIES = admission.parse_trusted_proxies(os.getenv("TRUSTED_PROXIES"))
+
+# 管理者用APIキー（未設定の場合は管理者用エンドポイントを無効化）
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+
+# 失敗したウォームアップの必須ステップ（DB接続・インデックスの構築）を再試行する間隔
+WARMUP_RETRY_SECONDS = 10
+
+
+async def _run_periodically(name: str, interval: float, func):
+    """同期関数をスレッドプールで定期実行する（例外はログに残して継続）"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(func)
+        except Exception:
+            logger.exception("Background task %s failed", name)
+
+
+spot_detail_cache: cache.LRUCache = cache.LRUCache(
+    maxsize=SPOT_DETAIL_CACHE_SIZE, ttl=SPOT_DETAIL_CACHE_TTL_SECONDS
+)
+
+
+def _invalidate_spot_detail(_kind: str, snapshot: spot_events.SpotSnapshot) -> None:
+    spot_detail_cache.invalidate(snapshot.id)
+
+
+# プロセス内インデックス（spot_eventsで書き込みに追従し、spot_syncで1回の読み込みでまとめてDBと同期する）
+_IN_PROCESS_INDEXES: List[spot_sync.SyncedIndex] = [
+    search_index.get_search_index(),
+    hot_spots.get_hot_spot_ranking(),
+    heatmap.get_heatmap(),
+    spot_index.get_spot_index(),
+]
+
+
+def _sync_in_process_indexes() -> None:
+    spot_sync.sync_from_db(_IN_PROCESS_INDEXES)
+
+
+def _warm_up_auth() -> None:
+    """JWTとbcryptのバックエンドを読み込んでおく"""
+    create_access_token({"sub": "warmup"})
+    crud.warm_up_password_hasher()
+
+
+async def _warm_up() -> None:
+    """
+    最初のリクエストが初期化コストを払わないよう、起動直後にバックグラウンドで実行する
+    各ステップは独立しているので並行して実行し、失敗しても他のステップは続ける
+    DB接続とインデックスの構築が成功するまではreadyにせず、失敗したものを成功するまで再試行する
+    """
+    steps = [
+        ("r2_client", get_r2_storage),
+        ("db_pool", warm_up_pool),
+        ("auth", _warm_up_auth),
+        ("default_user_icon", crud.get_default_user_icon_url),
+        ("in_process_indexes", _sync_in_process_indexes),
+    ]
+    # 失敗したままだとリクエストに応えられないステップ（R2とアイコンは最初の使用時に再試行される）
+    required = {"db_pool", "in_process_indexes"}
+
+    async def run(name, func) -> bool:
+        started = time.perf_counter()
+        try:
+            await run_in_threadpool(func)
+        except Exception as e:
+            # DBやR2に繋がらなくても起動は続け、最初の使用時や定期同期で再試行する
+            logger.exception("Warm-up step %s failed", name)
+            startup.metrics.record_step(name, time.perf_counter() - started, e)
+            return False
+        startup.metrics.record_step(name, time.perf_counter() - started)
+        return True
+
+    results = await asyncio.gather(*(run(name, func) for name, func in steps))
+    startup.metrics.mark("warmup_done")
+    failed = [(name, func) for (name, func), ok in zip(steps, results) if not ok and name in required]
+    while failed:
+        await asyncio.sleep(WARMUP_RETRY_SECONDS)
+        results = await asyncio.gather(*(run(name, func) for name, func in failed))
+        failed = [step for step, ok in zip(failed, results) if not ok]
+    startup.metrics.ready = True
+    startup.metrics.mark("ready")
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    spot_stream.start(asyncio.get_running_loop())
+    spot_events.add_listener(_invalidate_spot_detail)
+    tasks = [
+        asyncio.create_task(_warm_up()),
+        asyncio.create_task(
+            _run_periodically("idempotency_purge", idempotency.PURGE_INTERVAL_SECONDS, idempotency.purge_expired)
+        ),
+        asyncio.create_task(
+            _run_periodically("storage_gc_drain", storage_gc.DRAIN_INTERVAL_SECONDS, storage_gc.drain_queue)
+        ),
+        asyncio.create_task(
+            _run_periodically("storage_gc_reconcile", storage_gc.RECONCILE_INTERVAL_SECONDS, storage_gc.reconcile)
+        ),
+        asyncio.create_task(
+            _run_periodically("spot_stats_reconcile", spot_stats.RECONCILE_INTERVAL_SECONDS, spot_stats.reconcile)
+        ),
+        asyncio.create_task(
+            _run_periodically("coin_ledger_settle", coin_ledger.SETTLE_INTERVAL_SECONDS, coin_ledger.settle_pending)
+        ),
+        asyncio.create_task(
+            _run_periodically("spot_counters_flush", spot_counters.FLUSH_INTERVAL_SECONDS, spot_counters.flush)
+        ),
+        asyncio.create_task(
+            _run_periodically("crowd_reports_refresh", crowd_reports.REFRESH_INTERVAL_SECONDS, crowd_reports.refresh)
+        ),
+    ]
+    if profiling.enabled():
+        tasks.append(asyncio.create_task(
+            _run_periodically("profiling_purge", profiling.PURGE_INTERVAL_SECONDS, profiling.purge_expired)
+        ))
+    for index in _IN_PROCESS_INDEXES:
+        # crudの書き込みに追従させる（初回の構築はウォームアップで行う）
+        spot_events.add_listener(index.on_spot_event)
+    tasks.append(asyncio.create_task(
+        _run_periodically("in_process_indexes", spot_sync.SYNC_INTERVAL_SECONDS, _sync_in_process_indexes)
+    ))
+    startup.metrics.mark("lifespan_started")
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # 溜まっているカウンターの増分を書き出してから終了する
+        try:
+            await run_in_threadpool(spot_counters.flush)
+        except Exception:
+            logger.exception("Failed to flush spot counters on shutdown")
+        for index in _IN_PROCESS_INDEXES:
+            spot_events.remove_listener(index.on_spot_event)
+        spot_events.remove_listener(_invalidate_spot_detail)
+        spot_stream.stop()
+
 
 app = FastAPI(
     title="Numyp API",
     description="API for Numyp",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 
+# 対象のリクエストだけをプロファイルする（設定が無い場合は登録しない）
+if profiling.enabled():
+    app.add_middleware(profiling.ProfilingMiddleware)
+
+# 最初のリクエストの完了時刻を記録する
+app.add_middleware(startup.FirstRequestTimer)
+
+# 過負荷時は待たせずに503/429を返す（CORSより内側に置き、拒否レスポンスにもCORSヘッダーを付ける）
+app.add_middleware(
+    admission.AdmissionMiddleware,
+    secret_key=SECRET_KEY,
+    algorithm=ALGORITHM,
+    trusted_proxies=TRUSTED_PROXIES,
+)
+
 # CORS
 # ハッカソン用,開発環境のオリジンを許可
 app.add_middleware(
@@ -53,6 +253,7 @@ app.add_middleware(
 
 # 認証のための設定
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
+admin_key_header = APIKeyHeader(name="X-Admin-Key", auto_error=False)
 
 
 # ヘルパー関数
@@ -68,6 +269,26 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+# アップロードを許可する画像形式と拡張子
+IMAGE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/gif": ".gif"
+}
+MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 10MB
+PRESIGNED_UPLOAD_EXPIRES_SECONDS = 600
+
+
+def _storage_unavailable(e: R2UnavailableError) -> HTTPException:
+    """R2の障害中はワーカーを待たせずに503を返す"""
+    return HTTPException(
+        status_code=503,
+        detail="Image storage is temporarily unavailable",
+        headers={"Retry-After": str(int(e.retry_after + 0.999))},
+    )
+
+
 def _upload_image_from_base64(image_base64: str, folder: str = "spots") -> str:
     """
     base64文字列から画像をアップロードし、公開URLを返す。
@@ -93,13 +314,7 @@ def _upload_image_from_base64(image_base64: str, folder: str = "spots") -> str:
         image_data = base64.b64decode(encoded)
 
         # ファイル拡張子を決定
-        ext_map = {
-            "image/jpeg": ".jpg",
-            "image/png": ".png",
-            "image/webp": ".webp",
-            "image/gif": ".gif"
-        }
-        extension = ext_map.get(content_type, ".jpg")
+        extension = IMAGE_EXTENSIONS.get(content_type, ".jpg")
 
         # R2にアップロード
         r2_storage = get_r2_storage()
@@ -115,11 +330,49 @@ def _upload_image_from_base64(image_base64: str, folder: str = "spots") -> str:
     except HTTPException:
         # すでにHTTPExceptionに変換済みの場合はそのまま流す
         raise
+    except R2UnavailableError as e:
+        raise _storage_unavailable(e) from None
     except Exception:
         logger.exception("Failed to upload spot image")
         raise HTTPException(status_code=500, detail="Failed to upload image") from None
 
 
+def _verify_uploaded_image(image_key: str, user_id: UUID) -> str:
+    """
+    POST /upload/presign で発行したキーに直接アップロードされた画像を確認し、公開URLを返す。
+    自分用のプレフィックス配下であること、形式とサイズが制限内であることをHEAD 1回で確認する。
+    """
+    prefix = f"spots/{user_id}/"
+    if not image_key.startswith(prefix) or "/" in image_key[len(prefix):]:
+        raise HTTPException(status_code=400, detail="Invalid image key")
+
+    r2_storage = get_r2_storage()
+    try:
+        head = r2_storage.head_object(image_key)
+    except R2UnavailableError as e:
+        raise _storage_unavailable(e) from None
+    except Exception:
+        logger.exception("Failed to verify uploaded image")
+        raise HTTPException(status_code=500, detail="Failed to verify image") from None
+
+    if head is None:
+        raise HTTPException(status_code=400, detail="Uploaded image not found")
+    if head["content_type"] not in IMAGE_EXTENSIONS or (head["content_length"] or 0) > MAX_IMAGE_SIZE:
+        raise HTTPException(status_code=400, detail="Invalid uploaded image")
+    return r2_storage.get_public_url(image_key)
+
+
+def _resolve_spot_image(image_base64: Optional[str], image_key: Optional[str], user_id: UUID) -> Optional[str]:
+    """base64（APIサーバー経由）または直接アップロード済みのキーから画像URLを決める"""
+    if image_base64 and image_key:
+        raise HTTPException(status_code=400, detail="Specify either image_base64 or image_key, not both")
+    if image_key:
+        return _verify_uploaded_image(image_key, user_id)
+    if image_base64:
+        return _upload_image_from_base64(image_base64, folder="spots")
+    return None
+
+
 def _spot_to_response(spot: models.Spot, include_description: bool = True) -> schemas.SpotResponse:
     """モデルからレスポンスモデルを生成"""
     return schemas.SpotResponse(
@@ -148,8 +401,64 @@ def _spot_to_response(spot: models.Spot, include_description: bool = True) -> sc
     )
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    """現在のユーザーを取得"""
+def _get_spot_details(db: Session, spot_ids: List[UUID]) -> dict:
+    """スポット詳細をキャッシュ経由で取得（ミスした分だけ1回のINクエリで読む）"""
+    def load(missing: List[UUID]) -> dict:
+        return {
+            spot.id: _spot_to_response(spot, include_description=True)
+            for spot in crud.get_spots_by_ids(db, missing)
+        }
+    return spot_detail_cache.get_or_load_many(spot_ids, load)
+
+
+def _run_idempotent(
+    db: Session,
+    user_id: UUID,
+    endpoint: str,
+    idempotency_key: Optional[str],
+    req_hash: str,
+    func,
+    on_commit=None,
+):
+    """
+    funcを実行し、その変更をコミットする（funcはコミットせずに結果を返す）
+    Idempotency-Keyが指定されていれば、保存済みのレスポンスを返すか、funcの変更とレスポンスの保存を
+    1つのトランザクションでコミットする（処理だけがコミットされてキーが処理中のまま残ることはない）。
+    funcが例外を投げた場合やコミットに失敗した場合はキーを解放し、再送で再実行できるようにする。
+    on_commitはコミットの後に呼ぶ（保存済みのレスポンスを返した場合は呼ばない）
+    """
+    if idempotency_key is not None:
+        try:
+            stored = idempotency.begin(db, user_id, endpoint, idempotency_key, req_hash)
+        except idempotency.IdempotencyConflict as e:
+            raise HTTPException(status_code=409 if e.in_progress else 422, detail=str(e)) from None
+        if stored is not None:
+            status_code, body = stored
+            return JSONResponse(content=body, status_code=status_code, headers={"Idempotent-Replayed": "true"})
+
+    try:
+        result = func()
+        if idempotency_key is None:
+            db.commit()
+        else:
+            idempotency.complete(db, user_id, endpoint, idempotency_key, req_hash, 200, jsonable_encoder(result))
+    except BaseException:
+        db.rollback()
+        if idempotency_key is not None:
+            idempotency.abandon(db, user_id, endpoint, idempotency_key)
+        raise
+
+    if on_commit is not None:
+        on_commit()
+    return result
+
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> models.User:
+    """
+    現在のユーザーを取得
+    リクエストのセッションに紐づいたUser（current_skinも読み込み済み）を返す。
+    同じリクエスト内のcrud関数はセッションのidentity mapからこれを再利用するので、ユーザーの読み込みは1回で済む。
+    """
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -163,16 +472,17 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except JWTError:
         raise credentials_exception from None
     
-    user = crud.get_user_by_id(db, UUID(user_id))
+    user = crud.get_user_with_skin(db, UUID(user_id))
     if user is None:
         raise credentials_exception
     
-    # AuthorInfo形式で返す
-    return schemas.AuthorInfo(
-        id=user.id,
-        username=user.username,
-        icon_url=user.icon_url
-    )
+    return user
+
+
+def require_admin(api_key: Optional[str] = Depends(admin_key_header)) -> None:
+    """管理者用APIキーを検証"""
+    if not ADMIN_API_KEY or not api_key or not secrets.compare_digest(api_key, ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Admin privileges required")
 
 
 # Endpoints
@@ -180,6 +490,16 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
 def read_root():
     return {"message": "Welcome to Numyp API! Go to /docs to see Swagger UI."}
 
+# Health
+@app.get("/health/ready")
+def readiness():
+    """
+    ウォームアップが終わり、DB接続とインデックスの構築が成功していれば200、まだなら503
+    起動フェーズごとの経過時間（time_to_first_requestなど）も返す
+    """
+    status = startup.metrics.snapshot()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
 # Auth
 @app.post("/auth/signup")
 def signup(user: schemas.UserCreate, db: Session = Depends(get_db)):
@@ -234,29 +554,42 @@ def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Sessio
 
 
 # Spots
+def _list_spot_to_response(spot: models.Spot) -> schemas.SpotResponse:
+    # 一覧は軽量化のため description は None にする
+    return _spot_to_response(spot, include_description=False)
+
+
 @app.get("/spots", response_model=List[schemas.SpotResponse])
 def get_spots(
-    lat: Optional[float] = None,
-    lng: Optional[float] = None,
-    radius: Optional[float] = None,
+    request: Request,
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lng: Optional[float] = Query(None, ge=-180, le=180),
+    radius: Optional[float] = Query(None, gt=0, description="meters"),
+    shape: str = Query("full", pattern="^(full|table)$", description="table: 投稿者・スキンを正規化した列指向の形式"),
     db: Session = Depends(get_db)
 ):
     """
     Map表示用 スポット一覧を返す あえて情報量は少なめにしてます
-    (lat, lng, radiusパラメータは将来の検索機能用に予約)
+    lat, lng, radius を指定すると半径radius[m]以内の新着順に絞り込む
+    Accept: application/msgpack でMessagePack、Accept-Encodingに応じてbrotli/gzip圧縮して返す。
     """
+    geo_params = (lat, lng, radius)
+    if any(p is not None for p in geo_params) and not all(p is not None for p in geo_params):
+        raise HTTPException(status_code=400, detail="lat, lng and radius must be specified together")
+
     # データベースからスポットを取得
     db_spots = crud.get_spots(db, lat=lat, lng=lng, radius=radius)
     
-    # レスポンス形式に変換（軽量化のため description は None にする）
-    return [_spot_to_response(spot, include_description=False) for spot in db_spots]
+    return wire_format.spot_list_response(request, db_spots, shape, _list_spot_to_response)
 
 
 @app.post("/upload/image")
 async def upload_image(
-    _current_user: Annotated[schemas.AuthorInfo, Depends(get_current_user)],
+    current_user: Annotated[models.User, Depends(get_current_user)],
     file: UploadFile = File(...),
-    folder: str = Query("images", description="Folder name in R2 bucket")
+    folder: str = Query("images", description="Folder name in R2 bucket"),
+    idempotency_key: Annotated[Optional[str], Header(max_length=255)] = None,
+    db: Session = Depends(get_db)
 ):
     """
     画像ファイルをR2にアップロードする
@@ -264,6 +597,7 @@ async def upload_image(
     Args:
         file: アップロードする画像ファイル
         folder: R2バケット内のフォルダ名（デフォルト: images）
+        idempotency_key: 再送時に同じキーを指定すると、再アップロードせず前回の結果を返す
     
     Returns:
         アップロードされた画像の公開 URL
@@ -283,72 +617,449 @@ async def upload_image(
     if len(file_content) > max_size:
         raise HTTPException(status_code=400, detail="File size exceeds 10MB limit")
     
+    def upload():
+        try:
+            # R2にアップロード
+            r2_storage = get_r2_storage()
+            image_url = r2_storage.upload_file(
+                file_data=BytesIO(file_content),
+                filename=file.filename,
+                content_type=file.content_type,
+                folder=folder
+            )
+            
+            return {
+                "success": True,
+                "image_url": image_url,
+                "filename": file.filename,
+                "content_type": file.content_type,
+                "size": len(file_content)
+            }
+            
+        except R2UnavailableError as e:
+            raise _storage_unavailable(e) from None
+        except Exception:
+            logger.exception("Failed to upload image")
+            raise HTTPException(status_code=500, detail="Failed to upload image")
+
+    req_hash = idempotency.request_hash(folder, file.content_type or "", file.filename or "", file_content)
+    # キーの確保・保存（DB）とR2へのアップロードはブロックするので、イベントループの外で実行する
+    return await run_in_threadpool(
+        _run_idempotent, db, current_user.id, "POST /upload/image", idempotency_key, req_hash, upload
+    )
+
+
+@app.post("/upload/presign", response_model=schemas.PresignedUploadResponse)
+def create_presigned_upload(
+    request: schemas.PresignedUploadRequest,
+    current_user: Annotated[models.User, Depends(get_current_user)],
+):
+    """
+    スポット画像をクライアントからR2へ直接アップロードするための署名付きURLを発行する
+    
+    返されたupload_urlへheadersを付けてPUTした後、image_keyを POST /spots に渡す。
+    形式・サイズ・保存先キーは署名に含まれるため、指定と異なるアップロードはR2側で拒否される。
+    """
+    extension = IMAGE_EXTENSIONS.get(request.content_type)
+    if extension is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type. Allowed types: {', '.join(IMAGE_EXTENSIONS)}"
+        )
+
+    image_key = f"spots/{current_user.id}/{uuid4()}{extension}"
     try:
-        # R2にアップロード
         r2_storage = get_r2_storage()
-        image_url = r2_storage.upload_file(
-            file_data=BytesIO(file_content),
-            filename=file.filename,
-            content_type=file.content_type,
-            folder=folder
+        upload_url = r2_storage.generate_presigned_upload(
+            image_key,
+            content_type=request.content_type,
+            content_length=request.content_length,
+            expires_in=PRESIGNED_UPLOAD_EXPIRES_SECONDS
         )
-        
-        return {
-            "success": True,
-            "image_url": image_url,
-            "filename": file.filename,
-            "content_type": file.content_type,
-            "size": len(file_content)
-        }
-        
     except Exception:
-        # TODO: ログに例外を記録 (logger.exception("Failed to upload image"))
-        raise HTTPException(status_code=500, detail="Failed to upload image")
+        logger.exception("Failed to create presigned upload URL")
+        raise HTTPException(status_code=500, detail="Failed to create upload URL") from None
+
+    return schemas.PresignedUploadResponse(
+        upload_url=upload_url,
+        headers={
+            "Content-Type": request.content_type,
+            "Content-Length": str(request.content_length),
+        },
+        image_key=image_key,
+        image_url=r2_storage.get_public_url(image_key),
+        expires_in=PRESIGNED_UPLOAD_EXPIRES_SECONDS,
+    )
+
+
+@app.get("/spots/search", response_model=List[schemas.SpotResponse])
+def search_spots(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=50, description="検索文字列（空白区切りでAND）"),
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lng: Optional[float] = Query(None, ge=-180, le=180),
+    radius: Optional[float] = Query(None, gt=0, description="検索半径（メートル）"),
+    limit: int = Query(20, ge=1, le=50),
+    shape: str = Query("full", pattern="^(full|table)$"),
+    db: Session = Depends(get_db)
+):
+    """
+    タイトル・説明文でスポットを検索する（入力途中の前方一致にも対応）
+    lat, lng, radiusを指定すると範囲内に限定する。
+    レスポンス形式は /spots と同じくネゴシエーションされる。
+    """
+    geo_params = (lat, lng, radius)
+    if any(p is not None for p in geo_params) and not all(p is not None for p in geo_params):
+        raise HTTPException(status_code=400, detail="lat, lng and radius must be specified together")
+
+    index = search_index.get_search_index()
+    if not index.ready:
+        raise HTTPException(status_code=503, detail="Search index is not ready")
+
+    spot_ids = index.search(q, limit=limit, lat=lat, lng=lng, radius=radius)
+    spots = {spot.id: spot for spot in crud.get_spots_by_ids(db, spot_ids)}
+
+    results = []
+    for spot_id in spot_ids:
+        spot = spots.get(spot_id)
+        if spot is None:
+            # 他ワーカーで削除済み
+            index.remove(spot_id)
+            continue
+        results.append(spot)
+    return wire_format.spot_list_response(request, results, shape, _list_spot_to_response)
+
+
+@app.get("/spots/hot", response_model=List[schemas.RankedSpotResponse])
+def get_hot_spots(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius: float = Query(3000, gt=0, le=5000, description="検索半径（メートル）"),
+    limit: int = Query(20, ge=1, le=50),
+    db: Session = Depends(get_db)
+):
+    """
+    近くの人気スポットをスコア順に返す
+    スコアはセルごとに事前計算された順位キーに距離の減衰を掛けたもの。
+    半径は周辺MAX_RINGセルで覆える範囲まで（hot_spots.max_radius_m、超えると400）。
+    """
+    ranking = hot_spots.get_hot_spot_ranking()
+    if not ranking.ready:
+        raise HTTPException(status_code=503, detail="Ranking is not ready")
+
+    try:
+        ranked = ranking.top(lat, lng, radius, limit=limit)
+    except ValueError as e:
+        # 高緯度ではセルが小さく、周辺セルで覆える半径が5000mより狭い
+        raise HTTPException(status_code=400, detail=str(e)) from None
+    spots = {spot.id: spot for spot in crud.get_spots_by_ids(db, [spot_id for spot_id, _, _ in ranked])}
+
+    results = []
+    for spot_id, score, distance in ranked:
+        spot = spots.get(spot_id)
+        if spot is None:
+            # 他ワーカーで削除済み
+            ranking.remove(spot_id)
+            continue
+        results.append(schemas.RankedSpotResponse(
+            spot=_spot_to_response(spot, include_description=False),
+            score=score,
+            distance_m=round(distance, 1),
+        ))
+    return results
+
+
+@app.get("/spots/nearest", response_model=List[schemas.NearbySpotResponse])
+def get_nearest_spots(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    k: int = Query(10, ge=1, le=100),
+    max_distance: Optional[float] = Query(None, gt=0, le=100_000, description="検索半径（メートル、省略時は無制限）"),
+    min_rating: Optional[int] = Query(None, ge=1, le=5),
+    crowd_level: Optional[List[schemas.CrowdLevel]] = Query(None, description="指定した混雑度のスポットに限定する（複数可）"),
+    db: Session = Depends(get_db)
+):
+    """近いスポットを距離順にk件返す"""
+    index = spot_index.get_spot_index()
+    if not index.ready:
+        raise HTTPException(status_code=503, detail="Spot index is not ready")
+
+    nearest = index.nearest(
+        lat, lng, k,
+        max_distance=max_distance,
+        min_rating=min_rating,
+        crowd_levels=[level.value for level in crowd_level] if crowd_level else None,
+    )
+    spots = {spot.id: spot for spot in crud.get_spots_by_ids(db, [spot_id for spot_id, _ in nearest])}
+
+    results = []
+    for spot_id, distance in nearest:
+        spot = spots.get(spot_id)
+        if spot is None:
+            # 他ワーカーで削除済み
+            index.remove(spot_id)
+            continue
+        results.append(schemas.NearbySpotResponse(
+            spot=_spot_to_response(spot, include_description=False),
+            distance_m=round(distance, 1),
+        ))
+    return results
+
+
+@app.post("/spots/along-route", response_model=List[schemas.RouteSpotResponse])
+def get_spots_along_route(
+    request: schemas.AlongRouteRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    ルート（折れ線）から width_m 以内のスポットを、ルートの始点から近い順に返す
+    徒歩・自転車程度の長さのルートを想定している。
+    """
+    index = spot_index.get_spot_index()
+    if not index.ready:
+        raise HTTPException(status_code=503, detail="Spot index is not ready")
+
+    hits = index.along_route(
+        [(point.lat, point.lng) for point in request.points],
+        request.width_m,
+        request.limit,
+        min_rating=request.min_rating,
+        crowd_levels=[level.value for level in request.crowd_levels] if request.crowd_levels else None,
+    )
+    spots = {spot.id: spot for spot in crud.get_spots_by_ids(db, [spot_id for spot_id, _, _ in hits])}
+
+    results = []
+    for spot_id, distance, along in hits:
+        spot = spots.get(spot_id)
+        if spot is None:
+            # 他ワーカーで削除済み
+            index.remove(spot_id)
+            continue
+        results.append(schemas.RouteSpotResponse(
+            spot=_spot_to_response(spot, include_description=False),
+            distance_m=round(distance, 1),
+            along_m=round(along, 1),
+        ))
+    return results
+
+
+@app.get("/spots/stream")
+async def stream_spots(
+    request: Request,
+    bbox: str = Query(..., description="表示範囲 min_lat,min_lng,max_lat,max_lng"),
+):
+    """
+    表示範囲のタイルで購読し、スポットの作成・更新・削除をServer-Sent Eventsで受け取る
+    
+    イベント名は created / updated / deleted。配信が追いつかなかった場合は resync が届くので、
+    クライアントは一覧を取り直す。表示範囲が変わったら接続し直す。
+    """
+    try:
+        min_lat, min_lng, max_lat, max_lng = (float(v) for v in bbox.split(","))
+        tiles = spot_stream.tiles_for_bbox(min_lat, min_lng, max_lat, max_lng)
+    except ValueError as e:
+        detail = str(e) if "too large" in str(e) else "bbox must be min_lat,min_lng,max_lat,max_lng"
+        raise HTTPException(status_code=400, detail=detail) from None
+
+    hub = spot_stream.get_hub()
+    subscription = hub.subscribe(tiles)
 
+    async def event_stream():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), timeout=spot_stream.KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # プロキシに切断されないようにコメント行を送る
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {message['type']}\ndata: {json.dumps(message, ensure_ascii=False)}\n\n"
+        finally:
+            hub.unsubscribe(subscription)
 
-@app.get("/spots/{spot_id}", response_model=schemas.SpotResponse)
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/tiles/{z}/{x}/{y}.png", responses={200: {"content": {"image/png": {}}}}, response_class=Response)
+async def get_heatmap_tile(
+    z: int,
+    x: int,
+    y: int,
+    mode: str = Query(heatmap.MODE_DENSITY, pattern="^(density|crowd)$", description="density: 投稿の密度 / crowd: 混雑度"),
+):
+    """
+    ズームアウト時にピンの代わりに表示するヒートマップタイル（256px、Webメルカトル）
+    キャッシュ済みならそのまま返し、描画はスレッドプールで行う。
+    """
+    if not heatmap.MIN_ZOOM <= z <= heatmap.MAX_ZOOM or not (0 <= x < 1 << z and 0 <= y < 1 << z):
+        raise HTTPException(status_code=404, detail="Tile not found")
+    tiles = heatmap.get_heatmap()
+    if not tiles.ready:
+        raise HTTPException(status_code=503, detail="Heatmap is not ready")
+
+    png = tiles.cached_tile(mode, z, x, y)
+    if png is None:
+        png = await run_in_threadpool(tiles.tile, mode, z, x, y)
+    return Response(
+        content=png,
+        media_type="image/png",
+        headers={"Cache-Control": f"public, max-age={TILE_MAX_AGE_SECONDS}"},
+    )
+
+
+@app.get("/spots/{spot_id}", response_model=schemas.SpotDetailResponse)
 def get_spot_detail(spot_id: UUID, db: Session = Depends(get_db)):
     """
     詳細表示用 特定のスポットの全情報を返す。
-    ピンをタップした後に呼ばれるAPI。
+    ピンをタップした後に呼ばれるAPI。タップ数を数え、閲覧・タップ・チェックインの回数も返す。
     """
-    # データベースからスポットを取得
-    spot = crud.get_spot_by_id(db, spot_id)
+    spot = _get_spot_details(db, [spot_id]).get(spot_id)
     if not spot:
         raise HTTPException(status_code=404, detail="Spot not found")
-    
-    return _spot_to_response(spot, include_description=True)
+
+    counters = spot_counters.get_spot_counters()
+    counters.increment(spot_id, spot_counters.TAPS)
+    return schemas.SpotDetailResponse(
+        **dict(spot),
+        counts=schemas.SpotCounts(**counters.get_counts(db, spot_id)),
+    )
+
+
+@app.post("/spots/batch", response_model=List[schemas.SpotResponse])
+def get_spot_details_batch(request: schemas.SpotBatchRequest, db: Session = Depends(get_db)):
+    """
+    複数スポットの詳細をまとめて返す（表示中のピンの先読み用）
+    存在しないIDは結果から除かれ、順序はリクエストのidsに従う。
+    """
+    spots = _get_spot_details(db, request.ids)
+    found = [spot_id for spot_id in dict.fromkeys(request.ids) if spot_id in spots]
+    # 表示中のピンの詳細を先読みした = 閲覧として数える
+    spot_counters.get_spot_counters().increment_many(found, spot_counters.VIEWS)
+    return [spots[spot_id] for spot_id in found]
+
+
+@app.post("/spots/{spot_id}/crowd-reports", response_model=schemas.CrowdReportResponse, status_code=202)
+def report_crowd_level(
+    spot_id: UUID,
+    request: schemas.CrowdReportRequest,
+    current_user: Annotated[models.User, Depends(get_current_user)],
+    db: Session = Depends(get_db)
+):
+    """
+    スポットの今の混雑度をレポートする（誰でも可。スポットの近くに居る必要がある）
+    表示される混雑度は、投稿者の値と直近のレポートの時間減衰付き平均としてバックグラウンドで更新される。
+    """
+    spot = crud.get_spot_by_id(db, spot_id)
+    if spot is None:
+        raise HTTPException(status_code=404, detail="Spot not found")
+    if geo.haversine_m(request.lat, request.lng, spot.latitude, spot.longitude) > crowd_reports.REPORT_RADIUS_M:
+        raise HTTPException(status_code=400, detail="Too far from the spot")
+    if not crowd_reports.claim_report(current_user.id, spot_id):
+        raise HTTPException(status_code=429, detail="Already reported recently")
+
+    current_level = schemas.CrowdLevel(spot.crowd_level.value)
+    crud.add_crowd_report(db, spot_id, request.crowd_level.value)
+    return schemas.CrowdReportResponse(message="Thanks for the report!", crowd_level=current_level)
+
+
+@app.post("/spots/{spot_id}/checkin", response_model=schemas.CheckinResponse)
+def check_in_spot(
+    spot_id: UUID,
+    request: schemas.CheckinRequest,
+    current_user: Annotated[models.User, Depends(get_current_user)],
+    db: Session = Depends(get_db)
+):
+    """
+    スポットにチェックインしてコインを受け取る
+    スポットの近く（CHECKIN_RADIUS_M以内）に居る必要があり、同じスポットには24時間に1回まで
+    """
+    spot = crud.get_spot_by_id(db, spot_id)
+    if spot is None:
+        raise HTTPException(status_code=404, detail="Spot not found")
+    if geo.haversine_m(request.lat, request.lng, spot.latitude, spot.longitude) > crud.CHECKIN_RADIUS_M:
+        raise HTTPException(status_code=400, detail="Too far from the spot")
+
+    user_id = current_user.id
+    if not crud.check_in(db, user_id, spot):
+        raise HTTPException(status_code=409, detail="Already checked in recently")
+
+    spot_counters.get_spot_counters().increment(spot_id, spot_counters.CHECKINS)
+    return schemas.CheckinResponse(
+        message="Checked in!",
+        earned_coins=crud.CHECKIN_REWARD,
+        current_balance=crud.get_coin_balance(db, user_id).coins,
+    )
+
+def _duplicate_spot_error(error: crud.DuplicateSpotError) -> HTTPException:
+    """409: 近くの似たスポットを返し、統合（既存のスポットを使う）か allow_duplicate での再送を促す"""
+    return HTTPException(
+        status_code=409,
+        detail={
+            "message": "Similar spots already exist nearby",
+            "candidates": [
+                schemas.DuplicateSpotCandidate(
+                    id=c.spot_id, title=c.title, distance_m=c.distance_m, similarity=c.similarity
+                ).model_dump(mode="json")
+                for c in error.candidates
+            ],
+        },
+    )
+
 
 @app.post("/spots", response_model=schemas.SpotResponse)
 def create_spot(
     spot: schemas.SpotCreate,
-    current_user: Annotated[schemas.AuthorInfo, Depends(get_current_user)],
+    current_user: Annotated[models.User, Depends(get_current_user)],
+    idempotency_key: Annotated[Optional[str], Header(max_length=255)] = None,
     db: Session = Depends(get_db)
 ):
     """
     スポットを作成する。
     入力はフラット出力はネストされた構造にBackend側で変換して保存
     画像がbase64で送られた場合はR2にアップロードする
+    image_keyが指定された場合は直接アップロード済みの画像をHEADで確認して使う
+    Idempotency-Keyを指定した再送では、画像のアップロードもスポットの作成も行わず前回の結果を返す。
     """
-    image_url = _upload_image_from_base64(spot.image_base64, folder="spots") if spot.image_base64 else None
-    
-    # データベースにスポットを作成（image_urlを含む）
-    new_spot = crud.create_spot(db, spot, current_user.id, image_url=image_url)
-    
-    return _spot_to_response(new_spot, include_description=True)
+    def create():
+        # 画像をアップロードする前に、近くに同じスポットが無いか確認する
+        try:
+            crud.ensure_not_duplicate(db, spot)
+        except crud.DuplicateSpotError as e:
+            raise _duplicate_spot_error(e) from None
+
+        image_url = _resolve_spot_image(spot.image_base64, spot.image_key, current_user.id)
+        
+        # データベースにスポットを作成（image_urlを含む）。コミットは_run_idempotentで行う
+        new_spot = crud.add_spot(db, current_user, spot, image_url)
+        created.append(spot_events.SpotSnapshot.from_model(new_spot))
+        
+        return _spot_to_response(new_spot, include_description=True)
+
+    def notify():
+        for snapshot in created:
+            spot_events.emit(spot_events.SPOT_CREATED, snapshot)
+
+    created: List[spot_events.SpotSnapshot] = []
+    req_hash = idempotency.request_hash(spot.model_dump_json())
+    return _run_idempotent(db, current_user.id, "POST /spots", idempotency_key, req_hash, create, on_commit=notify)
 
 
 @app.put("/spots/{spot_id}", response_model=schemas.SpotResponse)
 def update_spot(
     spot_id: UUID,
     spot_update: schemas.SpotUpdate,
-    current_user: Annotated[schemas.AuthorInfo, Depends(get_current_user)],
+    current_user: Annotated[models.User, Depends(get_current_user)],
     db: Session = Depends(get_db)
 ):
     """
     スポットを更新（作成者のみ）。
     """
-    image_url = _upload_image_from_base64(spot_update.image_base64, folder="spots") if spot_update.image_base64 else None
+    image_url = _resolve_spot_image(spot_update.image_base64, spot_update.image_key, current_user.id)
     try:
         updated_spot = crud.update_spot(
             db,
@@ -368,7 +1079,7 @@ def update_spot(
 @app.delete("/spots/{spot_id}")
 def delete_spot(
     spot_id: UUID,
-    current_user: Annotated[schemas.AuthorInfo, Depends(get_current_user)],
+    current_user: Annotated[models.User, Depends(get_current_user)],
     db: Session = Depends(get_db)
 ):
     """
@@ -384,35 +1095,156 @@ def delete_spot(
     return {"success": True, "id": str(spot_id)}
 
 
+@app.post("/sync/batch", response_model=schemas.SyncBatchResponse)
+def sync_batch(
+    request: schemas.SyncBatchRequest,
+    current_user: Annotated[models.User, Depends(get_current_user)],
+    db: Session = Depends(get_db)
+):
+    """
+    オフライン中に溜めたスポットの作成・更新・削除を、送られた順に1リクエストで反映する
+    
+    変更ごとに、個別のAPI（POST/PUT/DELETE /spots）で送った場合と同じステータスを返す。
+    失敗した変更があっても残りは続ける（503の変更はサーバー側の障害なので、同じ順番で再送する）。
+    画像は POST /upload/presign で先にアップロードし、image_key で参照する（image_base64 は使えない）。
+    作成に spot_id（クライアントで生成したUUID）を付けると、再送しても二重に作成されない。
+    """
+    mutations = request.mutations
+    image_urls = {}
+    rejected = {}
+    # 画像の確認（R2へのHEAD）はトランザクションを開く前に済ませる
+    for i, mutation in enumerate(mutations):
+        payload = mutation.spot or mutation.changes
+        if payload is None:
+            continue
+        if payload.image_base64 is not None:
+            rejected[i] = offline_sync.MutationResult(
+                400, mutation.spot_id, "image_base64 is not supported; upload via /upload/presign and pass image_key"
+            )
+        elif payload.image_key is not None:
+            try:
+                image_urls[i] = _verify_uploaded_image(payload.image_key, current_user.id)
+            except HTTPException as e:
+                rejected[i] = offline_sync.MutationResult(e.status_code, mutation.spot_id, e.detail)
+
+    results = offline_sync.apply_batch(db, current_user, mutations, image_urls, rejected)
+
+    # 作成・更新したスポットは1回のクエリで読み直して返す
+    returned_ids = [
+        result.spot_id for mutation, result in zip(mutations, results)
+        if result.ok and mutation.op != schemas.SyncOperation.DELETE
+    ]
+    spots = {spot.id: spot for spot in crud.get_spots_by_ids(db, returned_ids)}
+
+    items = []
+    for mutation, result in zip(mutations, results):
+        spot = spots.get(result.spot_id) if result.ok else None
+        items.append(schemas.SyncMutationResult(
+            client_id=mutation.client_id,
+            op=mutation.op,
+            status_code=result.status_code,
+            spot_id=result.spot_id,
+            spot=_spot_to_response(spot, include_description=True) if spot is not None else None,
+            error=result.error,
+            candidates=[
+                schemas.DuplicateSpotCandidate(
+                    id=c.spot_id, title=c.title, distance_m=c.distance_m, similarity=c.similarity
+                )
+                for c in result.candidates
+            ] if result.candidates else None,
+        ))
+    applied = sum(1 for result in results if result.ok)
+    return schemas.SyncBatchResponse(results=items, applied=applied, failed=len(results) - applied)
+
+
 # Users
 @app.get("/users/me", response_model=schemas.UserResponse)
 def read_users_me(
-    current_user: Annotated[schemas.AuthorInfo, Depends(get_current_user)],
+    current_user: Annotated[models.User, Depends(get_current_user)],
     db: Session = Depends(get_db)
 ):
     """現在のユーザー情報を取得"""
-    user = crud.get_user_by_id(db, current_user.id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    user = current_user
     
-    # 現在のスキン情報を取得
+    # 現在のスキン情報を取得（認証時に読み込み済み）
     current_skin = user.current_skin if user.current_skin else crud.get_or_create_default_skin(db)
+    balance = crud.get_coin_balance(db, user.id)
+    post_stats = crud.get_spot_stats(db, user.id)
     
     return schemas.UserResponse(
         id=user.id,
         username=user.username,
         icon_url=user.icon_url,
-        wallet=schemas.UserWallet(coins=user.coins),
+        wallet=schemas.UserWallet(coins=balance.coins),
         current_skin=schemas.SkinInfo(
             id=current_skin.id,
             name=current_skin.name,
             image_url=current_skin.image_url
+        ),
+        stats=schemas.UserStats(
+            spot_count=post_stats.spot_count,
+            average_rating=(
+                round(post_stats.spot_rating_sum / post_stats.spot_count, 2) if post_stats.spot_count else None
+            ),
+            coins_earned=balance.coins_earned
         )
     )
 
+
+def _encode_cursor(row) -> str:
+    """(created_at, id) のキーセットページング用カーソル"""
+    raw = f"{row.created_at.isoformat()}|{row.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), UUID(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from None
+
+
+@app.get("/users/me/spots", response_model=schemas.SpotPage)
+def read_my_spots(
+    current_user: Annotated[models.User, Depends(get_current_user)],
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    db: Session = Depends(get_db)
+):
+    """
+    自分の投稿を新しい順に返す（マイページ用）
+    (author_id, created_at) インデックスを使ったキーセットページングなので、ページが進んでも遅くならない。
+    """
+    before = _decode_cursor(cursor) if cursor else None
+    spots = crud.get_spots_by_author(db, current_user.id, limit=limit + 1, before=before)
+    next_cursor = _encode_cursor(spots[limit - 1]) if len(spots) > limit else None
+    return schemas.SpotPage(
+        items=[_spot_to_response(spot, include_description=True) for spot in spots[:limit]],
+        next_cursor=next_cursor,
+    )
+
+@app.get("/users/me/coins/history", response_model=schemas.CoinHistoryPage)
+def read_my_coin_history(
+    current_user: Annotated[models.User, Depends(get_current_user)],
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    db: Session = Depends(get_db)
+):
+    """コインの増減（投稿報酬・購入など）を新しい順に返す"""
+    before = _decode_cursor(cursor) if cursor else None
+    entries = crud.get_coin_history(db, current_user.id, limit=limit + 1, before=before)
+    next_cursor = _encode_cursor(entries[limit - 1]) if len(entries) > limit else None
+    return schemas.CoinHistoryPage(
+        coins=crud.get_coin_balance(db, current_user.id).coins,
+        items=entries[:limit],
+        next_cursor=next_cursor,
+    )
+
 @app.post("/users/me/icon")
 async def update_user_icon(
-    current_user: Annotated[schemas.AuthorInfo, Depends(get_current_user)],
+    current_user: Annotated[models.User, Depends(get_current_user)],
     db: Session = Depends(get_db),
     file: UploadFile = File(...)
 ):
@@ -456,19 +1288,16 @@ async def update_user_icon(
         )
         
         # データベースを更新
-        user = crud.get_user_by_id(db, current_user.id)
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # TODO: 古いアイコンの削除を実装（ストレージ容量の節約）
-        # if user.icon_url and not user.icon_url.startswith("defaults/"):
-        #     try:
-        #         r2_storage.delete_file(user.icon_url)
-        #     except Exception:
-        #         logger.warning("Failed to delete old icon, continuing anyway")
+        user_id = current_user.id
+
+        # 古いアイコンは削除キューに積み、バックグラウンドでまとめて削除する
+        crud.enqueue_storage_deletion(db, current_user.icon_url, "user_icon_replaced")
         
-        user.icon_url = icon_url
+        current_user.icon_url = icon_url
         db.commit()
+
+        # キャッシュ済みのスポット詳細に古いアイコンが残らないようにする
+        spot_detail_cache.invalidate_where(lambda detail: detail.author.id == user_id)
         
         return {
             "success": True,
@@ -478,47 +1307,202 @@ async def update_user_icon(
         
     except HTTPException:
         raise
+    except R2UnavailableError as e:
+        raise _storage_unavailable(e) from None
     except Exception as e:
         logger.exception("Failed to update icon")
         raise HTTPException(status_code=500, detail="Failed to update icon") from e
 
+@app.get("/shop/items", response_model=schemas.ShopCatalogResponse)
+def get_shop_items(
+    current_user: Annotated[models.User, Depends(get_current_user)],
+    db: Session = Depends(get_db)
+):
+    """
+    ショップのスキン一覧と、自分が所有・装備しているかを返す
+    カタログはプロセス内にキャッシュし、所有状況は user_skins を1回引いたビット列をキャッシュする。
+    """
+    shop = shop_catalog.get_shop_catalog()
+    catalog = shop.get(db)
+    owned = shop.owned_bitmap(db, catalog, current_user.id)
+    return schemas.ShopCatalogResponse(
+        version=catalog.version,
+        items=[
+            schemas.ShopItem(
+                **skin,
+                owned=bool(owned >> position & 1),
+                equipped=skin["id"] == current_user.current_skin_id,
+            )
+            for position, skin in enumerate(catalog.skins)
+        ],
+    )
+
+
 @app.post("/shop/buy")
 def buy_item(
     request: schemas.BuyItemRequest,
-    current_user: Annotated[schemas.AuthorInfo, Depends(get_current_user)],
+    current_user: Annotated[models.User, Depends(get_current_user)],
+    idempotency_key: Annotated[Optional[str], Header(max_length=255)] = None,
     db: Session = Depends(get_db)
 ):
-    """アイテム（スキン）を購入"""
-    # スキンを購入
-    success = crud.purchase_skin(db, current_user.id, request.item_id)
-    
-    if not success:
-        user = crud.get_user_by_id(db, current_user.id)
-        skin = crud.get_skin_by_id(db, request.item_id)
-        
-        # ユーザーの存在チェック
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        if not skin:
-            raise HTTPException(status_code=404, detail="Item not found")
-        if crud.user_owns_skin(db, current_user.id, request.item_id):
-            raise HTTPException(status_code=400, detail="Already owned")
-        if user.coins < skin.price:
-            raise HTTPException(status_code=400, detail="Not enough coins")
-        
+    """アイテム（スキン）を購入（Idempotency-Key対応）"""
+    user_id = current_user.id
+    req_hash = idempotency.request_hash(str(request.item_id))
+    return _run_idempotent(
+        db, user_id, "POST /shop/buy", idempotency_key, req_hash,
+        lambda: _buy_item(db, current_user, request),
+        on_commit=lambda: shop_catalog.get_shop_catalog().invalidate_ownership(user_id),
+    )
+
+
+def _buy_item(db: Session, current_user: models.User, request: schemas.BuyItemRequest) -> dict:
+    user_id = current_user.id
+    # 残高の確認と引き落としはcrud側でusersの行をロックして行う
+    result = crud.purchase_skin(db, user_id, request.item_id)
+
+    if result is crud.PurchaseResult.USER_NOT_FOUND:
+        raise HTTPException(status_code=404, detail="User not found")
+    if result is crud.PurchaseResult.SKIN_NOT_FOUND:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if result is crud.PurchaseResult.ALREADY_OWNED:
+        raise HTTPException(status_code=400, detail="Already owned")
+    if result is crud.PurchaseResult.INSUFFICIENT_COINS:
+        raise HTTPException(status_code=400, detail="Not enough coins")
+    if result is not crud.PurchaseResult.SUCCESS:
         raise HTTPException(status_code=400, detail="Purchase failed")
-    
-    # 更新後のコイン残高を取得
-    user = crud.get_user_by_id(db, current_user.id)
-    if not user:
-        # 購入は成功したがユーザー取得に失敗（理論上は発生しない）
-        return {"success": True, "message": f"Item {request.item_id} purchased!"}
-    
+
     return {
         "success": True,
-        "remaining_coins": user.coins,
+        "remaining_coins": crud.get_coin_balance(db, user_id).coins,
         "message": f"Item {request.item_id} purchased!"
     }
 
+# Admin
+@app.post("/admin/spots/import", response_model=schemas.SpotImportResponse)
+def import_spots(
+    _admin: Annotated[None, Depends(require_admin)],
+    file: UploadFile = File(...),
+    fmt: Optional[str] = Query(None, alias="format", pattern="^(ndjson|csv)$", description="ndjson or csv (省略時はファイル名から推定)"),
+    author_id: Optional[UUID] = Query(None, description="author_idが無い行に使う投稿者"),
+    batch_size: int = Query(bulk_import.DEFAULT_BATCH_SIZE, ge=100, le=50000),
+    reward_coins: bool = Query(True, description="投稿報酬のコインを付与するか"),
+    db: Session = Depends(get_db)
+):
+    """
+    スポットをNDJSON/CSVから一括インポートする（管理者のみ）
+    
+    行はストリーミングで検証され、batch_size件ごとに1トランザクションでINSERTされる。
+    不正な行はスキップされ、行番号付きでerrorsに返される（先頭100件まで）。
+    """
+    fmt = fmt or bulk_import.detect_format(file.filename, file.content_type)
+    stream = TextIOWrapper(file.file, encoding="utf-8-sig", newline="")
+    try:
+        return bulk_import.import_spots(
+            db,
+            stream,
+            fmt,
+            default_author_id=author_id,
+            batch_size=batch_size,
+            reward_coins=reward_coins,
+        )
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="File must be UTF-8 encoded") from None
+    finally:
+        # UploadFile側でクローズするため、ラッパーだけ切り離す
+        stream.detach()
+
+
+@app.get("/admin/spots/export")
+def export_spots(
+    _admin: Annotated[None, Depends(require_admin)],
+    fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    gzip: bool = Query(False, description="gzip圧縮して返すか"),
+    min_lat: Optional[float] = Query(None, ge=-90, le=90),
+    max_lat: Optional[float] = Query(None, ge=-90, le=90),
+    min_lng: Optional[float] = Query(None, ge=-180, le=180),
+    max_lng: Optional[float] = Query(None, ge=-180, le=180),
+    since: Optional[datetime] = Query(None, description="created_atの下限（含む）"),
+    until: Optional[datetime] = Query(None, description="created_atの上限（含まない）"),
+):
+    """
+    スポットを全件ストリーミングでエクスポートする（管理者のみ）
+    
+    サーバーサイドカーソルで読みながら書き出すため、件数に関わらずメモリ使用量は一定。
+    """
+    filters = spot_export.ExportFilter(
+        min_lat=min_lat, max_lat=max_lat,
+        min_lng=min_lng, max_lng=max_lng,
+        since=since, until=until,
+    )
+    filename = f"spots.{fmt}" + (".gz" if gzip else "")
+    return StreamingResponse(
+        spot_export.stream_export(fmt, filters, compress=gzip),
+        media_type="application/gzip" if gzip else spot_export.MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.post("/admin/profiles/token", response_model=schemas.ProfileTokenResponse)
+def create_profile_token(
+    _admin: Annotated[None, Depends(require_admin)],
+    ttl_seconds: int = Query(600, ge=1, le=profiling.MAX_TOKEN_TTL_SECONDS),
+):
+    """
+    計測用トークンを発行する（管理者のみ）
+    
+    返したヘッダーを付けたリクエストは、有効期限までサンプリング率に関係なく計測される。
+    """
+    try:
+        token, expires_at = profiling.create_token(ttl_seconds)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
+    return {"token": token, "header": profiling.TOKEN_HEADER, "expires_at": expires_at}
+
+
+@app.get("/admin/profiles", response_model=List[schemas.RequestProfileSummary])
+def list_request_profiles(
+    _admin: Annotated[None, Depends(require_admin)],
+    route: Optional[str] = Query(None, description="ルートのパステンプレートで絞り込む（例: /spots/{spot_id}）"),
+    min_duration_ms: Optional[float] = Query(None, ge=0),
+    limit: int = Query(50, ge=1, le=500),
+    db: Session = Depends(get_db)
+):
+    """計測したリクエストの一覧（新しい順、管理者のみ）"""
+    query = db.query(models.RequestProfile).options(
+        load_only(*(getattr(models.RequestProfile, name) for name in schemas.RequestProfileSummary.model_fields))
+    )
+    if route is not None:
+        query = query.filter(models.RequestProfile.route == route)
+    if min_duration_ms is not None:
+        query = query.filter(models.RequestProfile.duration_ms >= min_duration_ms)
+    return query.order_by(models.RequestProfile.created_at.desc()).limit(limit).all()
+
+
+@app.get("/admin/profiles/{profile_id}")
+def download_request_profile(
+    profile_id: UUID,
+    _admin: Annotated[None, Depends(require_admin)],
+    fmt: str = Query("collapsed", alias="format", pattern="^(collapsed|json)$"),
+    db: Session = Depends(get_db)
+):
+    """
+    計測結果をダウンロードする（管理者のみ）
+    
+    - collapsed: スタックのサンプル（flamegraph.pl / speedscope で開ける）
+    - json: 概要・スタック・SQLとR2の呼び出し
+    """
+    profile = db.get(models.RequestProfile, profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if fmt == "collapsed":
+        return Response(
+            content=profile.stacks,
+            media_type="text/plain; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'},
+        )
+    summary = schemas.RequestProfileSummary.model_validate(profile)
+    return {**jsonable_encoder(summary), "stacks": profile.stacks, **json.loads(profile.calls)}
+
+startup.metrics.mark("imported")
+
 # uvicorn main:app --reload
@@ -0,0 +1,270 @@
+"""
+スキーマのマイグレーション
+
+既存のDBに対してモデルの変更（列・インデックス）を順番に適用する。
+適用済みのバージョンは schema_migrations テーブルに記録し、各マイグレーションは
+途中で失敗しても再実行できるよう、既に適用されている変更はスキップする。
+
+    python init_db.py            # 足りないテーブルの作成と未適用のマイグレーション
+    python init_db.py --reset    # すべて作り直す（データは消える）
+"""
+import logging
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+
+from sqlalchemy import bindparam, exists, inspect, select, text, update
+from sqlalchemy.engine import Connection
+
+import crud
+import geo
+import models
+from database import Base, get_engine
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+# ===== ヘルパー =====
+def _has_column(conn: Connection, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def _index_names(conn: Connection, table: str) -> set:
+    return {ix["name"] for ix in inspect(conn).get_indexes(table)}
+
+
+def _drop_index_if_exists(conn: Connection, table: str, name: str) -> None:
+    if name in _index_names(conn, table):
+        conn.execute(text(f"DROP INDEX {conn.dialect.identifier_preparer.quote(name)}"))
+        conn.commit()
+        logger.info("Dropped index %s", name)
+
+
+def _create_model_indexes(conn: Connection, model) -> None:
+    """モデルに定義されたインデックスのうち、まだ無いものを作成する"""
+    existing = _index_names(conn, model.__tablename__)
+    for index in model.__table__.indexes:
+        if index.name not in existing:
+            index.create(conn)
+            conn.commit()
+            logger.info("Created index %s", index.name)
+
+
+# ===== マイグレーション =====
+def _spots_grid_key_and_sharded_indexes(conn: Connection) -> None:
+    """
+    spots.grid_key の追加と、挿入がホットスポットにならないインデックスへの置き換え
+    - 単調増加の created_at / updated_at はハッシュシャーディング
+    - 緯度・経度の単一列インデックスを (grid_key, created_at) の複合インデックスに置き換え
+    - 一覧で読む列をSTORINGしたカバリングインデックス
+    """
+    if not _has_column(conn, "spots", "grid_key"):
+        conn.execute(text("ALTER TABLE spots ADD COLUMN grid_key BIGINT"))
+        conn.commit()
+
+    # 既存のスポットのgrid_keyを埋める
+    spots = models.Spot.__table__
+    stmt = (
+        update(spots)
+        .where(spots.c.id == bindparam("spot_id"))
+        .values(grid_key=bindparam("new_grid_key"))
+    )
+    filled = 0
+    while True:
+        rows = conn.execute(
+            select(spots.c.id, spots.c.latitude, spots.c.longitude)
+            .where(spots.c.grid_key.is_(None))
+            .limit(BACKFILL_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        conn.execute(stmt, [
+            {"spot_id": spot_id, "new_grid_key": geo.grid_key(lat, lng)} for spot_id, lat, lng in rows
+        ])
+        conn.commit()
+        filled += len(rows)
+    if filled:
+        logger.info("Backfilled grid_key for %d spots", filled)
+
+    # SQLiteはALTER COLUMNに対応していない（開発用）
+    if conn.dialect.name != "sqlite":
+        conn.execute(text("ALTER TABLE spots ALTER COLUMN grid_key SET NOT NULL"))
+        conn.commit()
+
+    for name in ("ix_spots_latitude", "ix_spots_longitude", "ix_spots_created_at"):
+        _drop_index_if_exists(conn, "spots", name)
+    _drop_index_if_exists(conn, "idempotency_keys", "ix_idempotency_keys_created_at")
+    _drop_index_if_exists(conn, "storage_deletions", "ix_storage_deletions_created_at")
+
+    for model in (models.Spot, models.IdempotencyRecord, models.StorageDeletion):
+        _create_model_indexes(conn, model)
+
+
+def _user_spot_aggregates(conn: Connection) -> None:
+    """
+    users の投稿集計列と (author_id, created_at) インデックスの追加
+    coins_earned は過去の履歴が無いため、投稿報酬（投稿数 × SPOT_POST_REWARD）で初期化する
+    """
+    for column in ("spot_count", "spot_rating_sum", "coins_earned"):
+        if not _has_column(conn, "users", column):
+            conn.execute(text(f"ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+            conn.commit()
+
+    # 集計は何度実行しても同じ結果になる
+    conn.execute(text(
+        "UPDATE users SET "
+        "spot_count = (SELECT COUNT(*) FROM spots WHERE spots.author_id = users.id), "
+        "spot_rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM spots WHERE spots.author_id = users.id)"
+    ))
+    conn.execute(
+        text("UPDATE users SET coins_earned = spot_count * :reward"),
+        {"reward": crud.SPOT_POST_REWARD},
+    )
+    conn.commit()
+
+    _create_model_indexes(conn, models.Spot)
+
+
+def _user_skins_index(conn: Connection) -> None:
+    """user_skins の (user_id, skin_id) インデックス"""
+    _create_model_indexes(conn, models.UserSkin)
+
+
+def _coin_ledger_opening_balances(conn: Connection) -> None:
+    """
+    coin_ledger（テーブルは create_all で作成済み）に、既存の残高を精算済みの開始残高として記録する
+    履歴の合計が残高と一致するようにするため。既に開始残高があるユーザーはスキップする
+    """
+    users = models.User.__table__
+    ledger = models.CoinLedger.__table__
+    now = datetime.now(timezone.utc)
+    recorded = 0
+    while True:
+        rows = conn.execute(
+            select(users.c.id, users.c.coins)
+            .where(users.c.coins != 0)
+            .where(~exists().where(
+                ledger.c.user_id == users.c.id,
+                ledger.c.reason == crud.COIN_REASON_OPENING_BALANCE,
+            ))
+            .limit(BACKFILL_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        conn.execute(ledger.insert(), [
+            {
+                "id": uuid.uuid4(),
+                "user_id": user_id,
+                "delta": coins,
+                "reason": crud.COIN_REASON_OPENING_BALANCE,
+                "settled": True,
+                "created_at": now,
+            }
+            for user_id, coins in rows
+        ])
+        conn.commit()
+        recorded += len(rows)
+    if recorded:
+        logger.info("Recorded opening coin balances for %d users", recorded)
+
+
+def _spots_author_crowd_level(conn: Connection) -> None:
+    """spots.author_crowd_level の追加（既存のスポットは今の crowd_level を投稿者の値とする）"""
+    if not _has_column(conn, "spots", "author_crowd_level"):
+        # SQLiteではENUMは文字列（開発用）
+        column_type = "VARCHAR(6)" if conn.dialect.name == "sqlite" else "crowdlevelenum"
+        conn.execute(text(f"ALTER TABLE spots ADD COLUMN author_crowd_level {column_type}"))
+        conn.commit()
+    conn.execute(text("UPDATE spots SET author_crowd_level = crowd_level WHERE author_crowd_level IS NULL"))
+    conn.commit()
+    if conn.dialect.name != "sqlite":
+        conn.execute(text("ALTER TABLE spots ALTER COLUMN author_crowd_level SET NOT NULL"))
+        conn.commit()
+
+
+def _user_spot_stats(conn: Connection) -> None:
+    """
+    投稿の集計を users の列から user_spot_stats（テーブルは create_all で作成済み）に移す
+    spots から数え直して入れ直すので、何度実行しても同じ結果になる。
+    users.spot_count / spot_rating_sum は書き込まれなくなるが、切り戻せるよう列は残す
+    """
+    conn.execute(models.UserSpotStats.__table__.delete())
+    conn.execute(text(
+        "INSERT INTO user_spot_stats (user_id, spot_count, spot_rating_sum) "
+        "SELECT author_id, COUNT(*), SUM(rating) FROM spots GROUP BY author_id"
+    ))
+    conn.commit()
+
+
+def _skins_updated_at(conn: Connection) -> None:
+    """skins.updated_at の追加（既存のスキンは作成日時で初期化する）"""
+    if not _has_column(conn, "skins", "updated_at"):
+        conn.execute(text("ALTER TABLE skins ADD COLUMN updated_at TIMESTAMP"))
+        conn.commit()
+    conn.execute(text("UPDATE skins SET updated_at = created_at WHERE updated_at IS NULL"))
+    conn.commit()
+    if conn.dialect.name != "sqlite":
+        conn.execute(text("ALTER TABLE skins ALTER COLUMN updated_at SET NOT NULL"))
+        conn.commit()
+
+
+# (バージョン, 説明, 適用関数) バージョン順に並べ、追加は末尾に
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "spots.grid_key and hash-sharded indexes", _spots_grid_key_and_sharded_indexes),
+    (2, "users spot aggregates and spots (author_id, created_at) index", _user_spot_aggregates),
+    (3, "user_skins (user_id, skin_id) index", _user_skins_index),
+    (4, "coin_ledger opening balances", _coin_ledger_opening_balances),
+    (5, "spots.author_crowd_level", _spots_author_crowd_level),
+    (6, "user_spot_stats", _user_spot_stats),
+    (7, "skins.updated_at", _skins_updated_at),
+]
+
+
+# ===== 実行 =====
+def applied_versions(conn: Connection) -> set:
+    return set(conn.scalars(select(models.SchemaMigration.version)))
+
+
+def _record(conn: Connection, version: int, description: str) -> None:
+    conn.execute(models.SchemaMigration.__table__.insert().values(version=version, description=description))
+    conn.commit()
+
+
+def stamp(engine=None) -> None:
+    """モデルから作成したばかりのDBに、すべてのマイグレーションを適用済みとして記録する"""
+    engine = engine or get_engine()
+    with engine.connect() as conn:
+        done = applied_versions(conn)
+        for version, description, _apply in MIGRATIONS:
+            if version not in done:
+                _record(conn, version, description)
+
+
+def upgrade(engine=None) -> List[int]:
+    """
+    足りないテーブルを作成し、未適用のマイグレーションを順に適用する
+
+    Returns:
+        適用したバージョンのリスト
+    """
+    engine = engine or get_engine()
+    fresh = not inspect(engine).has_table(models.Spot.__tablename__)
+    # 既存のテーブルは変更せず、無いテーブル（とそのインデックス）だけを作る
+    Base.metadata.create_all(bind=engine)
+    if fresh:
+        stamp(engine)
+        return []
+
+    applied = []
+    with engine.connect() as conn:
+        done = applied_versions(conn)
+        for version, description, apply in MIGRATIONS:
+            if version in done:
+                continue
+            logger.info("Applying migration %d: %s", version, description)
+            apply(conn)
+            _record(conn, version, description)
+            applied.append(version)
+    return applied
@@ -1,6 +1,8 @@
-from sqlalchemy import Column, String, Integer, Float, DateTime, ForeignKey, Enum as SQLEnum
+from sqlalchemy import Column, String, Integer, BigInteger, Boolean, Float, DateTime, ForeignKey, Text, UniqueConstraint, Index, Enum as SQLEnum
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
+from sqlalchemy.schema import CreateIndex
 from datetime import datetime, timezone
 import uuid
 import enum
@@ -15,6 +17,29 @@ class CrowdLevelEnum(str, enum.Enum):
     HIGH = "high"
 
 
+# ===== CockroachDB向けのインデックス =====
+# 単調増加する列（created_atなど）の通常のインデックスは、すべての挿入が末尾の1レンジに集中する。
+# info=HASH_SHARDED を付けたインデックスはCockroachDBではハッシュシャーディング（USING HASH）で作成し、
+# 挿入を複数のレンジ・ノードに分散させる。他のDBでは通常のインデックスになる。
+HASH_SHARDED = {"hash_sharded": True}
+
+
+@compiles(CreateIndex, "cockroachdb")
+def _create_index_cockroachdb(create, compiler, **kw):
+    sql = compiler.visit_create_index(create, **kw)
+    if not create.element.info.get("hash_sharded"):
+        return sql
+    # USING HASH は列リストの直後（STORING/INCLUDE より前）に置く
+    head, sep, tail = sql.partition(" INCLUDE (")
+    return f"{head} USING HASH{sep}{tail}"
+
+
+# 一覧表示（GET /spots）で読む列。一覧用のインデックスにSTORINGしてインデックスだけで返せるようにする
+SPOT_LIST_COLUMNS = [
+    "author_id", "skin_id", "latitude", "longitude", "title", "image_url", "crowd_level", "rating",
+]
+
+
 # Models
 class User(Base):
     __tablename__ = "users"
@@ -24,6 +49,7 @@ class User(Base):
     hashed_password = Column(String(255), nullable=False)
     icon_url = Column(String(500), nullable=True)
     coins = Column(Integer, default=0, nullable=False)
+    coins_earned = Column(Integer, default=0, server_default="0", nullable=False)
     current_skin_id = Column(UUID(as_uuid=True), ForeignKey("skins.id"), nullable=True)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), nullable=False)
@@ -42,6 +68,8 @@ class Skin(Base):
     image_url = Column(String(500), nullable=False)
     price = Column(Integer, default=100, nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+    # ショップのカタログの変更検出に使う（名前・画像・価格の変更でも更新される）
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), nullable=False)
 
     # Relationships
     user_skins = relationship("UserSkin", back_populates="skin")
@@ -60,6 +88,11 @@ class UserSkin(Base):
     user = relationship("User", back_populates="owned_skins")
     skin = relationship("Skin", back_populates="user_skins")
 
+    __table_args__ = (
+        # ユーザーの所有スキン一覧（ショップの所有状況・購入済みチェック）
+        Index("ix_user_skins_user_id_skin_id", user_id, skin_id),
+    )
+
 
 class Spot(Base):
     __tablename__ = "spots"
@@ -69,8 +102,10 @@ class Spot(Base):
     skin_id = Column(UUID(as_uuid=True), ForeignKey("skins.id"), nullable=False)
     
     # Location
-    latitude = Column(Float, nullable=False, index=True)
-    longitude = Column(Float, nullable=False, index=True)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    # geo.grid_key(latitude, longitude)。位置で絞り込むときのインデックスの先頭列
+    grid_key = Column(BigInteger, nullable=False)
     
     # Content
     title = Column(String(50), nullable=False)
@@ -78,12 +113,174 @@ class Spot(Base):
     image_url = Column(String(500), nullable=True)
     
     # Status
+    # 表示する混雑度（投稿者の値と最近の混雑度レポートから crowd_reports.py が定期的に計算する）
     crowd_level = Column(SQLEnum(CrowdLevelEnum), default=CrowdLevelEnum.MEDIUM, nullable=False)
+    # 投稿者が設定した混雑度（レポートが無い・古くなったときはこの値に戻る）
+    author_crowd_level = Column(SQLEnum(CrowdLevelEnum), default=CrowdLevelEnum.MEDIUM, nullable=False)
     rating = Column(Integer, default=3, nullable=False)
     
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False, index=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), nullable=False)
 
     # Relationships
     author = relationship("User", back_populates="spots")
     skin = relationship("Skin")
+
+    __table_args__ = (
+        # 新着順の一覧（位置指定なし）
+        Index("ix_spots_created_at_list", created_at.desc(), info=HASH_SHARDED, postgresql_include=SPOT_LIST_COLUMNS),
+        # 周辺の新着順の一覧
+        Index("ix_spots_grid_created_at", grid_key, created_at.desc(), postgresql_include=SPOT_LIST_COLUMNS),
+        # 自分の投稿一覧（GET /users/me/spots のキーセットページング）
+        Index("ix_spots_author_created_at", author_id, created_at.desc(), id.desc()),
+        # プロセス内インデックスの差分同期（updated_at >= ?）
+        Index("ix_spots_updated_at_hash", updated_at, info=HASH_SHARDED),
+    )
+
+
+class IdempotencyRecord(Base):
+    """Idempotency-Keyごとの処理結果（リトライ時に同じレスポンスを返すため）"""
+    __tablename__ = "idempotency_keys"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
+    endpoint = Column(String(50), nullable=False)
+    key = Column(String(255), nullable=False)
+    request_hash = Column(String(64), nullable=False)
+
+    # 処理中はNULL
+    status_code = Column(Integer, nullable=True)
+    response_body = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "endpoint", "key", name="uq_idempotency_keys_user_endpoint_key"),
+        Index("ix_idempotency_keys_created_at_hash", created_at, info=HASH_SHARDED),
+    )
+
+
+class StorageDeletion(Base):
+    """R2から削除待ちのオブジェクト（バックグラウンドでまとめて削除する）"""
+    __tablename__ = "storage_deletions"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    file_url = Column(String(500), nullable=False)
+    reason = Column(String(50), nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+
+    __table_args__ = (
+        Index("ix_storage_deletions_created_at_hash", created_at, info=HASH_SHARDED),
+    )
+
+
+class UserSpotStats(Base):
+    """
+    ユーザーごとの投稿の集計（COUNTで数えずに済むようにする）
+    スポットの作成・更新・削除と同じトランザクションでUPSERTの加算で更新する。
+    usersの行とは分け、認証・購入で読み書きするusersの行に投稿のたびの書き込みが集中しないようにする
+    """
+    __tablename__ = "user_spot_stats"
+
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    spot_count = Column(Integer, default=0, server_default="0", nullable=False)
+    spot_rating_sum = Column(Integer, default=0, server_default="0", nullable=False)
+
+
+class SpotCounter(Base):
+    """
+    スポットの閲覧・タップ・チェックインの回数
+    リクエストごとには書き込まず、プロセス内で集計してまとめてUPSERTする（spot_counters.py）
+    """
+    __tablename__ = "spot_counters"
+
+    spot_id = Column(UUID(as_uuid=True), ForeignKey("spots.id"), primary_key=True)
+    views = Column(BigInteger, default=0, server_default="0", nullable=False)
+    taps = Column(BigInteger, default=0, server_default="0", nullable=False)
+    checkins = Column(BigInteger, default=0, server_default="0", nullable=False)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+
+
+class CrowdReport(Base):
+    """
+    混雑度レポートの時間バケットごとの件数
+    レポート1件ごとに行を作らず、(スポット, バケット) の行の件数に加算する
+    """
+    __tablename__ = "crowd_reports"
+
+    spot_id = Column(UUID(as_uuid=True), ForeignKey("spots.id"), primary_key=True)
+    # UNIX時刻 // crowd_reports.BUCKET_SECONDS
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    low = Column(Integer, default=0, server_default="0", nullable=False)
+    medium = Column(Integer, default=0, server_default="0", nullable=False)
+    high = Column(Integer, default=0, server_default="0", nullable=False)
+
+    __table_args__ = (
+        # 直近のバケットの走査（単調増加なのでハッシュシャーディング）
+        Index("ix_crowd_reports_bucket_hash", bucket, info=HASH_SHARDED),
+    )
+
+
+class CoinLedger(Base):
+    """
+    コインの増減の記録（追記のみ。金額は書き換えない）
+    残高 = users.coins（精算済みの残高）+ 未精算（settled=False）の delta の合計
+    未精算の記録はバックグラウンドで users.coins にまとめて精算する（coin_ledger.py）
+    """
+    __tablename__ = "coin_ledger"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
+    delta = Column(Integer, nullable=False)
+    reason = Column(String(32), nullable=False)
+    # 関連するスポットやスキンのID
+    ref_id = Column(UUID(as_uuid=True), nullable=True)
+    settled = Column(Boolean, default=False, server_default="false", nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+
+    __table_args__ = (
+        # 履歴（新しい順のキーセットページング）
+        Index("ix_coin_ledger_user_created_at", user_id, created_at.desc(), id.desc()),
+        # 残高の計算と精算で未精算の記録だけを引く
+        Index(
+            "ix_coin_ledger_unsettled", user_id,
+            postgresql_where=settled.is_(False), sqlite_where=settled.is_(False),
+        ),
+    )
+
+
+class RequestProfile(Base):
+    """サンプリングで計測したリクエストのプロファイル（profiling.py）"""
+    __tablename__ = "request_profiles"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    method = Column(String(10), nullable=False)
+    path = Column(String(500), nullable=False)
+    # マッチしたルートのパステンプレート（例: /spots/{spot_id}）
+    route = Column(String(200), nullable=True)
+    status_code = Column(Integer, nullable=False)
+    duration_ms = Column(Float, nullable=False)
+    # "token" または "sampled"
+    trigger = Column(String(10), nullable=False)
+    sample_count = Column(Integer, nullable=False)
+    sql_count = Column(Integer, nullable=False)
+    r2_count = Column(Integer, nullable=False)
+    # collapsed stacks 形式
+    stacks = Column(Text, nullable=False)
+    # SQL・R2の呼び出し（JSON）
+    calls = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+
+    __table_args__ = (
+        Index("ix_request_profiles_created_at_hash", created_at, info=HASH_SHARDED),
+    )
+
+
+class SchemaMigration(Base):
+    """適用済みのマイグレーション（migrations.py）"""
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(200), nullable=False)
+    applied_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
@@ -0,0 +1,161 @@
+"""
+オフライン中に溜めたスポットの変更の一括反映（POST /sync/batch）
+
+- 送られた順に適用し、COMMIT_EVERY 件ごとに1トランザクションでコミットする
+- 各変更は適用前に存在・権限・重複を確認し、失敗した変更だけを個別のステータスで返して残りは続ける
+- 想定外のエラー（DBの障害など）ではそのトランザクションを戻し、戻した変更と残りの変更を503として返す
+  （クライアントは503の変更だけを同じ順番で再送すればよい）
+- 画像は POST /upload/presign で先にアップロードしておき、image_key で参照する。
+  確認（HEAD）はトランザクションの外で呼び出し元が済ませ、URLを渡す
+- 作成で spot_id を指定すると、同じ作成の再送は既存のスポットを返す（再接続時の二重作成を防ぐ）
+"""
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy.orm import Session
+
+import crud
+import models
+import schemas
+import spot_events
+
+logger = logging.getLogger(__name__)
+
+COMMIT_EVERY = 50
+
+NOT_APPLIED = "Not applied because of a server error; retry this mutation"
+
+
+@dataclass
+class MutationResult:
+    """変更1件の結果（status_code は同じ変更を個別のAPIで送った場合のステータス）"""
+    status_code: int
+    spot_id: Optional[UUID] = None
+    error: Optional[str] = None
+    candidates: Optional[List[crud.DuplicateCandidate]] = None
+    # コミット後に通知するイベント（作成・更新はコミット直前の値を通知する）
+    event_kind: Optional[str] = None
+    spot: Optional[models.Spot] = None
+    snapshot: Optional[spot_events.SpotSnapshot] = None
+    previous_location: Optional[Tuple[float, float]] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+
+def _apply(
+    db: Session,
+    user: models.User,
+    mutation: schemas.SyncMutation,
+    image_url: Optional[str],
+) -> MutationResult:
+    if mutation.op == schemas.SyncOperation.CREATE:
+        if mutation.spot_id is not None:
+            existing = db.get(models.Spot, mutation.spot_id)
+            if existing is not None:
+                if existing.author_id == user.id:
+                    # 前回の同期で作成済み（レスポンスを受け取れなかった再送）
+                    return MutationResult(200, existing.id)
+                return MutationResult(409, mutation.spot_id, "spot_id is already in use")
+        try:
+            crud.ensure_not_duplicate(db, mutation.spot)
+        except crud.DuplicateSpotError as e:
+            return MutationResult(409, error="Similar spots already exist nearby", candidates=e.candidates)
+        db_spot = crud.add_spot(db, user, mutation.spot, image_url, spot_id=mutation.spot_id)
+        return MutationResult(200, db_spot.id, event_kind=spot_events.SPOT_CREATED, spot=db_spot)
+
+    try:
+        db_spot = crud.get_own_spot(db, mutation.spot_id, user.id)
+    except ValueError:
+        return MutationResult(404, mutation.spot_id, "Spot not found")
+    except PermissionError:
+        return MutationResult(403, mutation.spot_id, "Forbidden")
+
+    if mutation.op == schemas.SyncOperation.UPDATE:
+        previous_location = (db_spot.latitude, db_spot.longitude)
+        crud.apply_spot_update(db, db_spot, mutation.changes, image_url)
+        db.flush()
+        return MutationResult(
+            200, db_spot.id, event_kind=spot_events.SPOT_UPDATED, spot=db_spot, previous_location=previous_location,
+        )
+
+    snapshot = crud.remove_spot(db, db_spot)
+    db.flush()
+    return MutationResult(200, db_spot.id, event_kind=spot_events.SPOT_DELETED, snapshot=snapshot)
+
+
+def _commit(db: Session, applied: List[MutationResult]) -> None:
+    """トランザクションをコミットし、適用した変更のイベントを通知する"""
+    # コミットで属性が期限切れになる前にスナップショットを取る
+    for result in applied:
+        if result.spot is not None:
+            result.snapshot = spot_events.SpotSnapshot.from_model(result.spot, result.previous_location)
+            result.spot = None
+    db.commit()
+    for result in applied:
+        if result.event_kind is not None:
+            spot_events.emit(result.event_kind, result.snapshot)
+
+
+def apply_batch(
+    db: Session,
+    user: models.User,
+    mutations: List[schemas.SyncMutation],
+    image_urls: Dict[int, str],
+    rejected: Dict[int, MutationResult],
+) -> List[MutationResult]:
+    """
+    変更を順番に適用する
+
+    Args:
+        image_urls: 変更の番号 -> 確認済みの画像URL
+        rejected: 呼び出し元で既に失敗とした変更（画像の確認に失敗したなど）。適用せずにそのまま返す
+
+    Returns:
+        変更ごとの結果（mutationsと同じ順番）
+    """
+    results: List[Optional[MutationResult]] = [None] * len(mutations)
+    # 現在のトランザクションで適用した変更 (番号, 結果)
+    pending: List[Tuple[int, MutationResult]] = []
+
+    def fail_pending_and_rest(start: int) -> None:
+        db.rollback()
+        for i, _result in pending:
+            results[i] = MutationResult(503, mutations[i].spot_id, NOT_APPLIED)
+        pending.clear()
+        for i in range(start, len(mutations)):
+            if results[i] is None:
+                results[i] = rejected.get(i) or MutationResult(503, mutations[i].spot_id, NOT_APPLIED)
+
+    for i, mutation in enumerate(mutations):
+        if i in rejected:
+            results[i] = rejected[i]
+            continue
+        try:
+            result = _apply(db, user, mutation, image_urls.get(i))
+        except Exception:
+            logger.exception("Failed to apply sync mutation %s (%s)", mutation.client_id, mutation.op.value)
+            fail_pending_and_rest(i)
+            return results
+        results[i] = result
+        if result.event_kind is not None:
+            pending.append((i, result))
+
+        if len(pending) >= COMMIT_EVERY:
+            try:
+                _commit(db, [r for _, r in pending])
+            except Exception:
+                logger.exception("Failed to commit sync batch")
+                fail_pending_and_rest(i + 1)
+                return results
+            pending.clear()
+
+    try:
+        _commit(db, [r for _, r in pending])
+    except Exception:
+        logger.exception("Failed to commit sync batch")
+        fail_pending_and_rest(len(mutations))
+    return results
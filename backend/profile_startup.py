@@ -0,0 +1,72 @@
+# 起動時のインポート時間の内訳を表示するスクリプト
+# 使い方: python profile_startup.py [--module main] [--top 20]
+#
+# `python -X importtime` の出力を集計し、トップレベルのパッケージごとの合計時間と
+# 対象モジュールが直接インポートしているモジュールの累積時間を表示します。
+
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+
+def _run_importtime(module: str):
+    """別プロセスでモジュールをインポートし、(自身の時間us, 累積us, 深さ, 名前) を返す"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=Path(__file__).parent,
+        env=os.environ.copy(),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "import failed")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="起動時のインポート時間の内訳を表示します")
+    parser.add_argument("--module", default="main", help="計測するモジュール（デフォルト: main）")
+    parser.add_argument("--top", type=int, default=20, help="表示する件数")
+    args = parser.parse_args(argv)
+
+    rows = _run_importtime(args.module)
+    target = next((r for r in rows if r[3] == args.module), None)
+    total_us = target[1] if target else sum(r[0] for r in rows)
+
+    by_package = defaultdict(int)
+    for self_us, _cumulative_us, _depth, name in rows:
+        by_package[name.split(".")[0]] += self_us
+
+    print(f"import {args.module}: {total_us / 1000:.1f} ms\n")
+    print("パッケージ別（自身の時間の合計）")
+    for name, us in sorted(by_package.items(), key=lambda kv: kv[1], reverse=True)[:args.top]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+    # importtimeはインポートが完了した順に出力するので、対象モジュールの直前にある1段深い行が直接のインポート
+    if target:
+        target_depth = target[2]
+        direct = []
+        for row in reversed(rows[:rows.index(target)]):
+            if row[2] <= target_depth:
+                break
+            if row[2] == target_depth + 1:
+                direct.append(row)
+        print(f"\n{args.module} が直接インポートしているモジュール（累積時間）")
+        for _self_us, cumulative_us, _depth, name in sorted(direct, key=lambda r: r[1], reverse=True)[:args.top]:
+            print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
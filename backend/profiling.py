@@ -0,0 +1,395 @@
+"""
+リクエスト単位のサンプリングプロファイラ（オプトイン）
+
+- PROFILING_SAMPLE_RATE（0〜1）の確率、または有効な X-Profile-Token ヘッダーが付いたリクエストだけを計測する
+  トークンは POST /admin/profiles/token で発行する（PROFILING_SECRET による署名付き・有効期限付き）
+- 計測中はサンプラースレッドが SAMPLE_INTERVAL_SECONDS ごとに、そのリクエストを実行しているスレッド
+  （イベントループ上のタスク・スレッドプールのワーカー）のスタックを記録する。
+  対象のリクエスト以外は止めず、計測していないときはスレッド自体が動かない
+- 同じリクエスト中に発行されたSQLとR2の呼び出しを所要時間付きで記録する
+- 結果は collapsed stacks 形式（flamegraph.pl や speedscope でそのまま開ける）で request_profiles に保存し、
+  GET /admin/profiles で一覧・ダウンロードできる
+
+どちらの設定も無い場合はミドルウェアもSQL・R2のフックも登録しないので、無効時のコストは無い。
+"""
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, event
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import models
+from database import SessionLocal
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 計測するリクエストの割合（0で無効）
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+# X-Profile-Token の署名鍵（未設定の場合はトークンでの計測を無効化）
+PROFILING_SECRET = os.getenv("PROFILING_SECRET")
+
+TOKEN_HEADER = "X-Profile-Token"
+MAX_TOKEN_TTL_SECONDS = 24 * 3600
+SAMPLE_INTERVAL_SECONDS = 0.005
+MAX_STACK_DEPTH = 128
+# 1リクエストで記録するSQL・R2の呼び出しの上限（超えた分は件数だけ数える）
+MAX_RECORDED_CALLS = 500
+MAX_STATEMENT_LENGTH = 2000
+PROFILE_RETENTION = timedelta(days=7)
+PURGE_INTERVAL_SECONDS = 3600
+
+# 計測しないパス（ヘルスチェックと計測結果の取得自体）
+UNPROFILED_PATH_PREFIXES = ("/health/", "/admin/profiles")
+
+TRIGGER_TOKEN = "token"
+TRIGGER_SAMPLED = "sampled"
+
+
+def enabled() -> bool:
+    return PROFILING_SAMPLE_RATE > 0 or bool(PROFILING_SECRET)
+
+
+# ===== トークン =====
+def _sign(expires: int) -> str:
+    return hmac.new(PROFILING_SECRET.encode(), str(expires).encode(), hashlib.sha256).hexdigest()
+
+
+def create_token(ttl_seconds: int) -> tuple:
+    """
+    計測用のトークンを発行する
+
+    Returns:
+        (トークン, 有効期限)
+    """
+    if not PROFILING_SECRET:
+        raise ValueError("PROFILING_SECRET is not configured")
+    expires = int(time.time()) + min(ttl_seconds, MAX_TOKEN_TTL_SECONDS)
+    return f"{expires}.{_sign(expires)}", datetime.fromtimestamp(expires, timezone.utc)
+
+
+def verify_token(token: str) -> bool:
+    if not PROFILING_SECRET:
+        return False
+    expires, _, signature = token.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _sign(int(expires)))
+
+
+# ===== 計測中のリクエスト =====
+class RequestProfile:
+    """1リクエスト分の計測結果"""
+
+    def __init__(self, method: str, path: str, trigger: str, task: Optional[asyncio.Task], loop_thread_id: int):
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.route: Optional[str] = None
+        self.status_code = 500
+        self.duration_ms = 0.0
+        self.task = task
+        self.loop_thread_id = loop_thread_id
+        self.started = time.perf_counter()
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.sql: List[dict] = []
+        self.r2: List[dict] = []
+        self.dropped_calls = 0
+        self._lock = threading.Lock()
+
+    def add_sample(self, stack: str) -> None:
+        # サンプラースレッドからだけ呼ばれる
+        self.stacks[stack] += 1
+        self.samples += 1
+
+    def add_call(self, calls: List[dict], call: dict) -> None:
+        call["at_ms"] = round((call.pop("started") - self.started) * 1000, 3)
+        with self._lock:
+            if len(self.sql) + len(self.r2) >= MAX_RECORDED_CALLS:
+                self.dropped_calls += 1
+                return
+            calls.append(call)
+
+    def collapsed(self) -> str:
+        """collapsed stacks 形式（"フレーム;フレーム;... 件数" を1行ずつ）"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_current: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar("request_profile", default=None)
+
+
+def current() -> Optional[RequestProfile]:
+    return _current.get()
+
+
+# ===== サンプラー =====
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _worker_profile(frame) -> Optional[RequestProfile]:
+    """
+    スレッドプールのワーカーが実行中のリクエスト
+    anyioのワーカーは呼び出し元のコンテキスト（context.run(func, *args)）で関数を実行するので、
+    スタックを遡ってそのコンテキストに入っている計測対象を取り出す
+    """
+    while frame is not None:
+        if "context" in frame.f_code.co_varnames:
+            context = frame.f_locals.get("context")
+            if isinstance(context, contextvars.Context):
+                return context.get(_current)
+        frame = frame.f_back
+    return None
+
+
+class _Sampler:
+    """計測中のリクエストがある間だけ動くサンプリングスレッド"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL_SECONDS):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._active: Dict[int, RequestProfile] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._active[id(profile)] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._active.pop(id(profile), None)
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = dict(self._active)
+            loop_threads = {profile.loop_thread_id for profile in active.values()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if thread_id in loop_threads:
+                    profile = self._loop_profile(thread_id, active)
+                else:
+                    profile = _worker_profile(frame)
+                if profile is not None and id(profile) in active:
+                    profile.add_sample(_collapse(frame))
+            del frame
+            time.sleep(self._interval)
+
+    @staticmethod
+    def _loop_profile(thread_id: int, active: Dict[int, RequestProfile]) -> Optional[RequestProfile]:
+        """イベントループのスレッドは、計測対象のタスクが実行中のときだけ記録する"""
+        for profile in active.values():
+            if profile.loop_thread_id == thread_id and profile.task is not None:
+                if asyncio.current_task(profile.task.get_loop()) is profile.task:
+                    return profile
+        return None
+
+
+_sampler = _Sampler()
+
+
+# ===== SQL・R2のフック =====
+_hooks_lock = threading.Lock()
+_sql_hooks_installed = False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    started = conn.info.get("profile_started")
+    if profile is None or not started:
+        return
+    begin = started.pop()
+    profile.add_call(profile.sql, {
+        "statement": statement[:MAX_STATEMENT_LENGTH],
+        "executemany": executemany,
+        "rows": cursor.rowcount,
+        "started": begin,
+        "duration_ms": round((time.perf_counter() - begin) * 1000, 3),
+    })
+
+
+def install_sql_hooks() -> None:
+    """すべてのエンジンのSQLを計測対象のリクエストに記録する（有効時のみ登録する）"""
+    global _sql_hooks_installed
+    with _hooks_lock:
+        if _sql_hooks_installed:
+            return
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _sql_hooks_installed = True
+
+
+def _before_r2_call(model, context, params=None, **kwargs):
+    if _current.get() is not None:
+        context["profile_started"] = time.perf_counter()
+
+
+def _after_r2_call(model, context, http_response=None, **kwargs):
+    profile = _current.get()
+    begin = context.get("profile_started")
+    if profile is None or begin is None:
+        return
+    profile.add_call(profile.r2, {
+        "operation": model.name,
+        "status": getattr(http_response, "status_code", None),
+        "started": begin,
+        "duration_ms": round((time.perf_counter() - begin) * 1000, 3),
+    })
+
+
+def instrument_boto_client(client) -> None:
+    """boto3クライアントの呼び出しを計測対象のリクエストに記録する（無効時は何もしない）"""
+    if not enabled():
+        return
+    client.meta.events.register("before-call.s3", _before_r2_call)
+    client.meta.events.register("after-call.s3", _after_r2_call)
+
+
+@contextmanager
+def r2_transfer(operation: str, object_key: str):
+    """
+    マネージド転送（upload_fileobj）を1件の呼び出しとして記録する
+    転送はs3transferの内部スレッドで実行され、個々のリクエストはフックで拾えないため
+    """
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    begin = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        profile.add_call(profile.r2, {
+            "operation": operation,
+            "key": object_key,
+            "status": status,
+            "started": begin,
+            "duration_ms": round((time.perf_counter() - begin) * 1000, 3),
+        })
+
+
+# ===== ミドルウェア =====
+class ProfilingMiddleware:
+    """対象のリクエストだけを計測し、レスポンスを返し終えてから結果を保存する"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        install_sql_hooks()
+
+    @staticmethod
+    def _trigger(scope: Scope) -> Optional[str]:
+        if scope["path"].startswith(UNPROFILED_PATH_PREFIXES):
+            return None
+        header = TOKEN_HEADER.lower().encode()
+        for name, value in scope["headers"]:
+            if name == header:
+                return TRIGGER_TOKEN if verify_token(value.decode("latin-1")) else None
+        if PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE:
+            return TRIGGER_SAMPLED
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        trigger = self._trigger(scope) if scope["type"] == "http" else None
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(
+            scope["method"], scope["path"], trigger, asyncio.current_task(), threading.get_ident(),
+        )
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+            await send(message)
+
+        token = _current.set(profile)
+        _sampler.add(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _sampler.remove(profile)
+            _current.reset(token)
+            profile.duration_ms = (time.perf_counter() - profile.started) * 1000
+            route = scope.get("route")
+            profile.route = getattr(route, "path", None)
+            try:
+                await run_in_threadpool(save_profile, profile)
+            except Exception:
+                logger.exception("Failed to save request profile for %s %s", profile.method, profile.path)
+
+
+# ===== 保存 =====
+def save_profile(profile: RequestProfile) -> None:
+    db = SessionLocal()
+    try:
+        db.add(models.RequestProfile(
+            method=profile.method,
+            path=profile.path[:500],
+            route=profile.route,
+            status_code=profile.status_code,
+            duration_ms=profile.duration_ms,
+            trigger=profile.trigger,
+            sample_count=profile.samples,
+            sql_count=len(profile.sql),
+            r2_count=len(profile.r2),
+            stacks=profile.collapsed(),
+            calls=json.dumps({"sql": profile.sql, "r2": profile.r2, "dropped": profile.dropped_calls}),
+        ))
+        db.commit()
+    finally:
+        db.close()
+    logger.info(
+        "Profiled %s %s: %d ms, %d samples, %d SQL, %d R2",
+        profile.method, profile.path, profile.duration_ms, profile.samples, len(profile.sql), len(profile.r2),
+    )
+
+
+def purge_expired() -> int:
+    """保存期間を過ぎた計測結果を削除する（バックグラウンドタスク用）"""
+    db = SessionLocal()
+    try:
+        cutoff = datetime.now(timezone.utc) - PROFILE_RETENTION
+        result = db.execute(delete(models.RequestProfile).where(models.RequestProfile.created_at < cutoff))
+        db.commit()
+        return result.rowcount
+    finally:
+        db.close()
@@ -1,20 +1,138 @@
-import boto3
-from botocore.client import Config
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 import os
-from typing import Optional, BinaryIO
+from typing import Optional, BinaryIO, Iterator, List, Tuple
 from datetime import datetime
 import uuid
 from pathlib import Path
 from dotenv import load_dotenv
 import logging
 import threading
+import time
+from contextlib import contextmanager
+
+import profiling
+from startup import lazy_module
+
+# boto3の読み込みは重いので、クライアントを作るまで遅らせる
+boto3 = lazy_module("boto3")
+botocore_config = lazy_module("botocore.config")
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+# ===== 接続・リトライ・転送の設定（.envで上書きできる） =====
+# 接続プールの上限。同時アップロード数 × R2_MAX_CONCURRENCY より小さいとプールの空き待ちになる
+MAX_POOL_CONNECTIONS = _env_int("R2_MAX_POOL_CONNECTIONS", 50)
+# adaptive: 標準のリトライに加え、スロットリングを受けると送信レートを自動で絞る
+RETRY_MODE = os.getenv("R2_RETRY_MODE", "adaptive")
+MAX_ATTEMPTS = _env_int("R2_MAX_ATTEMPTS", 3)
+CONNECT_TIMEOUT_SECONDS = _env_float("R2_CONNECT_TIMEOUT", 3)
+READ_TIMEOUT_SECONDS = _env_float("R2_READ_TIMEOUT", 10)
+# この大きさを超えるファイルはマルチパートで、パートを並列にアップロードする
+MULTIPART_THRESHOLD_BYTES = _env_int("R2_MULTIPART_THRESHOLD_MB", 8) * 1024 * 1024
+MULTIPART_CHUNKSIZE_BYTES = _env_int("R2_MULTIPART_CHUNKSIZE_MB", 8) * 1024 * 1024
+MAX_TRANSFER_CONCURRENCY = _env_int("R2_MAX_CONCURRENCY", 4)
+# 連続してこの回数失敗したら、BREAKER_RESET_SECONDS の間は呼び出さずに失敗させる
+BREAKER_FAILURE_THRESHOLD = _env_int("R2_BREAKER_FAILURE_THRESHOLD", 5)
+BREAKER_RESET_SECONDS = _env_float("R2_BREAKER_RESET_SECONDS", 30)
+
+# R2側の障害とみなすエラー（4xxはR2が応答しているので含めない）
+_THROTTLING_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "ServiceUnavailable"}
+
+
+class R2UnavailableError(Exception):
+    """R2が障害中と判断して呼び出しを行わなかった（サーキットブレーカーが開いている）"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"R2 is unavailable; retry after {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+
+def _is_outage(error: Exception) -> bool:
+    if isinstance(error, ClientError):
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return status >= 500 or error.response.get("Error", {}).get("Code") in _THROTTLING_CODES
+    # 接続エラー・タイムアウト（EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError など）
+    return isinstance(error, (BotoCoreError, OSError))
+
+
+class CircuitBreaker:
+    """
+    連続した失敗でR2への呼び出しを止めるサーキットブレーカー（スレッドセーフ）
+
+    - closed: 通常どおり呼び出す。障害とみなすエラーが failure_threshold 回続くと open にする
+    - open: reset_seconds の間は呼び出さずに R2UnavailableError を送出する
+    - half-open: 経過後は1件だけ試し、成功すれば closed に戻し、失敗すれば再び open にする
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def _before_call(self) -> None:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            remaining = self._opened_at + self.reset_seconds - time.monotonic()
+            if self._state == self.OPEN and remaining <= 0:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            raise R2UnavailableError(max(remaining, 1.0))
+
+    def _record(self, outage: bool) -> None:
+        with self._lock:
+            self._trial_running = False
+            if not outage:
+                if self._state != self.CLOSED:
+                    logger.info("R2 circuit breaker closed")
+                self._state = self.CLOSED
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning("R2 circuit breaker opened after %d consecutive failures", self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self):
+        """ブロック内のR2呼び出しの成否を記録する（open の間は入らずに R2UnavailableError）"""
+        self._before_call()
+        try:
+            yield
+        except BaseException as e:
+            self._record(isinstance(e, Exception) and _is_outage(e))
+            raise
+        self._record(False)
+
+
 class R2Storage:    
     def __init__(self):
         """R2クライアントの初期化"""
@@ -33,9 +151,25 @@ class R2Storage:
             endpoint_url=self.endpoint_url,
             aws_access_key_id=self.access_key_id,
             aws_secret_access_key=self.secret_access_key,
-            config=Config(signature_version='s3v4'),
+            config=botocore_config.Config(
+                signature_version='s3v4',
+                max_pool_connections=MAX_POOL_CONNECTIONS,
+                retries={"mode": RETRY_MODE, "max_attempts": MAX_ATTEMPTS},
+                connect_timeout=CONNECT_TIMEOUT_SECONDS,
+                read_timeout=READ_TIMEOUT_SECONDS,
+            ),
             region_name='auto'  # R2では'auto'を使用
         )
+        # サブモジュールは find_spec の時点で親パッケージを読み込むため、lazy_module にせずここで読む
+        from boto3.s3.transfer import TransferConfig
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD_BYTES,
+            multipart_chunksize=MULTIPART_CHUNKSIZE_BYTES,
+            max_concurrency=MAX_TRANSFER_CONCURRENCY,
+        )
+        # リクエストの処理中に呼ぶ操作（アップロード・アップロード済みの確認）はR2の障害時に待たせず失敗させる
+        self.breaker = CircuitBreaker()
+        profiling.instrument_boto_client(self.s3_client)
     
     def upload_file(
         self,
@@ -57,6 +191,9 @@ class R2Storage:
         
         Returns:
             アップロードされたファイルの公開URL
+        
+        Raises:
+            R2UnavailableError: R2の障害中（サーキットブレーカーが開いている）
         """
         try:
             # ユニークなファイル名を生成（拡張子は保持）
@@ -76,12 +213,14 @@ class R2Storage:
                 extra_args['ACL'] = 'public-read'
             
             # ファイルをアップロード
-            self.s3_client.upload_fileobj(
-                file_data,
-                self.bucket_name,
-                object_key,
-                ExtraArgs=extra_args
-            )
+            with self.breaker.guard(), profiling.r2_transfer("upload_fileobj", object_key):
+                self.s3_client.upload_fileobj(
+                    file_data,
+                    self.bucket_name,
+                    object_key,
+                    ExtraArgs=extra_args,
+                    Config=self.transfer_config
+                )
             
             # 公開URLを生成
             public_url = self._generate_public_url(object_key)
@@ -135,7 +274,8 @@ class R2Storage:
                     f,
                     self.bucket_name,
                     object_key,
-                    ExtraArgs=extra_args
+                    ExtraArgs=extra_args,
+                    Config=self.transfer_config
                 )
             
             return self._generate_public_url(object_key)
@@ -201,6 +341,110 @@ class R2Storage:
             logger.warning(f"Unexpected error checking file existence: {e}")
             return False
     
+    def generate_presigned_upload(
+        self,
+        object_key: str,
+        content_type: str,
+        content_length: int,
+        expires_in: int = 600
+    ) -> str:
+        """
+        クライアントが直接アップロードするための署名付きPUT URLを生成する
+        
+        Content-TypeとContent-Lengthを署名に含めるため、
+        指定と異なる形式・サイズのアップロードはR2側で拒否される。
+        
+        Args:
+            object_key: アップロード先のオブジェクトキー
+            content_type: 許可するMIMEタイプ
+            content_length: 許可するファイルサイズ（バイト）
+            expires_in: URLの有効期間（秒）
+        
+        Returns:
+            署名付きURL
+        """
+        return self.s3_client.generate_presigned_url(
+            'put_object',
+            Params={
+                'Bucket': self.bucket_name,
+                'Key': object_key,
+                'ContentType': content_type,
+                'ContentLength': content_length,
+            },
+            ExpiresIn=expires_in,
+            HttpMethod='PUT'
+        )
+    
+    def head_object(self, object_key: str) -> Optional[dict]:
+        """
+        オブジェクトのメタデータを取得する
+        
+        Returns:
+            {"content_type": ..., "content_length": ...}（存在しない場合はNone）
+        """
+        try:
+            with self.breaker.guard():
+                response = self.s3_client.head_object(
+                    Bucket=self.bucket_name,
+                    Key=object_key
+                )
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return {
+            "content_type": response.get("ContentType"),
+            "content_length": response.get("ContentLength"),
+        }
+    
+    def delete_files(self, object_keys: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        複数のオブジェクトをまとめて削除する（1リクエスト最大1000件）
+        
+        Args:
+            object_keys: 削除するオブジェクトキー（最大1000件）
+        
+        Returns:
+            (削除できたキー, 削除に失敗したキー)
+        """
+        if not object_keys:
+            return [], []
+        if len(object_keys) > 1000:
+            raise ValueError("delete_objects accepts at most 1000 keys per request")
+        
+        response = self.s3_client.delete_objects(
+            Bucket=self.bucket_name,
+            Delete={"Objects": [{"Key": key} for key in object_keys], "Quiet": True}
+        )
+        # Quietモードではエラーになったキーだけが返る
+        failed = [error["Key"] for error in response.get("Errors", [])]
+        failed_set = set(failed)
+        return [key for key in object_keys if key not in failed_set], failed
+    
+    def list_objects(self, prefix: str) -> Iterator[List[Tuple[str, datetime]]]:
+        """
+        プレフィックス配下のオブジェクトをページ（最大1000件）ごとに返す
+        
+        Args:
+            prefix: 例 "spots/"
+        
+        Returns:
+            (オブジェクトキー, 最終更新日時) のリストのイテレーター
+        """
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            contents = page.get("Contents", [])
+            if contents:
+                yield [(obj["Key"], obj["LastModified"]) for obj in contents]
+    
+    def get_public_url(self, object_key: str) -> str:
+        """オブジェクトキーから公開URLを生成する"""
+        return self._generate_public_url(object_key)
+    
+    def get_object_key(self, file_url: str) -> Optional[str]:
+        """公開URLからオブジェクトキーを取り出す（このバケットのURLでなければNone）"""
+        return self._extract_object_key(file_url)
+    
     def _generate_public_url(self, object_key: str) -> str:
         """
         オブジェクトキーから公開URLを生成する
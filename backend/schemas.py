@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, model_validator
 from typing import Optional, List
 from datetime import datetime
 from enum import Enum
@@ -14,8 +14,8 @@ class CrowdLevel(str, Enum):
 
 # ネスト用 拡張性優先のためclass乱立してます
 class LocationInfo(BaseModel):
-    lat: float = Field(..., description="Latitude")
-    lng: float = Field(..., description="Longitude")
+    lat: float = Field(..., ge=-90, le=90, description="Latitude")
+    lng: float = Field(..., ge=-180, le=180, description="Longitude")
     # address: Optional[str] = None
 
 class ContentInfo(BaseModel):
@@ -43,22 +43,33 @@ class AuthorInfo(BaseModel):
 # API Request Models クライアント→サーバー
 class SpotCreate(BaseModel):
     """スポット投稿用モデル 入力はフラット"""
-    lat: float
-    lng: float
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
     title: str
     description: Optional[str] = None
     image_base64: Optional[str] = Field(None, description="Base64 encoded image string")
+    image_key: Optional[str] = Field(None, max_length=255, description="Object key returned by POST /upload/presign")
     crowd_level: Optional[CrowdLevel] = CrowdLevel.MEDIUM
     rating: Optional[int] = 3
+    allow_duplicate: bool = Field(False, description="Create even if similar spots exist nearby (after the user confirmed the 409 candidates)")
+
+
+class DuplicateSpotCandidate(BaseModel):
+    """近くにある似たスポット（POST /spots の409で返す）"""
+    id: UUID
+    title: str
+    distance_m: float
+    similarity: float = Field(..., description="Title similarity 0-1")
 
 
 class SpotUpdate(BaseModel):
     """スポット更新用モデル(部分更新も許容)"""
-    lat: Optional[float] = None
-    lng: Optional[float] = None
+    lat: Optional[float] = Field(None, ge=-90, le=90)
+    lng: Optional[float] = Field(None, ge=-180, le=180)
     title: Optional[str] = Field(None, min_length=1, max_length=50)
     description: Optional[str] = Field(None, max_length=200)
     image_base64: Optional[str] = Field(None, description="Base64 encoded image string")
+    image_key: Optional[str] = Field(None, max_length=255, description="Object key returned by POST /upload/presign")
     crowd_level: Optional[CrowdLevel] = None
     rating: Optional[int] = Field(None, ge=1, le=5, description="1 to 5 stars")
 
@@ -74,6 +85,74 @@ class BuyItemRequest(BaseModel):
     item_id: UUID
 
 
+class SpotBatchRequest(BaseModel):
+    """スポット詳細の一括取得"""
+    ids: List[UUID] = Field(..., min_length=1, max_length=100)
+
+
+class SyncOperation(str, Enum):
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
+
+
+class SyncMutation(BaseModel):
+    """オフライン中に溜めたスポットの変更1件"""
+    client_id: str = Field(..., min_length=1, max_length=64, description="Client-side ID of this mutation, echoed back in the result")
+    op: SyncOperation
+    spot_id: Optional[UUID] = Field(
+        None,
+        description="Target spot for update/delete. For create, an optional client-generated ID for the new spot "
+                    "(later mutations can refer to it, and replaying the create returns the existing spot)",
+    )
+    spot: Optional[SpotCreate] = Field(None, description="Required for create")
+    changes: Optional[SpotUpdate] = Field(None, description="Required for update")
+
+    @model_validator(mode="after")
+    def _check_payload(self):
+        if self.op == SyncOperation.CREATE and self.spot is None:
+            raise ValueError("spot is required for create")
+        if self.op == SyncOperation.UPDATE and (self.spot_id is None or self.changes is None):
+            raise ValueError("spot_id and changes are required for update")
+        if self.op == SyncOperation.DELETE and self.spot_id is None:
+            raise ValueError("spot_id is required for delete")
+        return self
+
+
+class SyncBatchRequest(BaseModel):
+    """オフライン中の変更の一括反映（順番どおりに適用する）"""
+    mutations: List[SyncMutation] = Field(..., min_length=1, max_length=200)
+
+
+class AlongRouteRequest(BaseModel):
+    """ルート沿いのスポット検索"""
+    points: List[LocationInfo] = Field(..., min_length=2, max_length=1000, description="Route vertices in order")
+    width_m: float = Field(100, gt=0, le=2000, description="Max distance from the route in meters")
+    limit: int = Field(50, ge=1, le=200)
+    min_rating: Optional[int] = Field(None, ge=1, le=5)
+    crowd_levels: Optional[List[CrowdLevel]] = None
+
+
+class PresignedUploadRequest(BaseModel):
+    """直接アップロード用URLの発行"""
+    content_type: str = Field(..., description="image/jpeg, image/png, image/webp, image/gif")
+    content_length: int = Field(..., gt=0, le=10 * 1024 * 1024, description="File size in bytes (max 10MB)")
+
+
+class SpotImportRow(BaseModel):
+    """一括インポート用の1行分 (NDJSON/CSV共通)"""
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
+    title: str = Field(..., min_length=1, max_length=50)
+    description: Optional[str] = Field(None, max_length=200)
+    image_url: Optional[str] = Field(None, max_length=500)
+    crowd_level: CrowdLevel = CrowdLevel.MEDIUM
+    rating: int = Field(3, ge=1, le=5)
+    author_id: Optional[UUID] = None
+    skin_id: Optional[UUID] = None
+    created_at: Optional[datetime] = None
+
+
 # API Response Models サーバー→クライアント
 class SpotResponse(BaseModel):
     """スポット取得用モデル"""
@@ -89,9 +168,57 @@ class SpotResponse(BaseModel):
 
     model_config = ConfigDict(from_attributes=True)
 
+class SpotCounts(BaseModel):
+    """閲覧・タップ・チェックインの回数（数秒〜数十秒遅れて反映される）"""
+    views: int = 0
+    taps: int = 0
+    checkins: int = 0
+
+class SpotDetailResponse(SpotResponse):
+    """スポット詳細（カウンター付き）"""
+    counts: SpotCounts
+
+class RankedSpotResponse(BaseModel):
+    """ランキング付きスポット"""
+    spot: SpotResponse
+    score: float = Field(..., description="0〜1のスコア（評価・混雑度・新しさ・距離）")
+    distance_m: float
+
+class NearbySpotResponse(BaseModel):
+    """距離付きスポット"""
+    spot: SpotResponse
+    distance_m: float
+
+class RouteSpotResponse(BaseModel):
+    """ルート沿いのスポット"""
+    spot: SpotResponse
+    distance_m: float = Field(..., description="Distance from the route")
+    along_m: float = Field(..., description="Distance along the route from its start to the closest point")
+
+class SyncMutationResult(BaseModel):
+    """変更1件の結果（status_code は同じ変更を個別のAPIで送った場合のステータス）"""
+    client_id: str
+    op: SyncOperation
+    status_code: int
+    spot_id: Optional[UUID] = None
+    spot: Optional[SpotResponse] = Field(None, description="The spot after create/update")
+    error: Optional[str] = None
+    candidates: Optional[List[DuplicateSpotCandidate]] = Field(None, description="Similar spots nearby (409 on create)")
+
+class SyncBatchResponse(BaseModel):
+    results: List[SyncMutationResult]
+    applied: int
+    failed: int
+
 class UserWallet(BaseModel):
     coins: int
 
+class UserStats(BaseModel):
+    """投稿の集計"""
+    spot_count: int
+    average_rating: Optional[float] = None
+    coins_earned: int
+
 class UserResponse(BaseModel):
     """ユーザー情報レスポンス"""
     id: UUID
@@ -101,14 +228,109 @@ class UserResponse(BaseModel):
     # Grouping
     wallet: UserWallet
     current_skin: SkinInfo
+    stats: UserStats
+
+    model_config = ConfigDict(from_attributes=True)
+
+class SpotPage(BaseModel):
+    """キーセットページングの1ページ"""
+    items: List[SpotResponse]
+    next_cursor: Optional[str] = Field(None, description="Pass as cursor to get the next page (null on the last page)")
+
+class CoinLedgerEntry(BaseModel):
+    """コインの増減の記録"""
+    id: UUID
+    delta: int
+    reason: str
+    ref_id: Optional[UUID] = None
+    created_at: datetime
 
     model_config = ConfigDict(from_attributes=True)
 
+class CoinHistoryPage(BaseModel):
+    """コインの履歴の1ページ"""
+    coins: int = Field(..., description="Current balance")
+    items: List[CoinLedgerEntry]
+    next_cursor: Optional[str] = Field(None, description="Pass as cursor to get the next page (null on the last page)")
+
+class ShopItem(BaseModel):
+    """ショップの商品（スキン）"""
+    id: UUID
+    name: str
+    image_url: str
+    price: int
+    owned: bool
+    equipped: bool
+
+class ShopCatalogResponse(BaseModel):
+    """ショップのカタログと所有状況"""
+    version: str = Field(..., description="Changes whenever the catalog changes")
+    items: List[ShopItem]
+
+class CrowdReportRequest(BaseModel):
+    """現在の混雑度のレポート"""
+    crowd_level: CrowdLevel
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
+
+class CrowdReportResponse(BaseModel):
+    message: str
+    crowd_level: CrowdLevel = Field(..., description="Currently displayed level (reports are reflected within about a minute)")
+
+class CheckinRequest(BaseModel):
+    """チェックイン時の現在地"""
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
+
 class CheckinResponse(BaseModel):
     message: str
     earned_coins: int
     current_balance: int
 
+class PresignedUploadResponse(BaseModel):
+    """署名付きアップロードURL"""
+    upload_url: str
+    method: str = "PUT"
+    headers: dict = Field(..., description="Headers the client must send with the upload")
+    image_key: str = Field(..., description="Pass this as image_key to POST /spots")
+    image_url: str
+    expires_in: int
+
+class ImportRowError(BaseModel):
+    line: int
+    message: str
+
+class SpotImportResponse(BaseModel):
+    """一括インポート結果"""
+    inserted: int
+    failed: int
+    batches: int
+    coins_awarded: int
+    elapsed_seconds: float
+    errors: List[ImportRowError] = []
+
+class ProfileTokenResponse(BaseModel):
+    """計測用トークン（X-Profile-Tokenヘッダーに付けたリクエストを計測する）"""
+    token: str
+    header: str
+    expires_at: datetime
+
+class RequestProfileSummary(BaseModel):
+    """計測したリクエストの概要"""
+    id: UUID
+    created_at: datetime
+    method: str
+    path: str
+    route: Optional[str] = None
+    status_code: int
+    duration_ms: float
+    trigger: str
+    sample_count: int
+    sql_count: int
+    r2_count: int
+
+    model_config = ConfigDict(from_attributes=True)
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -0,0 +1,236 @@
+"""
+スポットのタイトル・説明文に対するプロセス内転置インデックス
+
+日本語を分かち書きせずに扱えるよう、文字bigramを索引語にする（タイトルはunigramも）。
+クエリのbigramの積集合で候補を絞り、正規化済み文字列の部分一致で確定するため、
+入力途中の文字列（前方一致）でも検索できる。
+
+自プロセスの書き込みは spot_events で即時反映し、他ワーカーの書き込みは
+spot_sync の定期同期（updated_at の差分と定期的な全件の読み直し）で追従する。
+"""
+import heapq
+import re
+import threading
+import unicodedata
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from uuid import UUID
+
+import geo
+import spot_events
+import spot_sync
+
+_SEGMENT_RE = re.compile(r"\w+")
+
+
+def normalize(text: Optional[str]) -> str:
+    """全角半角・大文字小文字の揺れを吸収する"""
+    return unicodedata.normalize("NFKC", text or "").casefold()
+
+
+def _segments(text: str) -> List[str]:
+    return _SEGMENT_RE.findall(text)
+
+
+def _bigrams(segment: str) -> Iterable[str]:
+    return (segment[i:i + 2] for i in range(len(segment) - 1))
+
+
+def _index_terms(title: str, description: str) -> Set[str]:
+    terms: Set[str] = set()
+    for segment in _segments(title):
+        terms.update(segment)  # 1文字クエリ用（タイトルのみ）
+        terms.update(_bigrams(segment))
+    for segment in _segments(description):
+        terms.update(_bigrams(segment))
+    return terms
+
+
+def _query_terms(segment: str) -> List[str]:
+    if len(segment) == 1:
+        return [segment]
+    return list(_bigrams(segment))
+
+
+def _timestamp(value: datetime) -> float:
+    # DBから読んだ値はUTCのnaive datetime
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _score(doc: "_Doc", segments: List[str]) -> float:
+    """全セグメントを含む場合のみ正のスコアを返す（タイトル一致・前方一致を優遇）"""
+    score = 0.0
+    for segment in segments:
+        if segment in doc.title:
+            score += 3
+            if doc.title.startswith(segment):
+                score += 2
+            elif any(word.startswith(segment) for word in doc.title_words):
+                score += 1
+        elif segment in doc.description:
+            score += 1
+        else:
+            return 0.0
+    return score
+
+
+class _Doc:
+    __slots__ = ("spot_id", "title", "title_words", "description", "lat", "lng", "created_ts")
+
+    def __init__(self, spot_id: UUID, title: str, description: str, lat: float, lng: float, created_ts: float):
+        self.spot_id = spot_id
+        self.title = title
+        self.title_words = tuple(_segments(title))
+        self.description = description
+        self.lat = lat
+        self.lng = lng
+        self.created_ts = created_ts
+
+
+class SpotSearchIndex(spot_sync.SyncedIndex):
+    """スレッドセーフな文字n-gram転置インデックス"""
+    COLUMNS = ("title", "description", "latitude", "longitude", "created_at")
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._doc_ids: Dict[UUID, int] = {}
+        self._docs: Dict[int, _Doc] = {}
+        self._postings: Dict[str, Set[int]] = {}
+        self._next_doc_id = 0
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    # ----- 更新 -----
+    def _add(self, doc: _Doc) -> None:
+        doc_id = self._next_doc_id
+        self._next_doc_id += 1
+        self._doc_ids[doc.spot_id] = doc_id
+        self._docs[doc_id] = doc
+        for term in _index_terms(doc.title, doc.description):
+            self._postings.setdefault(term, set()).add(doc_id)
+
+    def _remove(self, spot_id: UUID) -> None:
+        doc_id = self._doc_ids.pop(spot_id, None)
+        if doc_id is None:
+            return
+        doc = self._docs.pop(doc_id)
+        for term in _index_terms(doc.title, doc.description):
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.discard(doc_id)
+                if not posting:
+                    del self._postings[term]
+
+    def upsert(
+        self,
+        spot_id: UUID,
+        title: str,
+        description: Optional[str],
+        lat: float,
+        lng: float,
+        created_at: datetime,
+    ) -> None:
+        doc = _Doc(spot_id, normalize(title), normalize(description), lat, lng, _timestamp(created_at))
+        with self._lock:
+            self._remove(spot_id)
+            self._add(doc)
+
+    def remove(self, spot_id: UUID) -> None:
+        with self._lock:
+            self._remove(spot_id)
+
+    def on_spot_event(self, kind: str, snapshot: spot_events.SpotSnapshot) -> None:
+        """spot_eventsのリスナー"""
+        if kind == spot_events.SPOT_DELETED:
+            self.remove(snapshot.id)
+        else:
+            self.upsert(
+                snapshot.id, snapshot.title, snapshot.description,
+                snapshot.latitude, snapshot.longitude, snapshot.created_at,
+            )
+
+    # ----- DBとの同期 -----
+    def _apply_row(self, row) -> None:
+        self.upsert(row.id, row.title, row.description, row.latitude, row.longitude, row.created_at)
+
+    def _start_rebuild(self) -> "SpotSearchIndex":
+        # 別のインデックスに構築して置き換える（構築中も古いインデックスで検索できる）
+        return SpotSearchIndex()
+
+    def _rebuild_row(self, fresh: "SpotSearchIndex", row) -> None:
+        fresh._apply_row(row)
+
+    def _finish_rebuild(self, fresh: "SpotSearchIndex") -> None:
+        with self._lock:
+            self._doc_ids = fresh._doc_ids
+            self._docs = fresh._docs
+            self._postings = fresh._postings
+            self._next_doc_id = fresh._next_doc_id
+
+    # ----- 検索 -----
+    def search(
+        self,
+        query: str,
+        limit: int = 20,
+        lat: Optional[float] = None,
+        lng: Optional[float] = None,
+        radius: Optional[float] = None,
+    ) -> List[UUID]:
+        """
+        クエリに一致するスポットIDをスコア順に返す
+
+        Args:
+            query: 検索文字列（空白区切りはAND）
+            limit: 最大件数
+            lat, lng, radius: 指定時は中心からradiusメートル以内に限定
+        """
+        segments = _segments(normalize(query))
+        if not segments:
+            return []
+        geo_filter = lat is not None and lng is not None and radius is not None
+
+        with self._lock:
+            postings = []
+            for segment in segments:
+                for term in _query_terms(segment):
+                    posting = self._postings.get(term)
+                    if not posting:
+                        return []
+                    postings.append(posting)
+            postings.sort(key=len)
+            candidates = postings[0].intersection(*postings[1:])
+
+            # 範囲の絞り込みをスコア計算より先に行い、範囲内の候補はすべてスコアを付ける
+            # （件数で打ち切ると、よくある語では範囲内の一致が落ちて0件になりうる）
+            if geo_filter:
+                # 経度は日付変更線で折り返すため、先に緯度の範囲だけで安く落とす
+                min_lat, _, max_lat, _ = geo.bbox_around(lat, lng, radius)
+            scored: List[Tuple[float, float, int]] = []
+            for doc_id in candidates:
+                doc = self._docs[doc_id]
+                if geo_filter:
+                    if not min_lat <= doc.lat <= max_lat:
+                        continue
+                    if geo.haversine_m(lat, lng, doc.lat, doc.lng) > radius:
+                        continue
+                score = _score(doc, segments)
+                if score <= 0:
+                    continue
+                scored.append((score, doc.created_ts, doc_id))
+
+            top = heapq.nlargest(limit, scored)
+            return [self._docs[doc_id].spot_id for _, _, doc_id in top]
+
+
+# シングルトンインスタンス
+_search_index = SpotSearchIndex()
+
+
+def get_search_index() -> SpotSearchIndex:
+    """プロセス共通の検索インデックスを取得"""
+    return _search_index
+
@@ -0,0 +1,131 @@
+"""
+ショップのカタログとユーザーごとの所有状況
+
+- カタログ（skinsの全件）はプロセス内に保持し、skinsが変わったときだけ読み直す
+  （CATALOG_CHECK_INTERVAL_SECONDSごとに件数と最新の updated_at で変更を確認する。
+  DBを直接編集する場合は updated_at も更新すること）
+- 所有状況は user_skins を1回引き、カタログの並び順に対するビット列（int）にしてキャッシュする
+  キャッシュのキーにカタログのバージョンを含めるので、カタログが変わると読み直される
+"""
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import cache
+import models
+
+CATALOG_CHECK_INTERVAL_SECONDS = 60
+OWNERSHIP_CACHE_SIZE = 50_000
+# 他のワーカーでの購入はこの時間で反映される（同じワーカーでの購入は即時に無効化する）
+OWNERSHIP_CACHE_TTL_SECONDS = 30
+
+
+@dataclass(frozen=True)
+class Catalog:
+    """ある時点のカタログ（並び順がビット列の位置になる）"""
+    version: str
+    skins: Tuple[dict, ...]
+    positions: Dict[UUID, int]
+
+    def bitmap(self, skin_ids: Iterable[UUID]) -> int:
+        bits = 0
+        for skin_id in skin_ids:
+            position = self.positions.get(skin_id)
+            if position is not None:
+                bits |= 1 << position
+        return bits
+
+
+def _build_catalog(skins) -> Catalog:
+    items = tuple(
+        {"id": skin.id, "name": skin.name, "image_url": skin.image_url, "price": skin.price}
+        for skin in skins
+    )
+    digest = hashlib.blake2b(digest_size=8)
+    for item in items:
+        digest.update(f"{item['id']}|{item['name']}|{item['image_url']}|{item['price']}\n".encode())
+    return Catalog(
+        version=digest.hexdigest(),
+        skins=items,
+        positions={item["id"]: position for position, item in enumerate(items)},
+    )
+
+
+class ShopCatalog:
+    """スレッドセーフ"""
+
+    def __init__(self):
+        self._catalog: Optional[Catalog] = None
+        self._fingerprint: Optional[tuple] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._ownership: cache.LRUCache = cache.LRUCache(
+            maxsize=OWNERSHIP_CACHE_SIZE, ttl=OWNERSHIP_CACHE_TTL_SECONDS
+        )
+
+    @staticmethod
+    def _fingerprint_of(db: Session) -> tuple:
+        # 追加・変更は updated_at、削除は件数で検出する
+        return tuple(db.execute(
+            select(func.count(), func.max(models.Skin.updated_at)).select_from(models.Skin)
+        ).one())
+
+    def get(self, db: Session) -> Catalog:
+        """カタログを返す（確認間隔が過ぎていれば変更を確認し、変わっていれば読み直す）"""
+        now = time.monotonic()
+        with self._lock:
+            catalog = self._catalog
+            if catalog is not None and now - self._checked_at < CATALOG_CHECK_INTERVAL_SECONDS:
+                return catalog
+
+        fingerprint = self._fingerprint_of(db)
+        if catalog is None or fingerprint != self._fingerprint:
+            skins = db.query(models.Skin).order_by(
+                models.Skin.price, models.Skin.created_at, models.Skin.id
+            ).all()
+            catalog = _build_catalog(skins)
+
+        with self._lock:
+            self._catalog = catalog
+            self._fingerprint = fingerprint
+            self._checked_at = now
+        return catalog
+
+    def invalidate(self) -> None:
+        """次のget()で必ず変更を確認させる"""
+        with self._lock:
+            self._checked_at = 0.0
+
+    def owned_bitmap(self, db: Session, catalog: Catalog, user_id: UUID) -> int:
+        """ユーザーが所有しているスキンのビット列（bit i = catalog.skins[i] を所有）"""
+        key = (user_id, catalog.version)
+        bitmap = self._ownership.get(key)
+        if bitmap is None:
+            skin_ids = db.scalars(
+                select(models.UserSkin.skin_id).where(models.UserSkin.user_id == user_id)
+            )
+            bitmap = catalog.bitmap(skin_ids)
+            self._ownership.set(key, bitmap)
+        return bitmap
+
+    def invalidate_ownership(self, user_id: UUID) -> None:
+        """購入後に呼ぶ"""
+        with self._lock:
+            catalog = self._catalog
+        if catalog is not None:
+            self._ownership.invalidate((user_id, catalog.version))
+
+
+# シングルトンインスタンス
+_shop_catalog = ShopCatalog()
+
+
+def get_shop_catalog() -> ShopCatalog:
+    """プロセス共通のカタログを取得"""
+    return _shop_catalog
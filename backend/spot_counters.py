@@ -0,0 +1,153 @@
+"""
+スポットの閲覧・タップ・チェックインのカウンター（write-behind）
+
+- increment() はプロセス内の辞書（SHARDS個に分割してロックの競合を減らす）に足すだけでDBに書かない
+- flush() が溜まった増分を FLUSH_INTERVAL_SECONDS ごとに1回のUPSERT（複数行）で spot_counters に加算する
+- 終了時にも lifespan から flush() を呼び、溜まっている増分を書き出す
+- get_counts() はDBの値（短時間キャッシュ）にこのプロセスのまだ書き出していない増分を足して返す
+  （他のワーカーの増分は、そのワーカーの次の flush まで反映されない）
+"""
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Tuple
+from uuid import UUID
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import cache
+import models
+from database import SessionLocal, upsert_add
+
+logger = logging.getLogger(__name__)
+
+VIEWS = "views"
+TAPS = "taps"
+CHECKINS = "checkins"
+COUNTERS = (VIEWS, TAPS, CHECKINS)
+
+SHARDS = 16
+FLUSH_INTERVAL_SECONDS = 10
+COUNTS_CACHE_SIZE = 50_000
+
+_EMPTY = (0, 0, 0)
+
+
+class _Shard:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: Dict[UUID, List[int]] = {}   # spot_id -> [views, taps, checkins]
+
+
+class SpotCounters:
+    """スレッドセーフ"""
+
+    def __init__(self, shards: int = SHARDS):
+        self._shards = [_Shard() for _ in range(shards)]
+        # flush() を同時に実行しない（定期実行と終了時の書き出しが重なった場合）
+        self._flush_lock = threading.Lock()
+        self._counts: cache.LRUCache = cache.LRUCache(maxsize=COUNTS_CACHE_SIZE, ttl=FLUSH_INTERVAL_SECONDS)
+
+    def _shard(self, spot_id: UUID) -> _Shard:
+        return self._shards[hash(spot_id) % len(self._shards)]
+
+    def increment(self, spot_id: UUID, counter: str, amount: int = 1) -> None:
+        index = COUNTERS.index(counter)
+        shard = self._shard(spot_id)
+        with shard.lock:
+            values = shard.pending.get(spot_id)
+            if values is None:
+                values = shard.pending[spot_id] = [0, 0, 0]
+            values[index] += amount
+
+    def increment_many(self, spot_ids: Iterable[UUID], counter: str) -> None:
+        for spot_id in spot_ids:
+            self.increment(spot_id, counter)
+
+    def _pending(self, spot_id: UUID) -> Tuple[int, int, int]:
+        shard = self._shard(spot_id)
+        with shard.lock:
+            values = shard.pending.get(spot_id)
+            return tuple(values) if values is not None else _EMPTY
+
+    def _take_pending(self) -> Dict[UUID, List[int]]:
+        taken: Dict[UUID, List[int]] = {}
+        for shard in self._shards:
+            with shard.lock:
+                pending, shard.pending = shard.pending, {}
+            taken.update(pending)
+        return taken
+
+    def _restore_pending(self, pending: Dict[UUID, List[int]]) -> None:
+        """書き出しに失敗した増分を戻す（次のflushで再試行）"""
+        for spot_id, values in pending.items():
+            for name, amount in zip(COUNTERS, values):
+                if amount:
+                    self.increment(spot_id, name, amount)
+
+    def get_counts(self, db: Session, spot_id: UUID) -> Dict[str, int]:
+        """{"views": .., "taps": .., "checkins": ..}"""
+        stored = self._counts.get(spot_id)
+        if stored is None:
+            row = db.execute(
+                select(models.SpotCounter.views, models.SpotCounter.taps, models.SpotCounter.checkins)
+                .where(models.SpotCounter.spot_id == spot_id)
+            ).first()
+            stored = tuple(row) if row else _EMPTY
+            self._counts.set(spot_id, stored)
+        pending = self._pending(spot_id)
+        return {name: stored[i] + pending[i] for i, name in enumerate(COUNTERS)}
+
+    def flush(self) -> int:
+        """溜まった増分をまとめてDBに加算する（バックグラウンドタスク・終了時用）"""
+        with self._flush_lock:
+            pending = self._take_pending()
+            if not pending:
+                return 0
+
+            db = SessionLocal()
+            try:
+                # 削除されたスポットの増分は捨てる（外部キー違反でバッチ全体が失敗しないように）
+                existing = set(db.scalars(
+                    select(models.Spot.id).where(models.Spot.id.in_(list(pending)))
+                ))
+                now = datetime.now(timezone.utc)
+                rows = [
+                    {"spot_id": spot_id, **dict(zip(COUNTERS, values)), "updated_at": now}
+                    # キーの順序を揃えて、ワーカー間でロックの取り合いにならないようにする
+                    for spot_id, values in sorted(pending.items(), key=lambda item: str(item[0]))
+                    if spot_id in existing
+                ]
+                if rows:
+                    db.execute(upsert_add(
+                        db.get_bind().dialect.name, models.SpotCounter.__table__,
+                        ["spot_id"], COUNTERS, replace_columns=["updated_at"],
+                    ), rows)
+                db.commit()
+            except Exception:
+                db.rollback()
+                self._restore_pending(pending)
+                raise
+            finally:
+                db.close()
+
+            for spot_id in pending:
+                self._counts.invalidate(spot_id)
+            return len(rows)
+
+
+# シングルトンインスタンス
+_spot_counters = SpotCounters()
+
+
+def get_spot_counters() -> SpotCounters:
+    """プロセス共通のカウンターを取得"""
+    return _spot_counters
+
+
+def flush() -> int:
+    """溜まった増分を書き出す（lifespanの定期実行・終了時用）"""
+    return _spot_counters.flush()
@@ -0,0 +1,96 @@
+"""
+スポット変更イベントのフック
+
+crudの作成・更新・削除がコミットされた後に通知され、
+検索インデックスなどプロセス内のキャッシュを差分で追従させるために使う。
+"""
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+from uuid import UUID
+
+import models
+
+logger = logging.getLogger(__name__)
+
+SPOT_CREATED = "created"
+SPOT_UPDATED = "updated"
+SPOT_DELETED = "deleted"
+
+
+@dataclass(frozen=True)
+class SpotSnapshot:
+    """コミット時点のスポットの値（セッションから切り離して扱える）"""
+    id: UUID
+    author_id: UUID
+    skin_id: UUID
+    latitude: float
+    longitude: float
+    title: str
+    description: Optional[str]
+    image_url: Optional[str]
+    crowd_level: str
+    rating: int
+    created_at: datetime
+    updated_at: datetime
+    # 更新で位置が変わった場合の変更前の位置（移動元のタイルの購読者にも通知するため）
+    previous_latitude: Optional[float] = None
+    previous_longitude: Optional[float] = None
+
+    @classmethod
+    def from_model(
+        cls, spot: models.Spot, previous_location: Optional[Tuple[float, float]] = None
+    ) -> "SpotSnapshot":
+        moved = previous_location is not None and previous_location != (spot.latitude, spot.longitude)
+        return cls(
+            id=spot.id,
+            author_id=spot.author_id,
+            skin_id=spot.skin_id,
+            latitude=spot.latitude,
+            longitude=spot.longitude,
+            title=spot.title,
+            description=spot.description,
+            image_url=spot.image_url,
+            crowd_level=models.CrowdLevelEnum(spot.crowd_level).value,
+            rating=spot.rating,
+            created_at=spot.created_at,
+            updated_at=spot.updated_at,
+            previous_latitude=previous_location[0] if moved else None,
+            previous_longitude=previous_location[1] if moved else None,
+        )
+
+
+SpotListener = Callable[[str, SpotSnapshot], None]
+
+_listeners: List[SpotListener] = []
+_lock = threading.Lock()
+
+
+def add_listener(listener: SpotListener) -> None:
+    """変更イベントのリスナーを登録"""
+    with _lock:
+        if listener not in _listeners:
+            _listeners.append(listener)
+
+
+def remove_listener(listener: SpotListener) -> None:
+    """変更イベントのリスナーを解除"""
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def emit(kind: str, snapshot: SpotSnapshot) -> None:
+    """
+    全リスナーにイベントを通知する。
+    書き込み自体はコミット済みのため、リスナーの例外はログに残して握りつぶす。
+    """
+    with _lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        try:
+            listener(kind, snapshot)
+        except Exception:
+            logger.exception("Spot event listener failed (%s %s)", kind, snapshot.id)
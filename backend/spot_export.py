@@ -0,0 +1,160 @@
+"""
+スポットのストリーミングエクスポート (NDJSON / CSV)
+
+サーバーサイドカーソル (stream_results + yield_per) でテーブルを走査し、
+一定サイズのチャンクごとに書き出すため、テーブルサイズに関わらずメモリ使用量は一定。
+フィールド名は bulk_import の入力形式と揃えてある。
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from typing import Iterator, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+
+SUPPORTED_FORMATS = ("ndjson", "csv")
+YIELD_PER = 1000
+CHUNK_SIZE = 64 * 1024
+
+EXPORT_FIELDS = [
+    "id", "author_id", "skin_id", "lat", "lng", "title", "description",
+    "image_url", "crowd_level", "rating", "created_at", "updated_at",
+]
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+class ExportFilter:
+    """バウンディングボックスと期間による絞り込み条件"""
+
+    def __init__(
+        self,
+        min_lat: Optional[float] = None,
+        max_lat: Optional[float] = None,
+        min_lng: Optional[float] = None,
+        max_lng: Optional[float] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ):
+        self.min_lat = min_lat
+        self.max_lat = max_lat
+        self.min_lng = min_lng
+        self.max_lng = max_lng
+        self.since = since
+        self.until = until
+
+    def apply(self, stmt):
+        spot = models.Spot
+        if self.min_lat is not None:
+            stmt = stmt.where(spot.latitude >= self.min_lat)
+        if self.max_lat is not None:
+            stmt = stmt.where(spot.latitude <= self.max_lat)
+        if self.min_lng is not None:
+            stmt = stmt.where(spot.longitude >= self.min_lng)
+        if self.max_lng is not None:
+            stmt = stmt.where(spot.longitude <= self.max_lng)
+        if self.since is not None:
+            stmt = stmt.where(spot.created_at >= self.since)
+        if self.until is not None:
+            stmt = stmt.where(spot.created_at < self.until)
+        return stmt
+
+
+def iter_spot_records(db: Session, filters: Optional[ExportFilter] = None) -> Iterator[dict]:
+    """スポットを1件ずつdictで返す（ORMオブジェクトを生成せず列だけを読む）"""
+    spot = models.Spot
+    stmt = select(
+        spot.id, spot.author_id, spot.skin_id, spot.latitude, spot.longitude,
+        spot.title, spot.description, spot.image_url, spot.crowd_level,
+        spot.rating, spot.created_at, spot.updated_at,
+    ).order_by(spot.created_at, spot.id)
+    if filters is not None:
+        stmt = filters.apply(stmt)
+
+    result = db.execute(stmt.execution_options(stream_results=True, yield_per=YIELD_PER))
+    for row in result:
+        yield {
+            "id": str(row.id),
+            "author_id": str(row.author_id),
+            "skin_id": str(row.skin_id),
+            "lat": row.latitude,
+            "lng": row.longitude,
+            "title": row.title,
+            "description": row.description,
+            "image_url": row.image_url,
+            "crowd_level": row.crowd_level.value,
+            "rating": row.rating,
+            "created_at": row.created_at.isoformat(),
+            "updated_at": row.updated_at.isoformat(),
+        }
+
+
+def _iter_encoded(records: Iterator[dict], fmt: str) -> Iterator[str]:
+    if fmt == "ndjson":
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+    elif fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        for record in records:
+            writer.writerow([record[f] for f in EXPORT_FIELDS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+
+def iter_export_chunks(
+    db: Session,
+    fmt: str,
+    filters: Optional[ExportFilter] = None,
+    compress: bool = False,
+) -> Iterator[bytes]:
+    """エクスポート内容をCHUNK_SIZE程度のバイト列に分けて返す（gzipはその場で圧縮）"""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31: gzipヘッダー付き
+    pending = []
+    pending_size = 0
+
+    def emit(data: bytes) -> bytes:
+        return compressor.compress(data) if compressor else data
+
+    for text in _iter_encoded(iter_spot_records(db, filters), fmt):
+        data = text.encode("utf-8")
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size >= CHUNK_SIZE:
+            chunk = emit(b"".join(pending))
+            pending = []
+            pending_size = 0
+            if chunk:
+                yield chunk
+
+    tail = emit(b"".join(pending))
+    if compressor:
+        tail += compressor.flush()
+    if tail:
+        yield tail
+
+
+def stream_export(fmt: str, filters: Optional[ExportFilter] = None, compress: bool = False) -> Iterator[bytes]:
+    """
+    StreamingResponse用のジェネレーター。
+    レスポンス送信中もカーソルを保持するため、リクエストとは別にセッションを開く。
+    """
+    db = SessionLocal()
+    try:
+        yield from iter_export_chunks(db, fmt, filters, compress)
+    finally:
+        db.close()
@@ -0,0 +1,239 @@
+"""
+スポットの列指向インデックス（近傍検索・ルート沿いの検索）
+
+- 全スポットのID・緯度経度・評価・混雑度をNumPy配列でプロセス内に保持する
+  （spot_sync.ColumnStore。crudの書き込みイベントと spot_sync の定期同期で追従する）
+  列は1スポット約27バイトだが、IDからスロットへの辞書（UUIDオブジェクトを含む）が約180バイトかかり、
+  1スポットあたり合計約210バイトになる
+- nearest(): 全点との距離をまとめて計算し、np.argpartition で近いk件を取り出す
+- along_route(): ルート周辺の点をルートの中心の平面（メートル）に投影し、
+  線分ごとに点と線分の距離をまとめて計算して、ルートから width_m 以内の点をルート上の位置順に返す
+
+緯度・経度はfloat32（誤差1m程度）で持つため、返す距離も1m程度の誤差を含む。
+"""
+import math
+import threading
+from typing import Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+import geo
+import spot_events
+import spot_sync
+from startup import lazy_module
+
+np = lazy_module("numpy")
+
+CROWD_CODES = {"low": 0, "medium": 1, "high": 2}
+
+
+def _haversine(lat: float, lng: float, lats: "np.ndarray", lngs: "np.ndarray") -> "np.ndarray":
+    """1点から複数の点までの距離（メートル）"""
+    lat1 = math.radians(lat)
+    lat2 = np.radians(lats.astype(np.float64))
+    dlat = lat2 - lat1
+    dlng = np.radians(lngs.astype(np.float64) - lng)
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * geo.EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _wrap_lng(dlng: "np.ndarray") -> "np.ndarray":
+    """経度差を [-180, 180) に折り返す"""
+    return (dlng + 180.0) % 360.0 - 180.0
+
+
+class SpotIndex(spot_sync.SyncedIndex):
+    """スレッドセーフ"""
+    COLUMNS = ("latitude", "longitude", "rating", "crowd_level")
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # id: UUIDのバイト列, rating / crowd: CROWD_CODES
+        self._points = spot_sync.ColumnStore(
+            {"id": "V16", "lat": "float32", "lng": "float32", "rating": "int8", "crowd": "int8"}
+        )
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    # ----- 点の更新 -----
+    def upsert(self, spot_id: UUID, lat: float, lng: float, rating: int, crowd_level: str) -> None:
+        with self._lock:
+            points = self._points
+            slot = points.put(spot_id)
+            points["id"][slot] = spot_id.bytes
+            points["lat"][slot] = lat
+            points["lng"][slot] = lng
+            points["rating"][slot] = rating
+            points["crowd"][slot] = CROWD_CODES.get(crowd_level, CROWD_CODES["medium"])
+
+    def remove(self, spot_id: UUID) -> None:
+        with self._lock:
+            self._points.release(spot_id)
+
+    def on_spot_event(self, kind: str, snapshot: spot_events.SpotSnapshot) -> None:
+        """spot_eventsのリスナー"""
+        if kind == spot_events.SPOT_DELETED:
+            self.remove(snapshot.id)
+        else:
+            self.upsert(snapshot.id, snapshot.latitude, snapshot.longitude, snapshot.rating, snapshot.crowd_level)
+
+    # ----- DBとの同期 -----
+    def _apply_row(self, row) -> None:
+        self.upsert(row.id, row.latitude, row.longitude, row.rating, row.crowd_level.value)
+
+    def _start_rebuild(self) -> set:
+        return set()
+
+    def _rebuild_row(self, seen: set, row) -> None:
+        seen.add(row.id)
+        self._apply_row(row)
+
+    def _finish_rebuild(self, seen: set) -> None:
+        # 他のワーカーで削除されたスポットを消す
+        with self._lock:
+            for spot_id in [spot_id for spot_id in self._points.slots if spot_id not in seen]:
+                self._points.release(spot_id)
+
+    # ----- 検索 -----
+    def _candidates(
+        self,
+        min_lat: float,
+        max_lat: float,
+        min_rating: Optional[int],
+        crowd_levels: Optional[Iterable[str]],
+    ):
+        """緯度の範囲と条件に合う点の (ID, 緯度, 経度)（ロックの外で使えるようにコピーを返す）"""
+        with self._lock:
+            points = self._points
+            if points.size == 0:
+                return None
+            n = points.size
+            lat = points["lat"][:n]
+            mask = points["alive"][:n] & (lat >= min_lat) & (lat <= max_lat)
+            if min_rating is not None:
+                mask &= points["rating"][:n] >= min_rating
+            if crowd_levels is not None:
+                mask &= np.isin(points["crowd"][:n], [CROWD_CODES[level] for level in crowd_levels])
+            slots = np.flatnonzero(mask)
+            return points["id"][slots], lat[slots], points["lng"][slots]
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        k: int,
+        max_distance: Optional[float] = None,
+        min_rating: Optional[int] = None,
+        crowd_levels: Optional[Iterable[str]] = None,
+    ) -> List[Tuple[UUID, float]]:
+        """
+        近いk件を返す
+
+        Returns:
+            (spot_id, 距離[m]) のリスト（距離の昇順）
+        """
+        if max_distance is not None:
+            min_lat, _, max_lat, _ = geo.bbox_around(lat, lng, max_distance)
+        else:
+            min_lat, max_lat = -90.0, 90.0
+        candidates = self._candidates(min_lat, max_lat, min_rating, crowd_levels)
+        if candidates is None or len(candidates[0]) == 0:
+            return []
+        ids, lats, lngs = candidates
+
+        distances = _haversine(lat, lng, lats, lngs)
+        if max_distance is not None:
+            within = np.flatnonzero(distances <= max_distance)
+            ids, distances = ids[within], distances[within]
+        if len(distances) > k:
+            top = np.argpartition(distances, k - 1)[:k]
+            ids, distances = ids[top], distances[top]
+        order = np.argsort(distances, kind="stable")
+        return [(UUID(bytes=ids[i].tobytes()), float(distances[i])) for i in order]
+
+    def along_route(
+        self,
+        points: Sequence[Tuple[float, float]],
+        width: float,
+        limit: int,
+        min_rating: Optional[int] = None,
+        crowd_levels: Optional[Iterable[str]] = None,
+    ) -> List[Tuple[UUID, float, float]]:
+        """
+        ルート（折れ線）から width メートル以内の点をルート上の位置順に返す
+
+        Args:
+            points: ルートの頂点 [(lat, lng), ...]（2点以上）
+
+        Returns:
+            (spot_id, ルートからの距離[m], ルートの始点からの道のり[m]) のリスト
+        """
+        route_lat = np.array([p[0] for p in points], dtype=np.float64)
+        route_lng = np.array([p[1] for p in points], dtype=np.float64)
+        lat0 = float(route_lat.mean())
+        lng0 = float(route_lng[0])
+        # 投影の中心から見た経度差（日付変更線をまたぐルートも連続させる）
+        route_dlng = _wrap_lng(route_lng - lng0)
+        lng0 = float(lng0 + (route_dlng.min() + route_dlng.max()) / 2)
+        route_dlng = _wrap_lng(route_lng - lng0)
+
+        margin_lat = math.degrees(width / geo.EARTH_RADIUS_M)
+        candidates = self._candidates(
+            float(route_lat.min()) - margin_lat, float(route_lat.max()) + margin_lat, min_rating, crowd_levels,
+        )
+        if candidates is None or len(candidates[0]) == 0:
+            return []
+        ids, lats, lngs = candidates
+
+        # ルートの中心での正距円筒図法（メートル）。徒歩のルート程度の範囲なら誤差は小さい
+        meters_per_deg = math.radians(1) * geo.EARTH_RADIUS_M
+        cos0 = max(math.cos(math.radians(lat0)), 1e-6)
+        rx = route_dlng * meters_per_deg * cos0
+        ry = (route_lat - lat0) * meters_per_deg
+        px = _wrap_lng(lngs.astype(np.float64) - lng0) * meters_per_deg * cos0
+        py = (lats.astype(np.float64) - lat0) * meters_per_deg
+
+        # x で並べ、線分ごとに x の範囲の点だけを二分探索で取り出す
+        by_x = np.argsort(px, kind="stable")
+        px, py, ids = px[by_x], py[by_x], ids[by_x]
+        best = np.full(len(px), np.inf)
+        along = np.zeros(len(px))
+
+        travelled = 0.0
+        for i in range(len(rx) - 1):
+            ax, ay, bx, by = rx[i], ry[i], rx[i + 1], ry[i + 1]
+            dx, dy = bx - ax, by - ay
+            length_sq = dx * dx + dy * dy
+            length = math.sqrt(length_sq)
+            lo = np.searchsorted(px, min(ax, bx) - width, side="left")
+            hi = np.searchsorted(px, max(ax, bx) + width, side="right")
+            if lo < hi:
+                sx, sy = px[lo:hi], py[lo:hi]
+                near = np.flatnonzero((sy >= min(ay, by) - width) & (sy <= max(ay, by) + width))
+                if len(near):
+                    sx, sy = sx[near], sy[near]
+                    if length_sq > 0:
+                        t = np.clip(((sx - ax) * dx + (sy - ay) * dy) / length_sq, 0.0, 1.0)
+                    else:
+                        t = np.zeros(len(near))
+                    distance = np.hypot(sx - (ax + t * dx), sy - (ay + t * dy))
+                    target = lo + near
+                    closer = distance < best[target]
+                    best[target[closer]] = distance[closer]
+                    along[target[closer]] = travelled + t[closer] * length
+            travelled += length
+
+        hits = np.flatnonzero(best <= width)
+        order = hits[np.lexsort((best[hits], along[hits]))][:limit]
+        return [(UUID(bytes=ids[i].tobytes()), float(best[i]), float(along[i])) for i in order]
+
+
+# シングルトンインスタンス
+_index = SpotIndex()
+
+
+def get_spot_index() -> SpotIndex:
+    """プロセス共通のインデックスを取得"""
+    return _index
+
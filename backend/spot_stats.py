@@ -0,0 +1,36 @@
+"""
+投稿の集計（user_spot_stats）の照合
+
+集計はスポットの作成・更新・削除と同じトランザクションで加算しているため通常は食い違わないが、
+DBを直接編集した場合などに備えて、定期的に spots から数え直した値と比べて食い違いを直す。
+"""
+import logging
+
+import crud
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL_SECONDS = 24 * 60 * 60
+# 1回の実行で直すユーザー数の上限
+RECONCILE_MAX_USERS = 500
+
+
+def reconcile() -> int:
+    """食い違っているユーザーの集計を数え直す（バックグラウンドタスク用）"""
+    db = SessionLocal()
+    try:
+        drifted = crud.find_spot_stats_drift(db, limit=RECONCILE_MAX_USERS)
+        db.rollback()
+
+        fixed = 0
+        for user_id, recorded, actual in drifted:
+            logger.warning("Spot stats of user %s drifted: recorded %s, actual %s", user_id, recorded, actual)
+            try:
+                crud.reconcile_spot_stats(db, user_id)
+                fixed += 1
+            except Exception:
+                logger.exception("Failed to reconcile spot stats for user %s", user_id)
+        return fixed
+    finally:
+        db.close()
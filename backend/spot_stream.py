@@ -0,0 +1,211 @@
+"""
+スポット変更のプッシュ配信（タイル単位の購読）
+
+crud → spot_events → ブローカー → TileHub → 各購読者のキュー の順に流れる。
+ブローカーは差し替え可能で、デフォルトはプロセス内で完結する InProcessBroker。
+複数ワーカー間で配信したい場合は publish() で外部に送り、受信したメッセージを
+deliver() に渡すブローカーを set_broker() で登録する。
+
+購読者ごとのキューは上限付きで、溢れた場合はキューを捨てて "resync" を送り、
+クライアントに一覧の再取得を促す（大量インポート時などに遅い接続がメモリを食わないように）。
+"""
+import asyncio
+import logging
+import math
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import geo
+import spot_events
+
+logger = logging.getLogger(__name__)
+
+STREAM_ZOOM = 12               # 購読単位のタイル（東京付近で約8km四方）
+MAX_TILES_PER_SUBSCRIPTION = 64
+QUEUE_SIZE = 256
+KEEPALIVE_SECONDS = 15
+
+Tile = Tuple[int, int]
+Deliver = Callable[[dict], None]
+
+
+def event_message(kind: str, snapshot: spot_events.SpotSnapshot) -> dict:
+    """クライアントに送る最小限のペイロード"""
+    message = {
+        "type": kind,
+        "id": str(snapshot.id),
+        "lat": snapshot.latitude,
+        "lng": snapshot.longitude,
+    }
+    if snapshot.previous_latitude is not None:
+        # 移動元のタイルの購読者にも届け、古い位置のマーカーを消せるようにする
+        message["prev_lat"] = snapshot.previous_latitude
+        message["prev_lng"] = snapshot.previous_longitude
+    if kind != spot_events.SPOT_DELETED:
+        message.update({
+            "title": snapshot.title,
+            "crowd_level": snapshot.crowd_level,
+            "rating": snapshot.rating,
+            "author_id": str(snapshot.author_id),
+            "skin_id": str(snapshot.skin_id),
+            "updated_at": snapshot.updated_at.isoformat(),
+        })
+    return message
+
+
+def tiles_for_bbox(min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> List[Tile]:
+    """バウンディングボックスを覆うタイル（多すぎる場合はValueError）"""
+    # タイルのyは北ほど小さい
+    x0, y0 = geo.latlng_to_tile(max_lat, min_lng, STREAM_ZOOM)
+    x1, y1 = geo.latlng_to_tile(min_lat, max_lng, STREAM_ZOOM)
+    n = 1 << STREAM_ZOOM
+    xs = range(x0, x1 + 1) if x0 <= x1 else [*range(x0, n), *range(0, x1 + 1)]  # 日付変更線をまたぐ場合
+    if len(xs) * (y1 - y0 + 1) > MAX_TILES_PER_SUBSCRIPTION:
+        raise ValueError("Viewport is too large")
+    return [(x, y) for x in xs for y in range(y0, y1 + 1)]
+
+
+class Subscription:
+    """1接続分の購読"""
+
+    def __init__(self, tiles: List[Tile]):
+        self.tiles = tiles
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def offer(self, message: dict) -> None:
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # 追いつけない接続は溜まった分を捨てて再取得させる
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync"})
+
+
+class TileHub:
+    """タイル → 購読者の索引。購読者の操作はイベントループ上でのみ行う"""
+
+    def __init__(self):
+        self._subscribers: Dict[Tile, Set[Subscription]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def bind_loop(self, loop: Optional[asyncio.AbstractEventLoop]) -> None:
+        self._loop = loop
+
+    @property
+    def connections(self) -> int:
+        return len({sub for subs in self._subscribers.values() for sub in subs})
+
+    def subscribe(self, tiles: List[Tile]) -> Subscription:
+        sub = Subscription(tiles)
+        for tile in tiles:
+            self._subscribers.setdefault(tile, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        for tile in sub.tiles:
+            subs = self._subscribers.get(tile)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[tile]
+
+    def deliver(self, message: dict) -> None:
+        """任意のスレッドから呼べる配信口（ループへの受け渡しは1メッセージにつき1回）"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._dispatch, message)
+        except RuntimeError:
+            # シャットダウン中
+            pass
+
+    @staticmethod
+    def _tile_of(lat, lng) -> Optional[Tile]:
+        if lat is None or lng is None or not (math.isfinite(lat) and math.isfinite(lng)):
+            return None
+        return geo.latlng_to_tile(lat, lng, STREAM_ZOOM)
+
+    def _dispatch(self, message: dict) -> None:
+        # 移動した場合は移動元と移動先の両方のタイルに送る（両方を購読している接続には1回だけ）
+        tiles = {
+            self._tile_of(message.get("lat"), message.get("lng")),
+            self._tile_of(message.get("prev_lat"), message.get("prev_lng")),
+        }
+        tiles.discard(None)
+        subs = set()
+        for tile in tiles:
+            subs.update(self._subscribers.get(tile, ()))
+        for sub in subs:
+            sub.offer(message)
+
+
+class SpotBroker(ABC):
+    """ワーカー間配信のインターフェース"""
+
+    @abstractmethod
+    def start(self, deliver: Deliver) -> None:
+        """受信したメッセージを deliver に渡し始める"""
+
+    @abstractmethod
+    def stop(self) -> None:
+        """受信を止める"""
+
+    @abstractmethod
+    def publish(self, message: dict) -> None:
+        """メッセージを全ワーカー（自分を含む）に送る"""
+
+
+class InProcessBroker(SpotBroker):
+    """同一プロセス内だけで配信するデフォルトのブローカー"""
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    def start(self, deliver: Deliver) -> None:
+        self._deliver = deliver
+
+    def stop(self) -> None:
+        self._deliver = None
+
+    def publish(self, message: dict) -> None:
+        deliver = self._deliver
+        if deliver is not None:
+            deliver(message)
+
+
+# シングルトンインスタンス
+_hub = TileHub()
+_broker: SpotBroker = InProcessBroker()
+_lock = threading.Lock()
+
+
+def get_hub() -> TileHub:
+    return _hub
+
+
+def set_broker(broker: SpotBroker) -> None:
+    """ブローカーを差し替える（start() より前に呼ぶ）"""
+    global _broker
+    with _lock:
+        _broker = broker
+
+
+def on_spot_event(kind: str, snapshot: spot_events.SpotSnapshot) -> None:
+    """spot_eventsのリスナー"""
+    _broker.publish(event_message(kind, snapshot))
+
+
+def start(loop: asyncio.AbstractEventLoop) -> None:
+    """配信を開始する（lifespanから呼ぶ）"""
+    _hub.bind_loop(loop)
+    _broker.start(_hub.deliver)
+    spot_events.add_listener(on_spot_event)
+
+
+def stop() -> None:
+    spot_events.remove_listener(on_spot_event)
+    _broker.stop()
+    _hub.bind_loop(None)
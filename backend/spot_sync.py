@@ -0,0 +1,189 @@
+"""
+プロセス内インデックス（検索・人気スポット・ヒートマップ・スポットインデックス）の共通部分
+
+- SyncedIndex: spots の差分同期で追従するインデックスの基底クラス
+  自プロセスの書き込みは spot_events で即時反映し、他ワーカーの書き込みは updated_at の差分で取り込む。
+  他ワーカーでの削除は差分に現れないため、REBUILD_INTERVAL_SECONDS ごとに全件を読み直す
+- sync_from_db(): 複数のインデックスを1回の spots の読み込みで同期する
+  （全件の読み直しも差分も、インデックスごとにテーブルを読まない）
+- ColumnStore: スポットごとの値をNumPy配列の列で持つ（削除したスロットは再利用する）
+"""
+import logging
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Sequence
+from uuid import UUID
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from startup import lazy_module
+
+np = lazy_module("numpy")
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL_SECONDS = 30
+REBUILD_INTERVAL_SECONDS = 10 * 60
+# コミット遅延を吸収するための差分の重なり幅
+SYNC_OVERLAP = timedelta(seconds=5)
+
+_INITIAL_CAPACITY = 1024
+
+
+class SyncedIndex(ABC):
+    """
+    差分同期で追従するインデックスの基底クラス
+
+    サブクラスは COLUMNS（読む spots の列名）と、全件の読み直し（_start_rebuild / _rebuild_row /
+    _finish_rebuild）、差分の取り込み（_apply_row）を実装する。
+    _finish_rebuild はロックを取って構築した内容に置き換える（構築中も古い内容で検索できる）。
+    """
+    COLUMNS: Sequence[str] = ()
+
+    def __init__(self):
+        self._last_sync: Optional[datetime] = None
+        self._last_rebuild = 0.0
+        self.ready = False
+
+    def _needs_rebuild(self) -> bool:
+        return (
+            not self.ready
+            or self._last_sync is None
+            or time.monotonic() - self._last_rebuild > REBUILD_INTERVAL_SECONDS
+        )
+
+    @abstractmethod
+    def _start_rebuild(self):
+        """全件の読み直しを始め、_rebuild_row に渡す構築中の状態を返す"""
+
+    @abstractmethod
+    def _rebuild_row(self, state, row) -> None:
+        """全件の読み直しの1行を構築中の状態に加える"""
+
+    @abstractmethod
+    def _finish_rebuild(self, state) -> None:
+        """構築した内容に置き換える（読み直しで現れなかったスポットは消す）"""
+
+    @abstractmethod
+    def _apply_row(self, row) -> None:
+        """差分の1行を取り込む"""
+
+    def rebuild(self, db: Session) -> None:
+        """全スポットを読み直す"""
+        _rebuild(db, [self], datetime.now(timezone.utc))
+
+    def sync(self, db: Session) -> None:
+        """差分を取り込む。未構築・一定時間経過の場合は全件読み直す"""
+        sync(db, [self])
+
+
+def _select_rows(db: Session, indexes: Iterable[SyncedIndex], updated_since: Optional[datetime] = None):
+    names = {"id"}.union(*(index.COLUMNS for index in indexes))
+    stmt = select(*(getattr(models.Spot, name) for name in sorted(names)))
+    if updated_since is not None:
+        stmt = stmt.where(models.Spot.updated_at >= updated_since)
+    return db.execute(stmt.execution_options(stream_results=True, yield_per=1000))
+
+
+def _rebuild(db: Session, indexes: List[SyncedIndex], started: datetime) -> None:
+    states = [(index, index._start_rebuild()) for index in indexes]
+    rows = 0
+    for row in _select_rows(db, indexes):
+        rows += 1
+        for index, state in states:
+            index._rebuild_row(state, row)
+    rebuilt_at = time.monotonic()
+    for index, state in states:
+        index._finish_rebuild(state)
+        index._last_sync = started
+        index._last_rebuild = rebuilt_at
+        index.ready = True
+    logger.info("Rebuilt %s from %d spots", ", ".join(type(index).__name__ for index in indexes), rows)
+
+
+def sync(db: Session, indexes: Sequence[SyncedIndex]) -> None:
+    """
+    インデックスをまとめて同期する
+    読み直しが必要なものは1回の全件の読み込みで、残りは1回の差分の読み込みで更新する
+    """
+    started = datetime.now(timezone.utc)
+    stale = [index for index in indexes if index._needs_rebuild()]
+    if stale:
+        _rebuild(db, stale, started)
+
+    fresh = [index for index in indexes if index not in stale]
+    if fresh:
+        since = min(index._last_sync for index in fresh) - SYNC_OVERLAP
+        for row in _select_rows(db, fresh, updated_since=since):
+            for index in fresh:
+                index._apply_row(row)
+        for index in fresh:
+            index._last_sync = started
+
+
+def sync_from_db(indexes: Sequence[SyncedIndex]) -> None:
+    """専用セッションでDBと同期する（バックグラウンドタスク用）"""
+    db = SessionLocal()
+    try:
+        sync(db, indexes)
+    finally:
+        db.close()
+
+
+class ColumnStore:
+    """
+    スポットごとの値をNumPy配列の列で持つ（スレッドセーフではないので呼び出し元でロックする）
+
+    スポットは0〜size-1のスロットに置き、削除したスロットは alive を落として次の追加で再利用する。
+    列は容量が足りなくなると2倍の大きさに作り直す。
+    IDからスロットへの対応（slots）は辞書で持つため、列とは別に1スポット約180バイトかかる
+    （差分同期の追加・削除を1件ずつO(1)で反映するため、ソート済みの配列にはしない）。
+    """
+
+    def __init__(self, dtypes: Dict[str, str]):
+        self._dtypes = dict(dtypes, alive="bool")
+        self._columns: Dict[str, "np.ndarray"] = {}
+        self.slots: Dict[UUID, int] = {}
+        self._free: List[int] = []
+        self.size = 0            # 使用したことのあるスロット数
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def __getitem__(self, name: str) -> "np.ndarray":
+        """列（容量分の配列。使用中の範囲は [:size]）"""
+        return self._columns[name]
+
+    def _grow(self) -> None:
+        capacity = len(self._columns["alive"]) * 2 if self._columns else _INITIAL_CAPACITY
+        old = self._columns
+        self._columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self._dtypes.items()}
+        for name, values in old.items():
+            self._columns[name][:len(values)] = values
+
+    def put(self, spot_id: UUID) -> int:
+        """スポットのスロット（無ければ割り当てる）"""
+        slot = self.slots.get(spot_id)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                if not self._columns or self.size == len(self._columns["alive"]):
+                    self._grow()
+                slot = self.size
+                self.size += 1
+            self.slots[spot_id] = slot
+            self._columns["alive"][slot] = True
+        return slot
+
+    def release(self, spot_id: UUID) -> Optional[int]:
+        """スポットのスロットを空ける（空けたスロット、無ければNone）"""
+        slot = self.slots.pop(spot_id, None)
+        if slot is not None:
+            self._columns["alive"][slot] = False
+            self._free.append(slot)
+        return slot
@@ -0,0 +1,138 @@
+"""
+起動時間の計測と遅延インポート
+
+- lazy_module(): 重いモジュール（boto3, jose, passlib）を最初の属性アクセスまで読み込まない
+- metrics: プロセス開始からの経過時間（インポート完了・ウォームアップ完了・最初のリクエスト）を記録する
+- FirstRequestTimer: 最初のリクエストの完了時刻を記録するASGIミドルウェア
+
+インポート時間の内訳は `python profile_startup.py` で確認できる。
+"""
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+from types import ModuleType
+from typing import Dict, Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# 最初のリクエストとして数えないパス（ヘルスチェック）
+UNTIMED_PATH_PREFIXES = ("/health/",)
+
+
+class _LazyModule(ModuleType):
+    """
+    最初の属性アクセスで読み込まれるモジュール
+    importlib.util.LazyLoader（Python 3.11）は読み込みをロックしないため、複数のスレッドが同時に
+    最初のアクセスをすると読み込み途中のモジュールが見える（ウォームアップの並行ステップでnumpyなど）。
+    ここではモジュールごとのロックで読み込みを直列化し、終わったら通常の ModuleType に戻す
+    """
+
+    def __getattribute__(self, attr):
+        spec = ModuleType.__getattribute__(self, "__spec__")
+        with _lazy_locks[spec.name]:
+            # 読み込み中の同じスレッドからのアクセス（サブモジュールのimportなど）はそのまま返す
+            if type(self) is _LazyModule and spec.name not in _loading:
+                _loading.add(spec.name)
+                try:
+                    spec.loader.exec_module(self)
+                    self.__class__ = ModuleType
+                finally:
+                    _loading.discard(spec.name)
+        return ModuleType.__getattribute__(self, attr)
+
+
+_lazy_locks: Dict[str, threading.RLock] = {}
+_loading: set = set()
+
+
+def lazy_module(name: str) -> ModuleType:
+    """最初の属性アクセス時に読み込まれるモジュールを返す（既に読み込み済みならそれを返す）"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}")
+    _lazy_locks.setdefault(name, threading.RLock())
+    module = importlib.util.module_from_spec(spec)
+    module.__class__ = _LazyModule
+    sys.modules[name] = module
+    return module
+
+
+def _process_start_time() -> float:
+    """プロセスの開始時刻（UNIX時間）。インタプリタの起動時間も含めるため /proc から取得する"""
+    try:
+        with open("/proc/self/stat") as f:
+            # comm にスペースが含まれる場合があるので ')' 以降を分割する
+            fields = f.read().rsplit(")", 1)[1].split()
+        start_ticks = int(fields[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+class StartupMetrics:
+    """起動フェーズごとのプロセス開始からの経過秒数"""
+
+    def __init__(self):
+        self.process_started = _process_start_time()
+        self.phases: Dict[str, float] = {}
+        self.warmup_steps: Dict[str, dict] = {}
+        self.ready = False
+        self._lock = threading.Lock()
+
+    def elapsed(self) -> float:
+        return time.time() - self.process_started
+
+    def mark(self, phase: str) -> None:
+        """フェーズの完了を記録する（同じフェーズは最初の1回だけ）"""
+        with self._lock:
+            if phase in self.phases:
+                return
+            self.phases[phase] = round(self.elapsed(), 3)
+        logger.info("Startup: %s at %.3fs", phase, self.phases[phase])
+
+    def record_step(self, name: str, seconds: float, error: Optional[BaseException] = None) -> None:
+        step = {"seconds": round(seconds, 3)}
+        if error is not None:
+            step["error"] = f"{type(error).__name__}: {error}"
+        with self._lock:
+            self.warmup_steps[name] = step
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "uptime_seconds": round(self.elapsed(), 3),
+                "phases": dict(self.phases),
+                "warmup_steps": dict(self.warmup_steps),
+            }
+
+
+metrics = StartupMetrics()
+
+
+class FirstRequestTimer:
+    """最初のリクエスト（ヘルスチェックを除く）の完了を time_to_first_request として記録する"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.done = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.done or scope["type"] != "http" or scope["path"].startswith(UNTIMED_PATH_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if not self.done:
+                self.done = True
+                metrics.mark("time_to_first_request")
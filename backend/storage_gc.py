@@ -0,0 +1,148 @@
+"""
+R2の不要オブジェクトのガベージコレクション
+
+- drain_queue(): storage_deletions に積まれたオブジェクトを delete_objects で最大1000件ずつ削除する
+- reconcile(): SWEEP_PREFIXES 配下を列挙し、DBから参照されていない古いオブジェクトをキューに積む
+
+リクエスト処理中はキューに積むだけなので、削除のレイテンシはリクエストにかからない。
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Set
+
+from sqlalchemy import select
+
+import crud
+import models
+from database import SessionLocal
+from r2_storage import get_r2_storage
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH_SIZE = 1000          # delete_objects の上限
+MAX_BATCHES_PER_RUN = 10
+MAX_ATTEMPTS = 5
+DRAIN_INTERVAL_SECONDS = 60
+RECONCILE_INTERVAL_SECONDS = 24 * 60 * 60
+# アップロード直後でまだDBにコミットされていないオブジェクトを消さないための猶予
+RECONCILE_GRACE = timedelta(hours=24)
+# すべてのオブジェクトがDBから参照されるプレフィックスだけを掃除する
+SWEEP_PREFIXES = ("spots/", "user_icons/")
+
+
+def _referenced_urls(db, urls: Iterable[str]) -> Set[str]:
+    """spots / users / skins のいずれかから参照されているURL"""
+    urls = list(urls)
+    if not urls:
+        return set()
+    referenced: Set[str] = set()
+    for column in (models.Spot.image_url, models.User.icon_url, models.Skin.image_url):
+        referenced.update(db.scalars(select(column).where(column.in_(urls))))
+    return referenced
+
+
+def _is_protected(object_key: str) -> bool:
+    return object_key.startswith(crud.PROTECTED_STORAGE_PREFIXES)
+
+
+def _drain_batch(db, r2) -> int:
+    rows: List[models.StorageDeletion] = (
+        db.query(models.StorageDeletion)
+        .order_by(models.StorageDeletion.created_at)
+        .limit(DELETE_BATCH_SIZE)
+        .all()
+    )
+    if not rows:
+        return 0
+
+    # 再び参照されたもの・このバケット以外のURL・保護対象は消さずにキューから外す
+    referenced = _referenced_urls(db, {row.file_url for row in rows})
+    keys: Dict[str, List[models.StorageDeletion]] = {}
+    for row in rows:
+        key = r2.get_object_key(row.file_url)
+        if key is None or row.file_url in referenced or _is_protected(key):
+            db.delete(row)
+            continue
+        keys.setdefault(key, []).append(row)
+
+    try:
+        _deleted, failed = r2.delete_files(list(keys))
+    except Exception:
+        logger.exception("delete_objects request failed")
+        failed = list(keys)
+
+    failed_set = set(failed)
+    for key, key_rows in keys.items():
+        for row in key_rows:
+            if key not in failed_set:
+                db.delete(row)
+            elif row.attempts + 1 >= MAX_ATTEMPTS:
+                logger.warning("Giving up deleting %s after %d attempts", key, MAX_ATTEMPTS)
+                db.delete(row)
+            else:
+                row.attempts += 1
+    db.commit()
+
+    if failed_set:
+        # 失敗したものは次回の実行で再試行する
+        return 0
+    return len(rows)
+
+
+def drain_queue() -> int:
+    """削除キューを処理する（バックグラウンドタスク用）"""
+    db = SessionLocal()
+    processed = 0
+    try:
+        r2 = get_r2_storage()
+        for _ in range(MAX_BATCHES_PER_RUN):
+            count = _drain_batch(db, r2)
+            processed += count
+            if count < DELETE_BATCH_SIZE:
+                break
+    finally:
+        db.close()
+    if processed:
+        logger.info("Deleted %d orphaned objects from R2", processed)
+    return processed
+
+
+def reconcile() -> int:
+    """
+    バケットを走査し、参照されていないオブジェクトを削除キューに積む（バックグラウンドタスク用）
+
+    URLの比較は現在のR2設定で生成したURL（カスタムドメイン / エンドポイント）で行う。
+    """
+    db = SessionLocal()
+    enqueued = 0
+    cutoff = datetime.now(timezone.utc) - RECONCILE_GRACE
+    try:
+        r2 = get_r2_storage()
+        endpoint_base = f"{r2.endpoint_url.rstrip('/')}/{r2.bucket_name}"
+        for prefix in SWEEP_PREFIXES:
+            for page in r2.list_objects(prefix):
+                candidates: Dict[str, str] = {}  # url -> key
+                for key, last_modified in page:
+                    if last_modified >= cutoff or _is_protected(key):
+                        continue
+                    candidates[r2.get_public_url(key)] = key
+                    candidates[f"{endpoint_base}/{key}"] = key
+                if not candidates:
+                    continue
+
+                referenced_keys = {candidates[url] for url in _referenced_urls(db, candidates)}
+                queued = set(db.scalars(
+                    select(models.StorageDeletion.file_url)
+                    .where(models.StorageDeletion.file_url.in_(list(candidates)))
+                ))
+                queued_keys = {candidates[url] for url in queued}
+
+                for key in set(candidates.values()) - referenced_keys - queued_keys:
+                    db.add(models.StorageDeletion(file_url=r2.get_public_url(key), reason="orphaned"))
+                    enqueued += 1
+                db.commit()
+    finally:
+        db.close()
+    if enqueued:
+        logger.info("Reconciliation queued %d orphaned objects", enqueued)
+    return enqueued
@@ -0,0 +1,30 @@
+import admission
+
+TRUSTED = admission.parse_trusted_proxies("10.0.0.0/8, 127.0.0.1")
+
+
+def _scope(client, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded is not None else []
+    return {"type": "http", "client": (client, 12345), "headers": headers}
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies():
+    scope = _scope("203.0.113.5", "198.51.100.1")
+    assert admission._client_key(scope, None, "HS256") == "ip:203.0.113.5"
+
+
+def test_forwarded_for_is_ignored_from_untrusted_peer():
+    scope = _scope("203.0.113.5", "198.51.100.1")
+    assert admission._client_key(scope, None, "HS256", TRUSTED) == "ip:203.0.113.5"
+
+
+def test_rightmost_untrusted_forwarded_address_is_the_client():
+    # 左端はクライアントが偽装した値、10.1.2.3 は途中の信頼するプロキシ
+    scope = _scope("10.0.0.1", "1.2.3.4, 198.51.100.7, 10.1.2.3")
+    assert admission._client_key(scope, None, "HS256", TRUSTED) == "ip:198.51.100.7"
+
+
+def test_all_trusted_hops_fall_back_to_leftmost():
+    scope = _scope("127.0.0.1", "10.0.0.9")
+    assert admission._client_key(scope, None, "HS256", TRUSTED) == "ip:10.0.0.9"
+    assert admission._client_key(_scope("127.0.0.1"), None, "HS256", TRUSTED) == "ip:127.0.0.1"
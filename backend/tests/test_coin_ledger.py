@@ -0,0 +1,44 @@
+from sqlalchemy import func, select
+
+import coin_ledger
+import crud
+import models
+import schemas
+
+
+def _ledger_sum(db, user_id):
+    return db.scalar(select(func.sum(models.CoinLedger.delta)).where(models.CoinLedger.user_id == user_id))
+
+
+def test_settle_coins_makes_users_coins_equal_ledger_sum(db, user):
+    crud.add_spot(db, user, schemas.SpotCreate(lat=35.0, lng=139.0, title="Cafe"), image_url=None)
+    crud.credit_coins(db, user.id, crud.CHECKIN_REWARD, crud.COIN_REASON_CHECKIN)
+    db.commit()
+    skin = models.Skin(name="Gold Pin", image_url="https://example.com/gold.png", price=12)
+    db.add(skin)
+    db.commit()
+    assert crud.purchase_skin(db, user.id, skin.id) == crud.PurchaseResult.SUCCESS
+    db.commit()
+    before = crud.get_coin_balance(db, user.id)
+
+    assert crud.settle_coins(db, user.id) == 3
+
+    db.refresh(user)
+    assert user.coins == _ledger_sum(db, user.id) == crud.SPOT_POST_REWARD + crud.CHECKIN_REWARD - 12
+    assert user.coins_earned == crud.SPOT_POST_REWARD + crud.CHECKIN_REWARD
+    assert crud.get_coin_balance(db, user.id) == before
+    assert db.scalar(select(func.count()).where(models.CoinLedger.settled.is_(False))) == 0
+
+
+def test_settle_pending_settles_new_entries_only_once(db, user):
+    crud.credit_coins(db, user.id, 7, crud.COIN_REASON_CHECKIN)
+    db.commit()
+
+    assert coin_ledger.settle_pending() == 1
+    assert coin_ledger.settle_pending() == 0
+    crud.credit_coins(db, user.id, 3, crud.COIN_REASON_CHECKIN)
+    db.commit()
+    assert coin_ledger.settle_pending() == 1
+
+    db.refresh(user)
+    assert user.coins == _ledger_sum(db, user.id) == 10
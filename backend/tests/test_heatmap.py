@@ -0,0 +1,42 @@
+import uuid
+
+import geo
+import heatmap
+
+TOKYO = (35.681, 139.767)
+OSAKA = (34.702, 135.496)
+
+
+def _tile_of(lat, lng, z):
+    return geo.latlng_to_tile(lat, lng, z)
+
+
+def test_change_misses_only_tiles_over_its_region():
+    tiles = heatmap.SpotHeatmap()
+    tiles.upsert(uuid.uuid4(), *TOKYO, "low")
+    tokyo = (heatmap.MODE_DENSITY, 14, *_tile_of(*TOKYO, 14))
+    osaka = (heatmap.MODE_DENSITY, 14, *_tile_of(*OSAKA, 14))
+    world = (heatmap.MODE_DENSITY, 0, 0, 0)
+    for key in (tokyo, osaka, world):
+        tiles.tile(*key)
+        assert tiles.cached_tile(*key) is not None
+
+    tiles.upsert(uuid.uuid4(), TOKYO[0] + 0.001, TOKYO[1], "high")
+
+    assert tiles.cached_tile(*tokyo) is None
+    assert tiles.cached_tile(*world) is None
+    assert tiles.cached_tile(*osaka) is not None
+
+
+def test_unchanged_upsert_keeps_cached_tiles():
+    tiles = heatmap.SpotHeatmap()
+    spot_id = uuid.uuid4()
+    tiles.upsert(spot_id, *TOKYO, "low")
+    key = (heatmap.MODE_CROWD, 12, *_tile_of(*TOKYO, 12))
+    tiles.tile(*key)
+
+    tiles.upsert(spot_id, *TOKYO, "low")
+    assert tiles.cached_tile(*key) is not None
+
+    tiles.remove(spot_id)
+    assert tiles.cached_tile(*key) is None
@@ -0,0 +1,49 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import hot_spots
+
+LAT, LNG = 35.66, 139.70
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _full_truncated_ranking():
+    """CELL_CAPACITY件を保持し、それより下位の候補がDBにあるセル"""
+    ranking = hot_spots.HotSpotRanking()
+    ids = [uuid.uuid4() for _ in range(hot_spots.CELL_CAPACITY + 1)]
+    for i, spot_id in enumerate(ids):
+        ranking.upsert(spot_id, LAT, LNG, 5, "low", NOW - timedelta(minutes=i))
+    assert ranking._truncated and not ranking._stale
+    return ranking, ids
+
+
+def test_rerank_in_place_does_not_mark_stale():
+    ranking, ids = _full_truncated_ranking()
+
+    # 差分同期で同じ行を取り込み直す・順位が上がる
+    ranking.upsert(ids[0], LAT, LNG, 5, "low", NOW)
+    ranking.upsert(ids[10], LAT, LNG, 5, "low", NOW + timedelta(minutes=1))
+
+    assert not ranking._stale
+
+
+@pytest.mark.parametrize("change", [
+    lambda r, spot_id: r.remove(spot_id),
+    lambda r, spot_id: r.upsert(spot_id, LAT + 1.0, LNG, 5, "low", NOW),
+    lambda r, spot_id: r.upsert(spot_id, LAT, LNG, 1, "high", NOW),
+], ids=["delete", "move-out", "drop-below-last"])
+def test_leaving_truncated_cell_marks_stale(change):
+    ranking, ids = _full_truncated_ranking()
+
+    change(ranking, ids[0])
+
+    assert ranking._stale
+
+
+def test_top_rejects_radius_beyond_ring():
+    ranking = hot_spots.HotSpotRanking()
+    with pytest.raises(ValueError):
+        ranking.top(60.0, LNG, hot_spots.max_radius_m(60.0) + 1)
+    assert ranking.top(60.0, LNG, hot_spots.max_radius_m(60.0)) == []
@@ -0,0 +1,83 @@
+import json
+import uuid
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+
+import cache
+import crud
+import idempotency
+import main
+import models
+import schemas
+
+ENDPOINT = "POST /spots"
+
+
+def _post_spot(db, user, calls):
+    def func():
+        calls.append(1)
+        spot = crud.add_spot(db, user, schemas.SpotCreate(lat=35.0, lng=139.0, title="Cafe"), image_url=None)
+        return {"id": str(spot.id)}
+    return func
+
+
+def _spot_count(db):
+    return db.query(models.Spot).count()
+
+
+def test_replay_returns_stored_response_without_running_again(db, user, monkeypatch):
+    calls = []
+    first = main._run_idempotent(db, user.id, ENDPOINT, "key-1", "hash", _post_spot(db, user, calls))
+
+    replayed = main._run_idempotent(db, user.id, ENDPOINT, "key-1", "hash", _post_spot(db, user, calls))
+    # 他のワーカー（プロセス内のキャッシュが無い）でもDBから返す
+    monkeypatch.setattr(idempotency, "_completed", cache.LRUCache(maxsize=10))
+    from_db = main._run_idempotent(db, user.id, ENDPOINT, "key-1", "hash", _post_spot(db, user, calls))
+
+    assert len(calls) == 1
+    assert _spot_count(db) == 1
+    for response in (replayed, from_db):
+        assert response.headers["Idempotent-Replayed"] == "true"
+        assert json.loads(response.body) == first
+
+
+def test_reused_key_with_different_request_is_rejected(db, user):
+    main._run_idempotent(db, user.id, ENDPOINT, "key-2", "hash", _post_spot(db, user, []))
+
+    with pytest.raises(HTTPException) as excinfo:
+        main._run_idempotent(db, user.id, ENDPOINT, "key-2", "other-hash", _post_spot(db, user, []))
+    assert excinfo.value.status_code == 422
+
+
+def test_failure_releases_key_and_rolls_back(db, user):
+    def failing():
+        _post_spot(db, user, [])()
+        raise RuntimeError("storage failed")
+
+    with pytest.raises(RuntimeError):
+        main._run_idempotent(db, user.id, ENDPOINT, "key-3", "hash", failing)
+    assert _spot_count(db) == 0
+    assert db.query(models.IdempotencyRecord).count() == 0
+
+    committed = []
+    main._run_idempotent(db, user.id, ENDPOINT, "key-3", "hash", _post_spot(db, user, []), lambda: committed.append(1))
+    assert _spot_count(db) == 1
+    assert committed == [1]
+
+
+def test_commit_failure_releases_key(db, user):
+    def orphan_spot():
+        # 存在しないユーザーのスポット（コミット時に外部キー制約で失敗する）
+        db.add(models.Spot(
+            author_id=uuid.uuid4(), skin_id=user.current_skin_id, latitude=35.0, longitude=139.0,
+            grid_key=0, title="Orphan", crowd_level="medium", author_crowd_level="medium", rating=3,
+        ))
+        return {"ok": True}
+
+    with pytest.raises(IntegrityError):
+        main._run_idempotent(db, user.id, ENDPOINT, "key-4", "hash", orphan_spot)
+
+    assert db.query(models.IdempotencyRecord).count() == 0
+    assert idempotency._completed.get((user.id, ENDPOINT, "key-4")) is None
@@ -0,0 +1,100 @@
+import uuid
+
+import pytest
+from sqlalchemy import inspect, select, text
+
+import crud
+import database
+import geo
+import migrations
+import models
+from conftest import make_engine
+
+# 変更前（マイグレーション導入前）のスキーマ
+BASELINE_SCHEMA = [
+    """CREATE TABLE skins (
+        id CHAR(32) PRIMARY KEY, name VARCHAR(50) NOT NULL, image_url VARCHAR(500) NOT NULL,
+        price INTEGER NOT NULL, created_at DATETIME NOT NULL)""",
+    """CREATE TABLE users (
+        id CHAR(32) PRIMARY KEY, username VARCHAR(50) NOT NULL, hashed_password VARCHAR(255) NOT NULL,
+        icon_url VARCHAR(500), coins INTEGER NOT NULL, current_skin_id CHAR(32) REFERENCES skins (id),
+        created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)""",
+    "CREATE UNIQUE INDEX ix_users_username ON users (username)",
+    """CREATE TABLE user_skins (
+        id CHAR(32) PRIMARY KEY, user_id CHAR(32) NOT NULL REFERENCES users (id),
+        skin_id CHAR(32) NOT NULL REFERENCES skins (id), purchased_at DATETIME NOT NULL)""",
+    """CREATE TABLE spots (
+        id CHAR(32) PRIMARY KEY, author_id CHAR(32) NOT NULL REFERENCES users (id),
+        skin_id CHAR(32) NOT NULL REFERENCES skins (id), latitude FLOAT NOT NULL, longitude FLOAT NOT NULL,
+        title VARCHAR(50) NOT NULL, description VARCHAR(200), image_url VARCHAR(500),
+        crowd_level VARCHAR(6) NOT NULL, rating INTEGER NOT NULL,
+        created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)""",
+    "CREATE INDEX ix_spots_latitude ON spots (latitude)",
+    "CREATE INDEX ix_spots_longitude ON spots (longitude)",
+    "CREATE INDEX ix_spots_created_at ON spots (created_at)",
+]
+
+CREATED_AT = "2024-01-01 00:00:00.000000"
+
+
+@pytest.fixture
+def baseline(tmp_path, monkeypatch):
+    """変更前のスキーマとデータを入れたDBのエンジンと、ユーザーのID"""
+    engine = make_engine(tmp_path / "baseline.db")
+    monkeypatch.setattr(database, "_engine", engine)
+    database.SessionLocal.configure(bind=engine)
+    skin_id, user_id = uuid.uuid4(), uuid.uuid4()
+    with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(
+            text("INSERT INTO skins VALUES (:id, 'Default Pin', 'https://example.com/pin.png', 0, :at)"),
+            {"id": skin_id.hex, "at": CREATED_AT},
+        )
+        conn.execute(
+            text("INSERT INTO users VALUES (:id, 'alice', 'x', NULL, 30, :skin_id, :at, :at)"),
+            {"id": user_id.hex, "skin_id": skin_id.hex, "at": CREATED_AT},
+        )
+        for lat, lng, rating in [(35.681, 139.767, 4), (34.702, 135.496, 2)]:
+            conn.execute(
+                text("INSERT INTO spots VALUES (:id, :user_id, :skin_id, :lat, :lng, 'Spot', NULL, NULL, 'LOW', :rating, :at, :at)"),
+                {"id": uuid.uuid4().hex, "user_id": user_id.hex, "skin_id": skin_id.hex,
+                 "lat": lat, "lng": lng, "rating": rating, "at": CREATED_AT},
+            )
+    yield engine, user_id
+    database.SessionLocal.configure(bind=None)
+    engine.dispose()
+
+
+def test_upgrade_existing_baseline_db(baseline):
+    engine, user_id = baseline
+
+    assert migrations.upgrade(engine) == [version for version, _, _ in migrations.MIGRATIONS]
+    assert migrations.upgrade(engine) == []
+
+    spot_indexes = {ix["name"] for ix in inspect(engine).get_indexes("spots")}
+    assert not spot_indexes & {"ix_spots_latitude", "ix_spots_longitude", "ix_spots_created_at"}
+    assert {ix.name for ix in models.Spot.__table__.indexes} <= spot_indexes
+
+    db = database.SessionLocal()
+    try:
+        for spot in db.query(models.Spot):
+            assert spot.grid_key == geo.grid_key(spot.latitude, spot.longitude)
+            assert spot.author_crowd_level == spot.crowd_level
+        assert crud.get_spot_stats(db, user_id) == (2, 6)
+        assert crud.get_coin_balance(db, user_id).coins == 30
+        opening = db.scalars(select(models.CoinLedger.delta).where(models.CoinLedger.user_id == user_id)).all()
+        assert opening == [30]
+        skin = db.query(models.Skin).one()
+        assert skin.updated_at == skin.created_at
+    finally:
+        db.close()
+
+
+def test_upgrade_fresh_db_stamps_all_versions(tmp_path):
+    engine = make_engine(tmp_path / "fresh.db")
+
+    assert migrations.upgrade(engine) == []
+    with engine.connect() as conn:
+        assert migrations.applied_versions(conn) == {version for version, _, _ in migrations.MIGRATIONS}
+    engine.dispose()
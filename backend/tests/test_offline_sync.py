@@ -0,0 +1,80 @@
+import uuid
+
+import models
+import offline_sync
+import schemas
+
+
+def _create(client_id, spot_id=None, title="Cafe", lat=35.0):
+    return schemas.SyncMutation(
+        client_id=client_id, op="create", spot_id=spot_id, spot={"lat": lat, "lng": 139.0, "title": title},
+    )
+
+
+def _update(client_id, spot_id, **changes):
+    return schemas.SyncMutation(client_id=client_id, op="update", spot_id=spot_id, changes=changes)
+
+
+def _delete(client_id, spot_id):
+    return schemas.SyncMutation(client_id=client_id, op="delete", spot_id=spot_id)
+
+
+def _fail_on(monkeypatch, client_id):
+    """指定した変更の適用でDBの障害を起こす"""
+    apply = offline_sync._apply
+
+    def failing_apply(db, user, mutation, image_url):
+        if mutation.client_id == client_id:
+            raise RuntimeError("connection lost")
+        return apply(db, user, mutation, image_url)
+
+    monkeypatch.setattr(offline_sync, "_apply", failing_apply)
+
+
+def test_mid_batch_failure_returns_503_for_uncommitted_and_rest(db, user, monkeypatch):
+    monkeypatch.setattr(offline_sync, "COMMIT_EVERY", 2)
+    _fail_on(monkeypatch, "boom")
+    first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    mutations = [
+        _create("a", first, lat=35.0),
+        _create("b", second, lat=35.1),        # ここまでで1回コミットする
+        _update("missing", uuid.uuid4(), rating=5),
+        _create("c", third, lat=35.2),         # 障害でロールバックされる
+        _create("boom", lat=35.3),
+        _create("rejected", lat=35.4),
+        _delete("d", first),
+    ]
+    rejected = {5: offline_sync.MutationResult(422, error="Image not found")}
+
+    results = offline_sync.apply_batch(db, user, mutations, {}, rejected)
+
+    assert [r.status_code for r in results] == [200, 200, 404, 503, 503, 422, 503]
+    assert results[3].error == results[4].error == results[6].error == offline_sync.NOT_APPLIED
+    db.expire_all()
+    assert {spot.id for spot in db.query(models.Spot)} == {first, second}
+
+
+def test_replaying_the_503_tail_applies_it_once(db, user, monkeypatch):
+    spot_id = uuid.uuid4()
+    apply = offline_sync._apply
+    _fail_on(monkeypatch, "boom")
+    mutations = [_create("a", spot_id), _create("boom", lat=35.3)]
+    assert [r.status_code for r in offline_sync.apply_batch(db, user, mutations, {}, {})] == [503, 503]
+
+    monkeypatch.setattr(offline_sync, "_apply", apply)
+    results = offline_sync.apply_batch(db, user, mutations + [_create("a-again", spot_id)], {}, {})
+
+    assert [r.status_code for r in results] == [200, 200, 200]
+    assert results[2].spot_id == spot_id
+    assert db.query(models.Spot).count() == 2
+
+
+def test_delete_after_crowd_update_in_same_batch(db, user):
+    spot_id = uuid.uuid4()
+    mutations = [_create("a", spot_id), _update("b", spot_id, crowd_level="high"), _delete("c", spot_id)]
+
+    results = offline_sync.apply_batch(db, user, mutations, {}, {})
+
+    assert [r.status_code for r in results] == [200, 200, 200]
+    assert db.query(models.Spot).count() == 0
+    assert db.query(models.CrowdReport).count() == 0
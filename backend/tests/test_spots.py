@@ -0,0 +1,43 @@
+import pytest
+from pydantic import ValidationError
+
+import models
+import schemas
+import crud
+
+
+def _add_spot(db, user, **fields):
+    spot = schemas.SpotCreate(**{"lat": 35.0, "lng": 139.0, "title": "Cafe", **fields})
+    db_spot = crud.add_spot(db, user, spot, image_url=None)
+    db.commit()
+    return db_spot
+
+
+def test_delete_spot_removes_dependent_rows(db, user):
+    db_spot = _add_spot(db, user)
+    crud.update_spot(db, db_spot.id, user.id, schemas.SpotUpdate(crowd_level="high"))
+    db.add(models.SpotCounter(spot_id=db_spot.id, views=1))
+    db.commit()
+
+    crud.delete_spot(db, db_spot.id, user.id)
+
+    assert db.get(models.Spot, db_spot.id) is None
+    assert db.query(models.CrowdReport).count() == 0
+    assert db.query(models.SpotCounter).count() == 0
+    assert crud.get_spot_stats(db, user.id) == (0, 0)
+
+
+def test_find_duplicate_spots_near_pole(db, user):
+    _add_spot(db, user, lat=89.9999, lng=10.0, title="North Pole Camp")
+
+    candidates = crud.find_duplicate_spots(db, 89.9999, -170.0, "North Pole Camp")
+
+    assert [c.title for c in candidates] == ["North Pole Camp"]
+    assert crud.find_duplicate_spots(db, 90.0, 0.0, "Unrelated") == []
+
+
+def test_spot_create_rejects_out_of_range_coordinates():
+    with pytest.raises(ValidationError):
+        schemas.SpotCreate(lat=91.0, lng=0.0, title="Nowhere")
+    with pytest.raises(ValidationError):
+        schemas.SpotUpdate(lng=-180.5)
@@ -0,0 +1,128 @@
+"""
+スポット一覧レスポンスのコンテンツネゴシエーション
+
+- 形式: shape=table で投稿者・スキンを1回だけ列挙し、各スポットはインデックスで参照する列指向の形
+- エンコード: Accept が application/msgpack なら MessagePack、それ以外はJSON
+- 圧縮: Accept-Encoding に応じて brotli / gzip（COMPRESS_MIN_SIZE未満は無圧縮）
+"""
+import gzip
+import json
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+import brotli
+import msgpack
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+
+import models
+import schemas
+
+COMPRESS_MIN_SIZE = 1024
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+TABLE_COLUMNS = [
+    "id", "created_at", "lat", "lng", "title", "description", "image_url",
+    "crowd_level", "rating", "author", "skin",
+]
+
+_spot_list_adapter = TypeAdapter(List[schemas.SpotResponse])
+
+
+def _wants_msgpack(request: Request) -> bool:
+    accept = request.headers.get("accept", "").lower()
+    return any(media in accept for media in MSGPACK_MEDIA_TYPES)
+
+
+def _choose_encoding(request: Request) -> Optional[str]:
+    """Accept-Encodingからbr > gzipの順に選ぶ（q=0は除外）"""
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").lower().split(","):
+        token, _, params = part.partition(";")
+        name, _, value = params.partition("=")
+        if name.strip() == "q":
+            try:
+                if float(value) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(token.strip())
+    for encoding in ("br", "gzip"):
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def spots_to_table(spots: List[models.Spot], include_description: bool = False) -> dict:
+    """投稿者・スキンを正規化した列指向の表現に変換する"""
+    authors: List[list] = []
+    skins: List[list] = []
+    author_index: Dict[UUID, int] = {}
+    skin_index: Dict[UUID, int] = {}
+    rows = []
+    for spot in spots:
+        author = spot.author
+        if author.id not in author_index:
+            author_index[author.id] = len(authors)
+            authors.append([str(author.id), author.username, author.icon_url])
+        skin = spot.skin
+        if skin.id not in skin_index:
+            skin_index[skin.id] = len(skins)
+            skins.append([str(skin.id), skin.name, skin.image_url])
+        rows.append([
+            str(spot.id),
+            spot.created_at.isoformat(),
+            spot.latitude,
+            spot.longitude,
+            spot.title,
+            spot.description if include_description else None,
+            spot.image_url,
+            models.CrowdLevelEnum(spot.crowd_level).value,
+            spot.rating,
+            author_index[author.id],
+            skin_index[skin.id],
+        ])
+    return {
+        "columns": TABLE_COLUMNS,
+        "rows": rows,
+        "authors": {"columns": ["id", "username", "icon_url"], "rows": authors},
+        "skins": {"columns": ["id", "name", "image_url"], "rows": skins},
+    }
+
+
+def _encode(request: Request, spots: List[models.Spot], shape: str, to_response) -> Tuple[bytes, str]:
+    use_msgpack = _wants_msgpack(request)
+    if shape == "table":
+        payload = spots_to_table(spots)
+        if use_msgpack:
+            return msgpack.packb(payload, use_bin_type=True), "application/msgpack"
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), "application/json"
+
+    responses = [to_response(spot) for spot in spots]
+    if use_msgpack:
+        payload = _spot_list_adapter.dump_python(responses, mode="json")
+        return msgpack.packb(payload, use_bin_type=True), "application/msgpack"
+    return _spot_list_adapter.dump_json(responses), "application/json"
+
+
+def spot_list_response(request: Request, spots: List[models.Spot], shape: str, to_response) -> Response:
+    """
+    スポット一覧をネゴシエーション結果に応じてエンコード・圧縮したResponseを返す
+
+    Args:
+        spots: author/skinをロード済みのスポット
+        shape: "full"（従来のSpotResponseの配列）または "table"
+        to_response: shape="full" のときのSpotResponse変換関数
+    """
+    body, media_type = _encode(request, spots, shape, to_response)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+
+    encoding = _choose_encoding(request) if len(body) >= COMPRESS_MIN_SIZE else None
+    if encoding == "br":
+        body = brotli.compress(body, quality=4)
+        headers["Content-Encoding"] = "br"
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(content=body, media_type=media_type, headers=headers)